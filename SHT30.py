@@ -4,14 +4,18 @@
 
 
 # MODULE IMPORTS
+import threading
 import time
 
-import smbus
+import hardware
+import instrumentation
 
-import traceback
-import RPi.GPIO as GPIO
+# Only decode_frames wants numpy, and it takes a good part of a second to
+# import on a Pi, so it is loaded on first use (see _load_numpy).
+numpy = None
+_numpy_checked = False
 
-GPIO.setmode(GPIO.BCM)
+import traceback
 
 # GLOBAL VARIABLES
 SHT30_I2CADDR = 0x44
@@ -22,51 +26,369 @@ SHT30_POLYNOMIAL = 0x131  # P(x) = x^8 + x^5 + x^4 + 1 = 100110001
 
 SHT30DEBUG = False
 
+# MEASUREMENT MODES
+SHT30_MODE_SINGLE_SHOT = "single_shot"
+SHT30_MODE_PERIODIC = "periodic"
+
+SHT30_REPEATABILITY_HIGH = "high"
+SHT30_REPEATABILITY_MEDIUM = "medium"
+SHT30_REPEATABILITY_LOW = "low"
+
+# single shot without clock stretching, we wait out the conversion ourselves
+# (the Pi's I2C controller does not cope well with clock stretching)
+SHT30_SINGLE_SHOT_COMMANDS = {
+    SHT30_REPEATABILITY_HIGH: (0x24, 0x00),
+    SHT30_REPEATABILITY_MEDIUM: (0x24, 0x0B),
+    SHT30_REPEATABILITY_LOW: (0x24, 0x16),
+}
+
+# maximum conversion time per repeatability from the datasheet, plus margin
+SHT30_MEASUREMENT_DURATION = {
+    SHT30_REPEATABILITY_HIGH: 0.016,
+    SHT30_REPEATABILITY_MEDIUM: 0.007,
+    SHT30_REPEATABILITY_LOW: 0.005,
+}
+
+# periodic acquisition, keyed by measurements per second then repeatability
+SHT30_PERIODIC_COMMANDS = {
+    0.5: {SHT30_REPEATABILITY_HIGH: (0x20, 0x32), SHT30_REPEATABILITY_MEDIUM: (0x20, 0x24), SHT30_REPEATABILITY_LOW: (0x20, 0x2F)},
+    1:   {SHT30_REPEATABILITY_HIGH: (0x21, 0x30), SHT30_REPEATABILITY_MEDIUM: (0x21, 0x26), SHT30_REPEATABILITY_LOW: (0x21, 0x2D)},
+    2:   {SHT30_REPEATABILITY_HIGH: (0x22, 0x36), SHT30_REPEATABILITY_MEDIUM: (0x22, 0x20), SHT30_REPEATABILITY_LOW: (0x22, 0x2B)},
+    4:   {SHT30_REPEATABILITY_HIGH: (0x23, 0x34), SHT30_REPEATABILITY_MEDIUM: (0x23, 0x22), SHT30_REPEATABILITY_LOW: (0x23, 0x29)},
+    10:  {SHT30_REPEATABILITY_HIGH: (0x27, 0x37), SHT30_REPEATABILITY_MEDIUM: (0x27, 0x21), SHT30_REPEATABILITY_LOW: (0x27, 0x2A)},
+}
+SHT30_FETCH_DATA_COMMAND = (0xE0, 0x00)
+SHT30_BREAK_COMMAND = (0x30, 0x93)
+
+SHT30_FRAME_SIZE = 6
+
+# HEALTH STATES
+SHT30_HEALTHY = "healthy"
+SHT30_DEGRADED = "degraded"
+SHT30_FAILING = "failing"
+SHT30_QUARANTINED = "quarantined"
+
+# consecutive failed reads before a sensor counts as failing / is quarantined
+SHT30_FAILING_THRESHOLD = 3
+SHT30_QUARANTINE_THRESHOLD = 6
+# attempts per read in each state; the pause before a retry doubles each time
+SHT30_READ_ATTEMPTS = {SHT30_HEALTHY: 3, SHT30_DEGRADED: 2, SHT30_FAILING: 1, SHT30_QUARANTINED: 1}
+SHT30_RETRY_BACKOFF = 0.05
+# a quarantined sensor is skipped for the cooldown, which doubles every
+# time the trial read at the end of it fails
+SHT30_QUARANTINE_COOLDOWN = 60.0
+SHT30_MAX_QUARANTINE_COOLDOWN = 3600.0
+# power cycling: time off, time to settle once power is back, and how many
+# cycles to try before waiting for the sensor to come back on its own
+SHT30_POWER_OFF_TIME = 10.50
+SHT30_POWER_SETTLE_TIME = 1.50
+SHT30_MAX_POWER_CYCLES = 3
+# time from switching the power on to the first command: the datasheet's
+# 1 ms start-up time (tPU) plus a margin for the supply to come up
+SHT30_POWER_UP_TIME = 0.005
+
+# Sensors can share a power pin (the Grove PowerSave pin feeds both default
+# sensors), so power cycles are tracked per pin: when the pin is usable
+# again, and a generation count so every sensor on it knows it was reset.
+_power_lock = threading.Lock()
+_power_ready_at = {}
+_power_generation = {}
+# when each pin switched on by this process can first be talked to
+_power_up_ready_at = {}
+
+
+def _build_crc_table():
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ SHT30_POLYNOMIAL) & 0xff
+            else:
+                crc = (crc << 1) & 0xff
+        table.append(crc)
+    return tuple(table)
+
+# CRC-8 (poly 0x31, init 0xFF) of every byte value, one lookup per byte
+SHT30_CRC_TABLE = _build_crc_table()
+SHT30_CRC_TABLE_NUMPY = None
+
+
+def _load_numpy():
+    global numpy, SHT30_CRC_TABLE_NUMPY, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            return None
+        numpy = numpy_module
+        SHT30_CRC_TABLE_NUMPY = numpy.array(SHT30_CRC_TABLE, dtype=numpy.uint8)
+    return numpy
+
+
+def crc8(data):
+    crc = 0xff
+    for byte in data:
+        crc = SHT30_CRC_TABLE[crc ^ byte]
+    return crc
+
+
+def decode_frame(frame):
+    # frame is T msb, T lsb, T crc, H msb, H lsb, H crc
+    # returns (temperature C, humidity %, crc ok)
+    temperature = (((frame[0] << 8) | frame[1]) * 175.0 / 65535.0) - 45
+    humidity = ((frame[3] << 8) | frame[4]) * 100.0 / 65535.0
+    crc_ok = (SHT30_CRC_TABLE[SHT30_CRC_TABLE[0xff ^ frame[0]] ^ frame[1]] == frame[2] and
+              SHT30_CRC_TABLE[SHT30_CRC_TABLE[0xff ^ frame[3]] ^ frame[4]] == frame[5])
+    return (temperature, humidity, crc_ok)
+
+
+def decode_frames(frames):
+    # decode many raw frames at once, e.g. when replaying stored frames.
+    # frames is either a numpy array of shape (n, 6), or a bytes-like object
+    # (bytes, bytearray, memoryview) of concatenated frames, or a sequence
+    # of 6 byte frames.  returns (temperatures, humidities, crc_ok) as
+    # numpy arrays when numpy is available, lists otherwise
+    if _load_numpy() is not None:
+        if isinstance(frames, (bytes, bytearray, memoryview)):
+            data = numpy.frombuffer(frames, dtype=numpy.uint8).reshape(-1, SHT30_FRAME_SIZE)
+        else:
+            data = numpy.asarray(frames, dtype=numpy.uint8).reshape(-1, SHT30_FRAME_SIZE)
+        words = data.astype(numpy.uint16)
+        temperatures = ((words[:, 0] << 8) | words[:, 1]) * (175.0 / 65535.0) - 45
+        humidities = ((words[:, 3] << 8) | words[:, 4]) * (100.0 / 65535.0)
+        table = SHT30_CRC_TABLE_NUMPY
+        crc_ok = ((table[table[0xff ^ data[:, 0]] ^ data[:, 1]] == data[:, 2]) &
+                  (table[table[0xff ^ data[:, 3]] ^ data[:, 4]] == data[:, 5]))
+        return (temperatures, humidities, crc_ok)
+
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        view = memoryview(frames).cast('B')
+        frames = [view[i:i + SHT30_FRAME_SIZE] for i in range(0, len(view), SHT30_FRAME_SIZE)]
+    decoded = [decode_frame(frame) for frame in frames]
+    return ([d[0] for d in decoded], [d[1] for d in decoded], [d[2] for d in decoded])
+
+class SHT30UnavailableException(IOError):
+    """The sensor was skipped without touching the bus (quarantined or power cycling)."""
+    pass
+
+
+class SHT30Health:
+    """Health state machine for one sensor.
+
+    healthy -> degraded on a failed read, -> failing after
+    SHT30_FAILING_THRESHOLD consecutive failures, -> quarantined after
+    SHT30_QUARANTINE_THRESHOLD.  A quarantined sensor is not read at all
+    until its cooldown has passed, then gets a single trial read.  A good
+    read returns a healthy or degraded sensor to healthy; a failing or
+    quarantined one goes back through degraded first.
+    """
+
+    def __init__(self):
+        self.state = SHT30_HEALTHY
+        self.consecutive_failures = 0
+        self.quarantines = 0
+        self.quarantined_until = 0.0
+        self.cooldown = SHT30_QUARANTINE_COOLDOWN
+        self.episode_power_cycles = 0
+
+    def available(self, now):
+        return self.state != SHT30_QUARANTINED or now >= self.quarantined_until
+
+    def attempts(self):
+        return SHT30_READ_ATTEMPTS[self.state]
+
+    def record_success(self):
+        if self.state in (SHT30_FAILING, SHT30_QUARANTINED):
+            self.state = SHT30_DEGRADED
+        else:
+            self.state = SHT30_HEALTHY
+            self.cooldown = SHT30_QUARANTINE_COOLDOWN
+            self.episode_power_cycles = 0
+        self.consecutive_failures = 0
+
+    def record_failure(self, now):
+        self.consecutive_failures += 1
+        if self.state == SHT30_QUARANTINED:
+            # the trial read failed, stay out for longer this time
+            self.cooldown = min(self.cooldown * 2, SHT30_MAX_QUARANTINE_COOLDOWN)
+            self.quarantined_until = now + self.cooldown
+        elif self.consecutive_failures >= SHT30_QUARANTINE_THRESHOLD:
+            self.state = SHT30_QUARANTINED
+            self.quarantines += 1
+            self.quarantined_until = now + self.cooldown
+        elif self.consecutive_failures >= SHT30_FAILING_THRESHOLD:
+            self.state = SHT30_FAILING
+        else:
+            self.state = SHT30_DEGRADED
+        return self.state
+
+
 class SHT30:
     """Base functionality for SHT30 humidity and temperature sensor. """
 
-    def __init__(self, address=SHT30_I2CADDR, i2c=None, powerpin=0, **kwargs):
+    def __init__(self, address=SHT30_I2CADDR, i2c=None, powerpin=0, mode=SHT30_MODE_SINGLE_SHOT,
+                 repeatability=SHT30_REPEATABILITY_HIGH, mps=1, **kwargs):
 
-        i2c = smbus.SMBus(1)
+        if i2c is None:
+            i2c = hardware.smbus_module().SMBus(1)
+        self._address = address
         self.powerpin = powerpin
         # for Grove PowerSave
+        self._gpio = None
+        self._power_up_ready = None
+        self._periodic_pending = False
         if (self.powerpin != 0):
-            GPIO.setup(self.powerpin, GPIO.OUT)
-            GPIO.output(self.powerpin, True)
-            time.sleep(1.0)
+            self._gpio = hardware.gpio()
+            self._power_up_ready = self._power_up()
 
         self._device = i2c 
         self.humidity = 0
         self.temperature = 0
         self.crcT = 0
         self.crcH = 0
-        self.SHT30PreviousTemp = -1000
         self.goodreads = 0
         self.badreadings = 0
         self.badcrcs = 0
         self.retrys = 0
         self.powercycles = 0
+        self.health = SHT30Health()
+        self._power_generation = _power_generation.get(self.powerpin, 0)
+
+        self.mode = SHT30_MODE_SINGLE_SHOT
+        self.repeatability = repeatability
+        self.mps = mps
+        self._periodic_started = 0.0
+        if (mode == SHT30_MODE_PERIODIC):
+            self.start_periodic(mps, repeatability)
+        elif (mode != SHT30_MODE_SINGLE_SHOT):
+            raise ValueError("unknown SHT30 mode %s" % mode)
+
+    def _power_up(self):
+        # switch the power on without waiting for the sensor to come up; the
+        # first measurement waits out whatever is left (see _ensure_powered)
+        with _power_lock:
+            if self.powerpin not in _power_up_ready_at:
+                # after a crash or restart the pin is still a powered output,
+                # so the sensor is already up and there is nothing to wait for
+                was_output = self._gpio.gpio_function(self.powerpin) == self._gpio.OUT
+                self._gpio.setup(self.powerpin, self._gpio.OUT)
+                already_on = was_output and self._gpio.input(self.powerpin)
+                self._gpio.output(self.powerpin, True)
+                _power_up_ready_at[self.powerpin] = time.monotonic() + (0.0 if already_on else SHT30_POWER_UP_TIME)
+            return _power_up_ready_at[self.powerpin]
+
+    def _ensure_powered(self):
+        if self._power_up_ready is None:
+            return
+        wait = self._power_up_ready - time.monotonic()
+        self._power_up_ready = None
+        if wait > 0:
+            self._wait(wait)
+        if self._periodic_pending:
+            self._periodic_pending = False
+            self.start_periodic(self.mps, self.repeatability)
+
+    def _write_command(self, command):
+        with instrumentation.timed('sht30.command'):
+            self._device.write_i2c_block_data(self._address, command[0], [command[1]])
+
+    def _read_frame(self):
+        with instrumentation.timed('sht30.read'):
+            return self._device.read_i2c_block_data(self._address, SHT30_READREG, 6)
+
+    def _wait(self, seconds):
+        with instrumentation.timed('sht30.wait'):
+            time.sleep(seconds)
+
+    def start_periodic(self, mps=1, repeatability=SHT30_REPEATABILITY_HIGH):
+        # the sensor keeps measuring on its own, reads just fetch the latest result
+        if mps not in SHT30_PERIODIC_COMMANDS:
+            raise ValueError("SHT30 periodic mode supports %s measurements per second" % sorted(SHT30_PERIODIC_COMMANDS))
+        if self._power_up_ready is not None:
+            # not powered up yet, the first measurement sends the start command
+            self.mps = mps
+            self.repeatability = repeatability
+            self._periodic_pending = True
+            return
+        if (self.mode == SHT30_MODE_PERIODIC):
+            self.stop_periodic()
+        self._write_command(SHT30_PERIODIC_COMMANDS[mps][repeatability])
+        self.mode = SHT30_MODE_PERIODIC
+        self.mps = mps
+        self.repeatability = repeatability
+        self._periodic_started = time.monotonic()
+
+    def stop_periodic(self):
+        self._write_command(SHT30_BREAK_COMMAND)
+        # sensor needs 1ms to return to single shot mode after a break
+        time.sleep(0.001)
+        self.mode = SHT30_MODE_SINGLE_SHOT
+
+    def _measure(self):
+        # returns the raw 6 byte frame (T msb, T lsb, T crc, H msb, H lsb, H crc)
+        self._ensure_powered()
+        if (self.mode == SHT30_MODE_PERIODIC):
+            # no result is ready until the first period has elapsed
+            first_ready = self._periodic_started + (1.0 / self.mps) + SHT30_MEASUREMENT_DURATION[self.repeatability]
+            wait = first_ready - time.monotonic()
+            if wait > 0:
+                self._wait(wait)
+            try:
+                self._write_command(SHT30_FETCH_DATA_COMMAND)
+                return self._read_frame()
+            except IOError:
+                # NACK means the result since our last fetch is not ready yet
+                self._wait(1.0 / self.mps)
+                self._write_command(SHT30_FETCH_DATA_COMMAND)
+                return self._read_frame()
+        self._write_command(SHT30_SINGLE_SHOT_COMMANDS[self.repeatability])
+        self._wait(SHT30_MEASUREMENT_DURATION[self.repeatability])
+        return self._read_frame()
 
     def powerCycleSHT30(self):
+        # cut the power now and restore it from a timer thread, so nothing
+        # waits out the cycle; returns False if the pin is already cycling
         if (SHT30DEBUG == True):
             print ("power cycling SHT30")
-        GPIO.output(self.powerpin, False)
-        time.sleep(10.50)
-        GPIO.output(self.powerpin, True)
-        time.sleep(1.50)
+        now = time.monotonic()
+        with _power_lock:
+            if _power_ready_at.get(self.powerpin, 0.0) > now:
+                return False
+            self._gpio.output(self.powerpin, False)
+            _power_ready_at[self.powerpin] = now + SHT30_POWER_OFF_TIME + SHT30_POWER_SETTLE_TIME
+            _power_generation[self.powerpin] = _power_generation.get(self.powerpin, 0) + 1
+        timer = threading.Timer(SHT30_POWER_OFF_TIME, self._gpio.output, (self.powerpin, True))
+        timer.daemon = True
+        timer.start()
         self.powercycles += 1
-    
+        return True
+
+    def power_cycling(self):
+        return self.powerpin != 0 and _power_ready_at.get(self.powerpin, 0.0) > time.monotonic()
+
+    def _resume_after_power_cycle(self):
+        # a power cycle (ours or another sensor's on the same pin) drops the
+        # sensor back into single shot mode
+        generation = _power_generation.get(self.powerpin, 0)
+        if generation == self._power_generation:
+            return
+        self._power_generation = generation
+        if (self.mode == SHT30_MODE_PERIODIC):
+            self.mode = SHT30_MODE_SINGLE_SHOT
+            self.start_periodic(self.mps, self.repeatability)
+
     def verify_crc(self, data):
-        crc = 0xff
-        for byte in data:
-            crc ^= byte
-            for _ in range(8):
-                 if crc & 0x80:
-                    crc <<= 1
-                    crc ^= SHT30_POLYNOMIAL
-                 else:
-                    crc <<= 1
-        return crc
+        return crc8(data)
+
+    def _decode(self, tmp):
+        # sets temperature, humidity and raw crcs from a frame, returns crc ok
+        with instrumentation.timed('sht30.crc'):
+            self.temperature, self.humidity, crc_ok = decode_frame(tmp)
+        self.crcT = tmp[2]
+        self.crcH = tmp[5]
+        return crc_ok
 
 
 
@@ -74,147 +396,76 @@ class SHT30:
     def _fast_read_data(self):   
 
         
-        # TELL THE DEVICE WE WANT 4 BYTES OF DATA
-        self._device.write_i2c_block_data(SHT30_I2CADDR,SHT30_READCOMMAND,[0x06])
-        time.sleep(0.5)
-        tmp = self._device.read_i2c_block_data(SHT30_I2CADDR,SHT30_READREG,6)
+        # TELL THE DEVICE WE WANT 6 BYTES OF DATA
+        tmp = self._measure()
         print("tmp=", tmp)
-        TRaw = (((tmp[0] & 0x7F) << 8) | tmp[1]) 
-        HRaw = ((tmp[3] << 8) | tmp[4]) 
-        self.temperature = ((TRaw * 175) / 65535.0) - 45
-        self.humidity = 100 * (HRaw) / 65535.0
-
-        self.crcT = tmp[2]
-        self.crcH = tmp[5]
-        # Verify CRC here
-        # force CRC error with the next line
-        #tmp[0] = tmp[0]+1
-        tT = bytearray([tmp[0], tmp[1]])
-        crcTC = self.verify_crc(tT)
-        tH = bytearray([tmp[3], tmp[4]])
-        crcHC = self.verify_crc(tH)
+        crc_ok = self._decode(tmp)
 
         if (SHT30DEBUG == True):
             print("SHT30temperature=",self.temperature)
             print("SHT30humdity=",self.humidity)
             print("SHT30crcTR=",self.crcT)
-            print("SHT30crcTC=",crcTC)
             print("SHT30crcHR=",self.crcH)
-            print("SHT30crcHC=",crcHC)
 
-        if (self.crcT != crcTC) or (self.crcH != crcHC):
+        if not crc_ok:
             if (SHT30DEBUG == True):
-                print("AM2314 BAD CRC")
+                print("SHT30 BAD CRC")
             self.crc = -1
 
 
     def _read_data(self):
-        count = 0
-        tmp = None
-        powercyclecount = 0
-        while count <= MAXREADATTEMPT:
+        # raises SHT30UnavailableException when the sensor is skipped, and
+        # IOError once every attempt allowed in the current state has failed
+        if self.power_cycling():
+            raise SHT30UnavailableException("SHT30 power cycling")
+        now = time.monotonic()
+        if not self.health.available(now):
+            raise SHT30UnavailableException("SHT30 quarantined for another %0.0fs" % (self.health.quarantined_until - now))
+        self._resume_after_power_cycle()
+
+        attempts = self.health.attempts()
+        error = None
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.retrys += 1
+                time.sleep(SHT30_RETRY_BACKOFF * (2 ** (attempt - 1)))
             try:
-                self._device.write_i2c_block_data(SHT30_I2CADDR,SHT30_READCOMMAND,[0x06])
-                time.sleep(0.5)
-                tmp = self._device.read_i2c_block_data(SHT30_I2CADDR,SHT30_READREG,6)
-
-                #TRaw = (((tmp[0] & 0x7F) << 8) | tmp[1]) 
-                TRaw = (((tmp[0] ) << 8) | tmp[1]) 
-                HRaw = ((tmp[3] << 8) | tmp[4]) 
-                if (SHT30DEBUG == True):
-                    print("TRaw = ", hex(TRaw))
-                    print("TRaw = ", (TRaw))
-                    print("tmp[0] = ", hex(tmp[0]))
-                    print("tmp[1] = ", hex(tmp[1]))
-                    print("tmp[0] = ", (tmp[0]))
-                    print("tmp[1] = ", (tmp[1]))
-                    print("tmp[0] & 0x7F", hex(tmp[0] & 0x7F))
-                    print("TRaw*175/65535.0 = ", TRaw*175.0/65535.0) 
-                    print("TRaw*175/65535.0)-45 = ", (TRaw*175.0/65535.0 )-45)
-
-                self.temperature = ((TRaw * 175.0) / 65535.0) - 45
-                self.humidity = 100 * (HRaw) / 65535.0
-
-                self.crcT = tmp[2]
-                self.crcH = tmp[5]
-                # check for > 10.0 degrees higher
-                if (self.SHT30PreviousTemp != -1000):   # ignore first time
-                        if (self.humidity <0.01 or self.humidity > 100.0):
-                            # OK, humidity is bad.  Ignore
-                            if (SHT30DEBUG == True):
-                                print(">>>>>>>>>>>>>")
-                                print("Bad SHT30 Humidity = ", self.temperature)
-                                print(">>>>>>>>>>>>>")
-                                self.badreadings = self.badreadings+1
-                                tmp = None
-                        else:
-                            if (abs(self.temperature - self.SHT30PreviousTemp) > 10.0):
-                                # OK, temp is bad.  Ignore
-                                if (SHT30DEBUG == True):
-                                    print(">>>>>>>>>>>>>")
-                                    print("Bad SHT30 Humidity = ", self.temperature)
-                                    print(">>>>>>>>>>>>>")
-                                    self.badreadings = self.badreadings+1
-                                    tmp = None
-                            else:
-                                # Good Temperature
-                                self.SHT30PreviousTemp = self.temperature
-                else:
-                    # assume first is good temperature
-                    self.SHT30PreviousTemp = self.temperature
-                # IF WE HAVE DATA, LETS EXIT THIS LOOP
-                if tmp != None:
-                    break
+                tmp = self._measure()
             except Exception as ex:
                 if (SHT30DEBUG == True):
                     template = "An exception of type {0} occurred. Arguments:\n{1!r}"
                     message = template.format(type(ex).__name__, ex.args)
                     print(message)
                     print(traceback.format_exc())
-                    print("SHT30readCount = ", count)
-            count += 1
-            self.retrys += 1
-            time.sleep(0.10)
-            # only do three power cycle attempts
-            if (self.powerpin != 0):
-                if (count > MAXREADATTEMPT):
-                    self.powerCycleSHT30()
-                    if (powercyclecount <=2): 
-                        powercyclecount +1
-                        count = 0 
-            
-        # GET THE DATA OUT OF THE LIST WE READ
-        #TRaw = (((tmp[0] & 0x7F) << 8) | tmp[1]) 
-        TRaw = (((tmp[0]) << 8) | tmp[1]) 
-        HRaw = ((tmp[3] << 8) | tmp[4]) 
-        self.temperature = ((TRaw * 175) / 65535.0) - 45
-        self.humidity = 100 * (HRaw) / 65535.0
-
-        self.crcT = tmp[2]
-        self.crcH = tmp[5]
-        # Verify CRC here
-        # force CRC error with the next line
-        # tmp[0] = tmp[0]+1
-        tT = bytearray([tmp[0], tmp[1]])
-        crcTC = self.verify_crc(tT)
-        tH = bytearray([tmp[3], tmp[4]])
-        crcHC = self.verify_crc(tH)
-
-        if (SHT30DEBUG == True):
-            print("SHT30temperature=",self.temperature)
-            print("SHT30humdity=",self.humidity)
-            print("SHT30crcTR=",self.crcT)
-            print("SHT30crcTC=",crcTC)
-            print("SHT30crcHR=",self.crcH)
-            print("SHT30crcHC=",crcHC)
-
-        if (self.crcT != crcTC) or (self.crcH != crcHC):
+                    print("SHT30readCount = ", attempt)
+                error = ex
+                continue
             if (SHT30DEBUG == True):
-                print("SHT30 BAD CRC")
-            self.badcrcs = self.badcrcs + 1
-            self.crc = -1
-        else:
+                print("tmp = ", [hex(b) for b in tmp])
+            if not self._decode(tmp):
+                if (SHT30DEBUG == True):
+                    print("SHT30 BAD CRC")
+                self.badcrcs = self.badcrcs + 1
+                self.crc = -1
+                error = IOError("bad CRC")
+                continue
+            if (SHT30DEBUG == True):
+                print("SHT30temperature=",self.temperature)
+                print("SHT30humdity=",self.humidity)
+                print("SHT30crcTR=",self.crcT)
+                print("SHT30crcHR=",self.crcH)
             self.goodreads = self.goodreads+1
+            self.health.record_success()
+            return
+
+        state = self.health.record_failure(time.monotonic())
+        # schedule a power cycle rather than sitting through one; the next
+        # reads are skipped until the sensor has settled
+        if (self.powerpin != 0 and state in (SHT30_FAILING, SHT30_QUARANTINED) and
+                self.health.episode_power_cycles < SHT30_MAX_POWER_CYCLES):
+            if self.powerCycleSHT30():
+                self.health.episode_power_cycles += 1
+        raise IOError("SHT30 read failed after %d attempt(s), now %s - %s" % (attempts, state, error))
 
     def fast_read_temperature(self):
         self._fast_read_data()
@@ -241,6 +492,11 @@ class SHT30:
         return (self.humidity, self.temperature, self.crcH, self.crcT)
 
     def read_status_info(self):
+        # spikes are rejected by the filter stage (filters.py) now, so
+        # badreadings only stays for the shape of this tuple
         return  (self.goodreads, self.badreadings, self.badcrcs, self.retrys,self.powercycles)
 
+    def read_health_info(self):
+        return (self.health.state, self.health.consecutive_failures, self.health.quarantines)
+
     
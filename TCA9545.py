@@ -9,7 +9,7 @@
  
 from datetime import datetime
 
-import smbus
+import hardware
 
 # constants
 
@@ -40,8 +40,9 @@ class TCA9545():
     ###########################
     # TCA9545 Code
     ###########################
-    def __init__(self, twi=1, addr=TCA9545_ADDRESS, bus_enable =  TCA9545_CONFIG_BUS0 ):
-        self._bus = smbus.SMBus(twi)
+    def __init__(self, twi=1, addr=TCA9545_ADDRESS, bus_enable =  TCA9545_CONFIG_BUS0, bus=None ):
+        # Pass bus to share one SMBus handle with the devices behind the mux.
+        self._bus = bus if bus is not None else hardware.smbus_module().SMBus(twi)
         self._addr = addr
         config = bus_enable
         self._write(TCA9545_REG_CONFIG, config)
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+
+
+class StageResult:
+    """Outcome of one acquisition stage: its value or the exception it raised, and how long it took."""
+
+    def __init__(self, name, value=None, error=None, duration=0.0):
+        self.name = name
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class AcquisitionPipeline:
+    """Runs the acquisition stages of a tick concurrently and joins their results.
+
+    Each stage is a plain callable returning the data it gathered; storing
+    that data is left to the caller so the database is only touched from one
+    thread.  Stages sharing a piece of hardware must serialise themselves
+    (see bus_lock) since the pool makes no ordering promises.
+    """
+
+    DEFAULT_MAX_WORKERS = 3
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='acquire')
+        # The TCA9545 mux and every sensor behind it share one I2C bus, so any
+        # stage doing a mux switch + read must hold this for the whole sequence.
+        self.bus_lock = threading.Lock()
+
+    @staticmethod
+    def _timed(name, stage):
+        started = time.monotonic()
+        try:
+            result = StageResult(name, value=stage(), duration=time.monotonic() - started)
+        except Exception as e:
+            result = StageResult(name, error=e, duration=time.monotonic() - started)
+        instrumentation.record('stage.' + name, result.duration)
+        return result
+
+    def run(self, stages):
+        """Run {name: callable} concurrently; returns {name: StageResult} once all have finished."""
+        futures = dict((name, self._executor.submit(AcquisitionPipeline._timed, name, stage))
+                       for name, stage in stages.items())
+        return dict((name, future.result()) for name, future in futures.items())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
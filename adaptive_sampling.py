@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import collections
+import time
+
+# Imported by the first MotionDetector; numpy is slow to load on a Pi and
+# most configurations never need it.
+numpy = None
+
+QUANTITIES = ('temperature', 'humidity')
+
+
+class RateController:
+    """Adapts the sensor period to how much the readings are moving.
+
+    Each sweep is checked against a short window per sensor: if any sensor's
+    temperature changes faster than rate_threshold degrees C per minute, or
+    its variance over the window exceeds variance_threshold, the period is
+    halved down to min_period.  After stable_sweeps calm sweeps in a row it
+    is doubled again, up to max_period, so quiet nights are sampled less
+    often than the configured base period.
+    """
+
+    DEFAULT_WINDOW = 5
+    DEFAULT_RATE_THRESHOLD = 0.5
+    DEFAULT_VARIANCE_THRESHOLD = 0.25
+    DEFAULT_STABLE_SWEEPS = 6
+
+    def __init__(self, base_period, min_period, max_period, rate_threshold=DEFAULT_RATE_THRESHOLD,
+                 variance_threshold=DEFAULT_VARIANCE_THRESHOLD, window=DEFAULT_WINDOW,
+                 stable_sweeps=DEFAULT_STABLE_SWEEPS):
+        self._min_period = float(min_period)
+        self._max_period = float(max_period)
+        self._rate_threshold = float(rate_threshold)
+        self._variance_threshold = float(variance_threshold)
+        self._window = max(2, int(window))
+        self._stable_sweeps = int(stable_sweeps)
+        self._history = {}
+        self._calm = 0
+        self.period = min(self._max_period, max(self._min_period, float(base_period)))
+
+    @classmethod
+    def from_config(cls, config, base_period):
+        """None unless the config has an "adaptive_sampling" block."""
+        options = config.get('adaptive_sampling')
+        if options is None:
+            return None
+        return cls(base_period,
+                   min_period=options.get('min_period', base_period),
+                   max_period=options.get('max_period', base_period),
+                   rate_threshold=options.get('rate_threshold', cls.DEFAULT_RATE_THRESHOLD),
+                   variance_threshold=options.get('variance_threshold', cls.DEFAULT_VARIANCE_THRESHOLD),
+                   window=options.get('window', cls.DEFAULT_WINDOW),
+                   stable_sweeps=options.get('stable_sweeps', cls.DEFAULT_STABLE_SWEEPS))
+
+    def _active(self, samples):
+        if len(samples) < 2:
+            return False
+        count = float(len(samples))
+        mean_t = sum(t for t, _ in samples) / count
+        mean_v = sum(v for _, v in samples) / count
+        spread_t = sum((t - mean_t) ** 2 for t, _ in samples)
+        variance = sum((v - mean_v) ** 2 for _, v in samples) / (count - 1)
+        # Least squares slope, in degrees per minute.
+        slope = 60.0 * sum((t - mean_t) * (v - mean_v) for t, v in samples) / spread_t if spread_t > 0 else 0.0
+        return abs(slope) > self._rate_threshold or variance > self._variance_threshold
+
+    def update(self, timestamp, readings):
+        """Feed one sweep of (name, sensor_id, temperature, humidity, error); returns the new period if it changed."""
+        active = False
+        for name, sensor_id, temperature, humidity, error in readings:
+            if temperature is None:
+                continue
+            samples = self._history.get(name)
+            if samples is None:
+                samples = self._history[name] = collections.deque(maxlen=self._window)
+            samples.append((timestamp, temperature))
+            active = self._active(samples) or active
+        period = self.period
+        if active:
+            self._calm = 0
+            period = max(self._min_period, period / 2.0)
+        else:
+            self._calm += 1
+            if self._calm >= self._stable_sweeps:
+                self._calm = 0
+                period = min(self._max_period, period * 2.0)
+        if period == self.period:
+            return None
+        self.period = period
+        return period
+
+
+class ThresholdTrigger:
+    """Fires once when a sensor's reading crosses a limit.
+
+    It re-arms once the reading is back by hysteresis on the safe side, so
+    a value hovering at the limit does not fire on every sweep.
+    """
+
+    def __init__(self, sensor, quantity='temperature', above=None, below=None, hysteresis=0.5):
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown trigger quantity '%s'" % quantity)
+        if (above is None) == (below is None):
+            raise ValueError("A threshold trigger needs exactly one of 'above' or 'below'")
+        self._sensor = sensor
+        self._index = QUANTITIES.index(quantity)
+        self._quantity = quantity
+        self._above = above
+        self._below = below
+        self._hysteresis = float(hysteresis)
+        self._armed = True
+
+    def check(self, readings):
+        """Returns a description when it fires for this sweep, else None."""
+        for name, sensor_id, temperature, humidity, error in readings:
+            value = (temperature, humidity)[self._index]
+            if name != self._sensor or value is None:
+                continue
+            if self._above is not None:
+                crossed = value > self._above
+                safe = value < self._above - self._hysteresis
+                limit = "above %s" % self._above
+            else:
+                crossed = value < self._below
+                safe = value > self._below + self._hysteresis
+                limit = "below %s" % self._below
+            if crossed and self._armed:
+                self._armed = False
+                return "%s %s %0.1f is %s" % (name, self._quantity, value, limit)
+            if safe:
+                self._armed = True
+        return None
+
+
+class MotionDetector:
+    """Frame differencing on the camera's low resolution preview stream.
+
+    Each frame is reduced to every downsample'th pixel of its luminance
+    plane; the score is the mean absolute difference from the previous
+    frame, in grey levels.
+    """
+
+    DEFAULT_THRESHOLD = 12.0
+    DEFAULT_DOWNSAMPLE = 4
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, downsample=DEFAULT_DOWNSAMPLE, luma_rows=None):
+        global numpy
+        if numpy is None:
+            try:
+                import numpy
+            except ImportError:
+                raise RuntimeError("Motion triggers need numpy")
+        self._threshold = float(threshold)
+        self._downsample = max(1, int(downsample))
+        self._luma_rows = luma_rows
+        self._previous = None
+        self.score = 0.0
+
+    def check(self, frame):
+        """Returns a description when the frame differs enough from the previous one, else None."""
+        frame = numpy.asarray(frame)
+        if self._luma_rows is not None:
+            # YUV420 frames carry the chroma planes below the luminance.
+            frame = frame[:self._luma_rows]
+        if frame.ndim == 3:
+            frame = frame[:, :, 0]
+        current = frame[::self._downsample, ::self._downsample].astype(numpy.int16)
+        previous, self._previous = self._previous, current
+        if previous is None or previous.shape != current.shape:
+            return None
+        self.score = float(numpy.abs(current - previous).mean())
+        if self.score > self._threshold:
+            return "frame difference %0.1f" % self.score
+        return None
+
+
+class CaptureLimiter:
+    """Bounds triggered captures: at least min_interval seconds apart and at most max_per_hour."""
+
+    def __init__(self, min_interval=60.0, max_per_hour=12, monotonic=time.monotonic):
+        self._min_interval = float(min_interval)
+        self._max_per_hour = int(max_per_hour)
+        self._monotonic = monotonic
+        self._recent = collections.deque()
+        self.suppressed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(min_interval=config.get('min_seconds_between_triggered_images', 60.0),
+                   max_per_hour=config.get('max_triggered_images_per_hour', 12))
+
+    def allow(self):
+        now = self._monotonic()
+        while self._recent and now - self._recent[0] >= 3600.0:
+            self._recent.popleft()
+        if len(self._recent) >= self._max_per_hour or \
+                (self._recent and now - self._recent[-1] < self._min_interval):
+            self.suppressed += 1
+            return False
+        self._recent.append(now)
+        return True
+
+
+def triggers_from_config(config):
+    """Splits "capture_triggers" into ([ThresholdTrigger], motion options or None).
+
+    e.g. [{"sensor": "Internal", "quantity": "temperature", "above": 35},
+          {"type": "motion", "threshold": 12, "interval": 5}]
+    """
+    thresholds = []
+    motion = None
+    for trigger_config in config.get('capture_triggers', []):
+        options = dict(trigger_config)
+        trigger_type = options.pop('type', 'threshold')
+        if trigger_type == 'threshold':
+            thresholds.append(ThresholdTrigger(**options))
+        elif trigger_type == 'motion':
+            motion = options
+        else:
+            raise ValueError("Unknown capture trigger type '%s'" % trigger_type)
+    return thresholds, motion
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Benchmarks the recorder against the simulated hardware backend.
+#
+#   python benchmark.py [--ticks N] [--image-every N] [--instrument] [--json FILE]
+#
+# Drives SenseAndRecord.tick() back to back (no scheduler sleeps) and
+# reports per-stage latency, data points per second, database write cost
+# and memory, so regressions show up on any Linux box.  --instrument also
+# switches on the recorder's own instrumentation and reports its finer
+# grained stages (mux switch, SHT30 command/wait/read, each insert, ...).
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from database_writer import DatabaseWriter
+import instrumentation
+import migrations
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarise(values):
+    return {'count': len(values),
+            'mean': sum(values) / len(values) if values else 0.0,
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'max': max(values) if values else 0.0}
+
+
+def benchmark_recorder(work_dir, ticks, image_every, simulation, instrument=False):
+    from sense_and_record import SenseAndRecord
+
+    config = {'output_dir': os.path.join(work_dir, 'output'),
+              'image_subfolder': 'images',
+              'minutes_between_sensor_readings': 5,
+              'minutes_between_image_acquisitions': 30,
+              'hardware_backend': 'simulated',
+              'simulation': simulation}
+    if instrument:
+        config['instrumentation'] = {'interval': 3600}
+    config_path = os.path.join(work_dir, 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump(config, config_file)
+
+    stage_durations = {}
+    tick_durations = []
+    # The recorder narrates every tick on stdout; keep that out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.monotonic()
+        recorder = SenseAndRecord(config_path)
+        recorder.start()
+        startup = time.monotonic() - started
+        # Like run_schedule: the sensors go first, waiting out what is left of
+        # their power up, and the first image follows in its own data point
+        # once the camera has settled. Keep both out of the tick stats.
+        recorder.tick(set(['weather', 'system']))
+        first_data_point = time.monotonic() - started
+        recorder.tick(set(['image']))
+
+        tracemalloc.start()
+        run_started = time.monotonic()
+        for tick in range(ticks):
+            due = set(['weather', 'system'])
+            if image_every and tick % image_every == 0:
+                due.add('image')
+            tick_started = time.monotonic()
+            results = recorder.tick(due)
+            tick_durations.append(time.monotonic() - tick_started)
+            for name, result in results.items():
+                stage_durations.setdefault(name, []).append(result.duration)
+        run_time = time.monotonic() - run_started
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        histograms = instrumentation.snapshot(reset=False)
+
+        stop_started = time.monotonic()
+        recorder.stop()
+        shutdown = time.monotonic() - stop_started
+
+    return {'startup_seconds': startup,
+            'first_data_point_seconds': first_data_point,
+            'shutdown_seconds': shutdown,
+            'data_points_per_second': ticks / run_time if run_time > 0 else 0.0,
+            'tick_seconds': summarise(tick_durations),
+            'stage_seconds': dict((name, summarise(values)) for name, values in sorted(stage_durations.items())),
+            'peak_traced_bytes': peak_traced,
+            'instrumented_seconds': dict((name, dict((key, value) for key, value in histogram.as_dict().items()
+                                                     if key != 'buckets'))
+                                         for name, histogram in sorted(histograms.items()))}
+
+
+def benchmark_database(work_dir, data_points, commit_every):
+    db_path = os.path.join(work_dir, 'writer_%d.sqlite' % commit_every)
+    writer = DatabaseWriter(db_path, commit_every_data_points=commit_every, commit_every_seconds=3600)
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrations.migrate(writer.connection)
+    size_before = sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+    started = time.monotonic()
+    for index in range(data_points):
+        data_point_id = writer.begin_data_point(1700000000 + index * 300)
+        writer.insert_sensor_data(1, 21.5, 55.0, data_point_id)
+        writer.insert_sensor_data(2, 12.5, 80.0, data_point_id)
+        writer.insert_system_data(48.3, 0.77, -56, 264212084, 18433808, 83862320, data_point_id)
+        writer.end_data_point()
+    writer.flush()
+    elapsed = time.monotonic() - started
+    writer.connection.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    writer.close()
+    size_after = os.path.getsize(db_path)
+    return {'commit_every_data_points': commit_every,
+            'microseconds_per_data_point': 1e6 * elapsed / data_points,
+            'bytes_per_data_point': float(size_after - size_before) / data_points}
+
+
+def print_report(report):
+    recorder = report['recorder']
+    print("Recorder (simulated hardware, %d ticks)" % recorder['tick_seconds']['count'])
+    print("    startup:              %8.3f s" % recorder['startup_seconds'])
+    print("    first data point:     %8.3f s" % recorder['first_data_point_seconds'])
+    print("    shutdown:             %8.3f s" % recorder['shutdown_seconds'])
+    print("    throughput:           %8.1f data points/s" % recorder['data_points_per_second'])
+    print("    tick p50/p95/max:     %8.4f %8.4f %8.4f s" % (recorder['tick_seconds']['p50'], recorder['tick_seconds']['p95'], recorder['tick_seconds']['max']))
+    for name, stats in recorder['stage_seconds'].items():
+        print("    %-21s %8.4f %8.4f %8.4f s" % (name + " p50/p95/max:", stats['p50'], stats['p95'], stats['max']))
+    for name, stats in recorder['instrumented_seconds'].items():
+        print("    %-27s %8.4f %8.4f %8.4f s  (%d)" % (name + ":", stats['p50_seconds'], stats['p95_seconds'],
+                                                    stats['max_seconds'], stats['count']))
+    print("    peak traced memory:   %8.1f KiB" % (recorder['peak_traced_bytes'] / 1024.0))
+    print("    max RSS:              %8.1f KiB" % report['max_rss_kib'])
+    print("Database writer")
+    for result in report['database']:
+        print("    commit every %-4d     %8.1f us/data point  %8.1f bytes/data point" % (
+            result['commit_every_data_points'], result['microseconds_per_data_point'], result['bytes_per_data_point']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recorder against simulated hardware.")
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument('--image-every', type=int, default=10)
+    parser.add_argument('--db-data-points', type=int, default=2000)
+    parser.add_argument('--i2c-latency', type=float, default=0.0002)
+    parser.add_argument('--crc-fault-rate', type=float, default=0.0)
+    parser.add_argument('--nak-rate', type=float, default=0.0)
+    parser.add_argument('--instrument', action='store_true', help="report the recorder's instrumented stages")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    simulation = {'i2c_latency': args.i2c_latency, 'crc_fault_rate': args.crc_fault_rate,
+                  'nak_rate': args.nak_rate, 'seed': 1}
+    work_dir = tempfile.mkdtemp(prefix='greenhouse_bench_')
+    try:
+        report = {'recorder': benchmark_recorder(work_dir, args.ticks, args.image_every, simulation,
+                                                   instrument=args.instrument),
+                  'database': [benchmark_database(work_dir, args.db_data_points, commit_every)
+                               for commit_every in (1, 12)]}
+        report['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
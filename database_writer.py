@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import json
+import sqlite3
+import threading
+import time
+
+import instrumentation
+import rollups
+
+# data_points.synchronized is a bit field so each downstream consumer keeps
+# its own watermark without another table.
+SYNCHRONIZED_UPLOADED = 0x01
+SYNCHRONIZED_EXPORTED = 0x02
+# Set, with the upload bit cleared, when an image row is added or changed
+# after its data point was read for upload, so the point is sent again.
+SYNCHRONIZED_CHANGED = 0x04
+
+
+class DatabaseWriter:
+    """Long lived writer for greenhouse_data.sqlite.
+
+    Holds a single connection open in WAL mode so that readers (the Rails
+    dashboard) never block the recorder, and groups several data points into
+    one transaction to cut down on SD card writes.  Sensor readings are
+    also folded into the rollup tables in the same transaction.
+
+    Rows written from other threads between data points (images, their
+    replicated filenames and thumbnails, stage timings) do not wait for the
+    next data point: they are committed straight away, or at the end of the
+    data point they landed in.
+    """
+
+    DEFAULT_COMMIT_EVERY_DATA_POINTS = 1
+    DEFAULT_COMMIT_EVERY_SECONDS = 60.0
+    DEFAULT_CACHE_SIZE_KB = 2048
+    DEFAULT_SYNCHRONOUS = "NORMAL"
+
+    INSERT_DATA_POINT = "INSERT INTO data_points(timestamp) VALUES (?)"
+    INSERT_SENSOR_DATA = "INSERT INTO sensor_data(sensor_id, temperature, humidity, raw_temperature, raw_humidity, data_point_id) VALUES (?, ?, ?, ?, ?, ?)"
+    INSERT_SYSTEM_DATA = "INSERT INTO system_data(soc_temperature, wlan0_link_quality, wlan0_signal_level, storage_total_size, storage_used, storage_avail, data_point_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    INSERT_SENSOR_HEALTH = "INSERT INTO sensor_health(sensor_id, state, consecutive_failures, good_reads, bad_readings, bad_crcs, retries, power_cycles, quarantines, data_point_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    INSERT_IMAGE_DATA = "INSERT INTO image_data(filename, data_point_id) VALUES (?, ?)"
+    UPDATE_IMAGE_FILENAME = "UPDATE image_data SET filename = ? WHERE filename = ?"
+    UPDATE_IMAGE_INFO = "UPDATE image_data SET width = ?, height = ?, file_size = ?, thumbnail_filename = ? WHERE filename = ?"
+    MARK_CHANGED = "UPDATE data_points SET synchronized = (synchronized & ~%d) | %d WHERE id = ?" % (SYNCHRONIZED_UPLOADED, SYNCHRONIZED_CHANGED)
+    MARK_IMAGE_CHANGED = "UPDATE data_points SET synchronized = (synchronized & ~%d) | %d WHERE id IN (SELECT data_point_id FROM image_data WHERE filename = ?)" % (SYNCHRONIZED_UPLOADED, SYNCHRONIZED_CHANGED)
+    INSERT_TIMINGS = "INSERT INTO timings(timestamp, source, stage, count, total_seconds, max_seconds, p50_seconds, p95_seconds, p99_seconds, buckets) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, db_path, commit_every_data_points=DEFAULT_COMMIT_EVERY_DATA_POINTS,
+                 commit_every_seconds=DEFAULT_COMMIT_EVERY_SECONDS, cache_size_kb=DEFAULT_CACHE_SIZE_KB,
+                 synchronous=DEFAULT_SYNCHRONOUS):
+        self._db_path = db_path
+        self._commit_every_data_points = max(1, int(commit_every_data_points))
+        self._commit_every_seconds = float(commit_every_seconds)
+        self._lock = threading.RLock()
+        self._committed = threading.Condition(self._lock)
+        self._commits = 0
+        # isolation_level=None puts transaction control in our hands so several
+        # data points can share one BEGIN/COMMIT.
+        self._db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=64)
+        self._db.execute('PRAGMA journal_mode = WAL;')
+        self._db.execute('PRAGMA synchronous = %s;' % synchronous)
+        self._db.execute('PRAGMA cache_size = -%d;' % int(cache_size_kb))
+        self._db.execute('PRAGMA temp_store = MEMORY;')
+        self._cursor = self._db.cursor()
+        self._in_transaction = False
+        self._pending_data_points = 0
+        self._transaction_started = 0.0
+        self._data_point_open = False
+        self._commit_at_end_of_data_point = False
+        self._data_point_timestamps = {}
+
+    @classmethod
+    def from_config(cls, config, db_path):
+        return cls(db_path,
+                   commit_every_data_points=config.get('commit_every_data_points', cls.DEFAULT_COMMIT_EVERY_DATA_POINTS),
+                   commit_every_seconds=config.get('commit_every_seconds', cls.DEFAULT_COMMIT_EVERY_SECONDS),
+                   cache_size_kb=config.get('sqlite_cache_size_kb', cls.DEFAULT_CACHE_SIZE_KB),
+                   synchronous=config.get('sqlite_synchronous', cls.DEFAULT_SYNCHRONOUS))
+
+    @property
+    def commit_every_data_points(self):
+        return self._commit_every_data_points
+
+    @property
+    def commit_every_seconds(self):
+        return self._commit_every_seconds
+
+    @property
+    def connection(self):
+        return self._db
+
+    def _begin(self):
+        if not self._in_transaction:
+            self._cursor.execute('BEGIN')
+            self._in_transaction = True
+            self._transaction_started = time.monotonic()
+
+    def begin_data_point(self, timestamp):
+        with self._lock:
+            self._begin()
+            self._data_point_open = True
+            with instrumentation.timed('db.insert_data_point'):
+                self._cursor.execute(DatabaseWriter.INSERT_DATA_POINT, (timestamp,))
+            data_point_id = self._cursor.lastrowid
+            # Only the most recent few are needed to place readings in rollup buckets.
+            self._data_point_timestamps = {data_point_id: timestamp}
+            return data_point_id
+
+    def _data_point_timestamp(self, data_point_id):
+        if data_point_id not in self._data_point_timestamps:
+            row = self._cursor.execute("SELECT timestamp FROM data_points WHERE id = ?", (data_point_id,)).fetchone()
+            self._data_point_timestamps[data_point_id] = row[0]
+        return self._data_point_timestamps[data_point_id]
+
+    def insert_sensor_data(self, sensor_id, temperature, humidity, data_point_id, raw_temperature=None,
+                           raw_humidity=None):
+        with self._lock:
+            self._begin()
+            with instrumentation.timed('db.insert_sensor_data'):
+                self._cursor.execute(DatabaseWriter.INSERT_SENSOR_DATA, (sensor_id, temperature, humidity, raw_temperature,
+                                                                         raw_humidity, data_point_id))
+            # A reading with a rejected value stays out of the rollups.
+            if temperature is not None and humidity is not None:
+                with instrumentation.timed('db.update_rollups'):
+                    rollups.update(self._cursor, sensor_id, self._data_point_timestamp(data_point_id), temperature,
+                                   humidity)
+
+    def insert_system_data(self, soc_temperature, link_quality, link_signal, storage_total_size, storage_used,
+                           storage_avail, data_point_id):
+        with self._lock:
+            self._begin()
+            with instrumentation.timed('db.insert_system_data'):
+                self._cursor.execute(DatabaseWriter.INSERT_SYSTEM_DATA, (soc_temperature, link_quality, link_signal,
+                                                                         storage_total_size, storage_used, storage_avail,
+                                                                         data_point_id))
+
+    def insert_sensor_health(self, sensor_id, state, consecutive_failures, good_reads, bad_readings, bad_crcs,
+                             retries, power_cycles, quarantines, data_point_id):
+        with self._lock:
+            self._begin()
+            with instrumentation.timed('db.insert_sensor_health'):
+                self._cursor.execute(DatabaseWriter.INSERT_SENSOR_HEALTH, (sensor_id, state, consecutive_failures,
+                                                                           good_reads, bad_readings, bad_crcs, retries,
+                                                                           power_cycles, quarantines, data_point_id))
+
+    def insert_image_data(self, filename, data_point_id):
+        with self._lock:
+            self._begin()
+            with instrumentation.timed('db.insert_image_data'):
+                self._cursor.execute(DatabaseWriter.INSERT_IMAGE_DATA, (filename, data_point_id))
+            self._cursor.execute(DatabaseWriter.MARK_CHANGED, (data_point_id,))
+            self._commit_outside_data_point()
+
+    def update_image_filename(self, old_filename, new_filename):
+        with self._lock:
+            self._begin()
+            self._cursor.execute(DatabaseWriter.UPDATE_IMAGE_FILENAME, (new_filename, old_filename))
+            self._cursor.execute(DatabaseWriter.MARK_IMAGE_CHANGED, (new_filename,))
+            self._commit_outside_data_point()
+
+    def update_image_info(self, filename, width, height, file_size, thumbnail_filename):
+        with self._lock:
+            self._begin()
+            self._cursor.execute(DatabaseWriter.UPDATE_IMAGE_INFO, (width, height, file_size, thumbnail_filename,
+                                                                    filename))
+            self._cursor.execute(DatabaseWriter.MARK_IMAGE_CHANGED, (filename,))
+            self._commit_outside_data_point()
+
+    def image_data_point_id(self, filename):
+        """The data point an image row belongs to, or None if there is no row for filename."""
+        with self._lock:
+            row = self._cursor.execute("SELECT data_point_id FROM image_data WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row is not None else None
+
+    def insert_timings(self, timestamp, source, histograms):
+        with self._lock:
+            self._begin()
+            self._cursor.executemany(DatabaseWriter.INSERT_TIMINGS, [
+                (timestamp, source, stage, histogram.count, histogram.total, histogram.max, histogram.percentile(0.50),
+                 histogram.percentile(0.95), histogram.percentile(0.99), json.dumps(histogram.buckets))
+                for stage, histogram in sorted(histograms.items())])
+            self._commit_outside_data_point()
+
+    def _commit_outside_data_point(self):
+        # Nothing else would commit these until the next data point ends,
+        # which holds the write lock for a whole sensor period.
+        if self._data_point_open:
+            self._commit_at_end_of_data_point = True
+        else:
+            self.flush()
+
+    def end_data_point(self):
+        # Group commit: only hit the disk once enough points are pending or the
+        # oldest uncommitted point is getting stale.
+        with self._lock:
+            self._data_point_open = False
+            self._pending_data_points += 1
+            if self._pending_data_points >= self._commit_every_data_points or self._commit_at_end_of_data_point or \
+                    (time.monotonic() - self._transaction_started) >= self._commit_every_seconds:
+                self.flush()
+
+    def maybe_flush(self):
+        with self._lock:
+            if self._in_transaction and (time.monotonic() - self._transaction_started) >= self._commit_every_seconds:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._in_transaction:
+                with instrumentation.timed('db.commit'):
+                    self._cursor.execute('COMMIT')
+                self._in_transaction = False
+                self._commits += 1
+                self._committed.notify_all()
+            self._pending_data_points = 0
+            self._commit_at_end_of_data_point = False
+
+    def wait_for_commit(self, timeout=None):
+        """Block until everything written so far is committed; False on timeout."""
+        with self._committed:
+            if not self._in_transaction:
+                return True
+            target = self._commits + 1
+            return self._committed.wait_for(lambda: self._commits >= target, timeout)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self.flush()
+                self._db.close()
+                self._db = None
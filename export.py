@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import array
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from database_writer import SYNCHRONIZED_EXPORTED
+
+FORMAT_NPZ = 'npz'
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+PARTITION_DAY = 'day'
+PARTITION_MONTH = 'month'
+
+DEFAULT_CHUNK_SIZE = 10000
+
+SELECT_PENDING_PARTITION_STARTS = ('SELECT DISTINCT CAST(timestamp AS integer) FROM data_points '
+                                   'WHERE (synchronized & %d) = 0 ORDER BY timestamp' % SYNCHRONIZED_EXPORTED)
+
+SELECT_PARTITION = ('SELECT data_points.timestamp, sensor_data.sensor_id, sensor_data.temperature, sensor_data.humidity '
+                    'FROM data_points JOIN sensor_data ON sensor_data.data_point_id = data_points.id '
+                    'WHERE data_points.timestamp >= ? AND data_points.timestamp < ? AND data_points.id <= ? '
+                    'ORDER BY data_points.timestamp, sensor_data.sensor_id')
+
+# SELECT_PARTITION and MARK_EXPORTED both stop at the newest id when the
+# export started, so a point committed while a partition is being written
+# is left for the next run rather than flagged without being in the file.
+SELECT_LAST_ID = 'SELECT MAX(id) FROM data_points'
+
+MARK_EXPORTED = ('UPDATE data_points SET synchronized = synchronized | %d '
+                 'WHERE timestamp >= ? AND timestamp < ? AND id <= ? AND (synchronized & %d) = 0' % (SYNCHRONIZED_EXPORTED, SYNCHRONIZED_EXPORTED))
+
+
+class SensorHistoryExporter:
+    """Writes sensor history as columnar files, one per local day or month.
+
+    Only partitions holding data points not yet flagged as exported in
+    data_points.synchronized are (re)written, and each is rewritten whole so
+    a file is always complete for its period.  Rows are streamed from
+    SQLite in chunks into typed arrays, so memory is bounded by one
+    partition.  Files are written to a temporary name and renamed.
+    """
+
+    def __init__(self, db_path, export_dir, export_format=FORMAT_NPZ, partition=PARTITION_DAY,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if export_format == FORMAT_NPZ and numpy is None:
+            raise RuntimeError("npz export needs numpy")
+        if export_format in (FORMAT_PARQUET, FORMAT_ARROW) and pyarrow is None:
+            raise RuntimeError("%s export needs pyarrow" % export_format)
+        if export_format not in (FORMAT_NPZ, FORMAT_PARQUET, FORMAT_ARROW):
+            raise ValueError("Unknown export format '%s'" % export_format)
+        if partition not in (PARTITION_DAY, PARTITION_MONTH):
+            raise ValueError("Unknown export partition '%s'" % partition)
+        self._db = sqlite3.connect(db_path, isolation_level=None, timeout=120.0)
+        self._export_dir = export_dir
+        self._format = export_format
+        self._partition = partition
+        self._chunk_size = int(chunk_size)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls("%s/greenhouse_data.sqlite" % config['output_dir'],
+                   config.get('export_dir', os.path.join(config['output_dir'], 'export')),
+                   export_format=config.get('export_format', FORMAT_NPZ),
+                   partition=config.get('export_partition', PARTITION_DAY))
+
+    def _partition_bounds(self, timestamp):
+        start = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+        if self._partition == PARTITION_DAY:
+            end = (start + timedelta(days=1, hours=2)).replace(hour=0)
+            name = start.strftime('%Y-%m-%d')
+        else:
+            start = start.replace(day=1)
+            end = (start + timedelta(days=32)).replace(day=1)
+            name = start.strftime('%Y-%m')
+        return name, start.timestamp(), end.timestamp()
+
+    def pending_partitions(self):
+        partitions = []
+        cursor = self._db.execute(SELECT_PENDING_PARTITION_STARTS)
+        end = None
+        while True:
+            rows = cursor.fetchmany(self._chunk_size)
+            if not rows:
+                break
+            for (timestamp,) in rows:
+                if end is not None and timestamp < end:
+                    continue
+                name, start, end = self._partition_bounds(timestamp)
+                partitions.append((name, start, end))
+        return partitions
+
+    def _read_partition(self, start, end, last_id):
+        timestamps = array.array('q')
+        sensor_ids = array.array('l')
+        temperatures = array.array('d')
+        humidities = array.array('d')
+        cursor = self._db.execute(SELECT_PARTITION, (start, end, last_id))
+        while True:
+            rows = cursor.fetchmany(self._chunk_size)
+            if not rows:
+                break
+            for timestamp, sensor_id, temperature, humidity in rows:
+                timestamps.append(int(timestamp))
+                sensor_ids.append(sensor_id)
+                temperatures.append(temperature if temperature is not None else float('nan'))
+                humidities.append(humidity if humidity is not None else float('nan'))
+        return timestamps, sensor_ids, temperatures, humidities
+
+    def _write(self, filename, timestamps, sensor_ids, temperatures, humidities):
+        temporary_filename = filename + '.part'
+        if self._format == FORMAT_NPZ:
+            with open(temporary_filename, 'wb') as output:
+                numpy.savez_compressed(output,
+                                       timestamp=numpy.frombuffer(timestamps, dtype=numpy.int64).astype('datetime64[s]'),
+                                       sensor_id=numpy.array(sensor_ids, dtype=numpy.int32),
+                                       temperature=numpy.frombuffer(temperatures, dtype=numpy.float64),
+                                       humidity=numpy.frombuffer(humidities, dtype=numpy.float64))
+        else:
+            table = pyarrow.table({'timestamp': pyarrow.array(timestamps, type=pyarrow.timestamp('s', tz='UTC')),
+                                   'sensor_id': pyarrow.array(sensor_ids, type=pyarrow.int32()),
+                                   'temperature': pyarrow.array(temperatures, type=pyarrow.float64()),
+                                   'humidity': pyarrow.array(humidities, type=pyarrow.float64())})
+            if self._format == FORMAT_PARQUET:
+                pyarrow.parquet.write_table(table, temporary_filename, compression='zstd')
+            else:
+                with pyarrow.OSFile(temporary_filename, 'wb') as sink:
+                    with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+        os.rename(temporary_filename, filename)
+
+    def export(self):
+        """Export every partition with new data; returns the list of files written."""
+        directory = os.path.join(self._export_dir, 'sensor_data')
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        written = []
+        last_id = self._db.execute(SELECT_LAST_ID).fetchone()[0]
+        if last_id is None:
+            return written
+        for name, start, end in self.pending_partitions():
+            columns = self._read_partition(start, end, last_id)
+            filename = os.path.join(directory, '%s.%s' % (name, self._format))
+            self._write(filename, *columns)
+            self._db.execute(MARK_EXPORTED, (start, end, last_id))
+            written.append(filename)
+        return written
+
+    def close(self):
+        self._db.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: export.py <PATH_TO_JSON_CONFIG>")
+        sys.exit(127)
+
+    with open(sys.argv[1]) as json_config_file:
+        exporter = SensorHistoryExporter.from_config(json.load(json_config_file))
+    for filename in exporter.export():
+        print("Wrote %s" % filename)
+    exporter.close()
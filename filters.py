@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import array
+import bisect
+import math
+
+# Applied when neither the sensor nor "sensor_filters" says otherwise; the
+# same spike rejection the SHT30 driver used to do inline.
+DEFAULT_FILTERS = {
+    'temperature': [{'type': 'step', 'max_step': 10.0}],
+    'humidity': [{'type': 'range', 'minimum': 0.01, 'maximum': 100.0}],
+}
+
+QUANTITIES = ('temperature', 'humidity')
+
+# Scales the median absolute deviation to a standard deviation for normal data.
+MAD_SCALE = 1.4826
+
+
+class Window:
+    """The last N samples in insertion order (an array('d') ring) and in sorted order.
+
+    Appending evicts the oldest sample once full; both orders are kept up to
+    date with a bisect each, so the median is an index lookup.  Keeping the
+    sorted list costs O(window) per sample for the list shift (the windows
+    are a handful of samples), and the median absolute deviation is read off
+    it in O(window) without sorting.
+    """
+
+    def __init__(self, size):
+        self._size = max(1, int(size))
+        self._ring = array.array('d', [0.0]) * self._size
+        self._sorted = []
+        self._next = 0
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def append(self, value):
+        if len(self._sorted) == self._size:
+            del self._sorted[bisect.bisect_left(self._sorted, self._ring[self._next])]
+        self._ring[self._next] = value
+        self._next = (self._next + 1) % self._size
+        bisect.insort(self._sorted, value)
+
+    def median(self):
+        count = len(self._sorted)
+        middle = count // 2
+        if count % 2:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2.0
+
+    def median_absolute_deviation(self, median):
+        # Walking outwards from the median through the sorted samples yields
+        # the deviations smallest first; stop at the middle one.
+        values = self._sorted
+        count = len(values)
+        below = bisect.bisect_left(values, median) - 1
+        above = below + 1
+        previous = deviation = 0.0
+        for _ in range(count // 2 + 1):
+            previous = deviation
+            if above >= count or (below >= 0 and median - values[below] <= values[above] - median):
+                deviation = median - values[below]
+                below -= 1
+            else:
+                deviation = values[above] - median
+                above += 1
+        if count % 2:
+            return deviation
+        return (previous + deviation) / 2.0
+
+
+# Every filter takes one sample at a time: update(value) returns the value to
+# pass on, or None to reject the sample.  State is per filter instance, so
+# each sensor and quantity gets its own chain.
+
+class RangeFilter:
+    """Rejects samples outside [minimum, maximum]."""
+
+    def __init__(self, minimum=-math.inf, maximum=math.inf):
+        self._minimum = float(minimum)
+        self._maximum = float(maximum)
+
+    def update(self, value):
+        if value < self._minimum or value > self._maximum:
+            return None
+        return value
+
+
+class StepFilter:
+    """Rejects samples more than max_step away from the last accepted one.
+
+    After max_rejections rejections in a row the change is taken to be real
+    and the next sample is accepted as the new reference.
+    """
+
+    def __init__(self, max_step=10.0, max_rejections=3):
+        self._max_step = float(max_step)
+        self._max_rejections = int(max_rejections)
+        self._last = None
+        self._rejections = 0
+
+    def update(self, value):
+        if self._last is not None and abs(value - self._last) > self._max_step and \
+                self._rejections < self._max_rejections:
+            self._rejections += 1
+            return None
+        self._last = value
+        self._rejections = 0
+        return value
+
+
+class MedianFilter:
+    """Median of the last window samples."""
+
+    def __init__(self, window=5):
+        self._window = Window(window)
+
+    def update(self, value):
+        self._window.append(value)
+        return self._window.median()
+
+
+class HampelFilter:
+    """Replaces samples more than threshold scaled MADs from the window median with that median."""
+
+    def __init__(self, window=7, threshold=3.0):
+        self._window = Window(window)
+        self._threshold = float(threshold)
+
+    def update(self, value):
+        self._window.append(value)
+        if len(self._window) < 3:
+            return value
+        median = self._window.median()
+        sigma = MAD_SCALE * self._window.median_absolute_deviation(median)
+        if abs(value - median) > self._threshold * sigma:
+            return median
+        return value
+
+
+class EWMAFilter:
+    """Exponentially weighted moving average, alpha being the weight of the newest sample."""
+
+    def __init__(self, alpha=0.3):
+        self._alpha = float(alpha)
+        self._value = None
+
+    def update(self, value):
+        if self._value is None:
+            self._value = value
+        else:
+            self._value += self._alpha * (value - self._value)
+        return self._value
+
+
+class KalmanFilter:
+    """Scalar Kalman filter for a slowly drifting value (random walk model)."""
+
+    def __init__(self, process_variance=0.01, measurement_variance=0.25):
+        self._process_variance = float(process_variance)
+        self._measurement_variance = float(measurement_variance)
+        self._estimate = None
+        self._error = 0.0
+
+    def update(self, value):
+        if self._estimate is None:
+            self._estimate = value
+            self._error = self._measurement_variance
+            return value
+        error = self._error + self._process_variance
+        gain = error / (error + self._measurement_variance)
+        self._estimate += gain * (value - self._estimate)
+        self._error = (1.0 - gain) * error
+        return self._estimate
+
+
+FILTER_TYPES = {
+    'range': RangeFilter,
+    'step': StepFilter,
+    'median': MedianFilter,
+    'hampel': HampelFilter,
+    'ewma': EWMAFilter,
+    'kalman': KalmanFilter,
+}
+
+
+def build_filter(spec):
+    """A filter from its config, e.g. {"type": "hampel", "window": 7, "threshold": 3}."""
+    options = dict(spec)
+    filter_type = options.pop('type')
+    if filter_type not in FILTER_TYPES:
+        raise ValueError("Unknown filter type '%s'" % filter_type)
+    return FILTER_TYPES[filter_type](**options)
+
+
+class FilterChain:
+
+    def __init__(self, filters):
+        self._filters = list(filters)
+
+    @classmethod
+    def from_config(cls, specs):
+        return cls(build_filter(spec) for spec in specs)
+
+    def update(self, value):
+        for sensor_filter in self._filters:
+            if value is None:
+                break
+            value = sensor_filter.update(value)
+        return value
+
+
+class SignalProcessor:
+    """Per-sensor filter chains between the sensor sweep and the database.
+
+    Each sensor entry in the "sensors" config may carry its own "filters",
+    e.g. {"temperature": [{"type": "hampel"}, {"type": "ewma", "alpha": 0.2}]};
+    sensors without one use the top level "sensor_filters", then
+    DEFAULT_FILTERS.  Chains are built on first use and keep their state per
+    sensor name, so readings from different sensors never share a filter.
+    """
+
+    def __init__(self, filters=None, default_filters=DEFAULT_FILTERS):
+        self._specs = dict(filters or {})
+        self._default_filters = default_filters
+        self._chains = {}
+        self.rejected = {}
+
+    @classmethod
+    def from_config(cls, config):
+        filters = dict((sensor_config['name'], sensor_config['filters'])
+                       for sensor_config in config.get('sensors', []) if 'filters' in sensor_config)
+        return cls(filters, default_filters=config.get('sensor_filters', DEFAULT_FILTERS))
+
+    def _chain(self, name, quantity):
+        key = (name, quantity)
+        if key not in self._chains:
+            specs = self._specs.get(name, self._default_filters)
+            self._chains[key] = FilterChain.from_config(specs.get(quantity, []))
+        return self._chains[key]
+
+    def process(self, name, temperature, humidity):
+        """Returns the filtered (temperature, humidity); either is None when rejected."""
+        filtered = []
+        for quantity, value in zip(QUANTITIES, (temperature, humidity)):
+            value = self._chain(name, quantity).update(value)
+            if value is None:
+                self.rejected[name] = self.rejected.get(name, 0) + 1
+            filtered.append(value)
+        return tuple(filtered)
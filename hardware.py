@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Hardware backend selection.
+#
+# Drivers ask this module for smbus, RPi.GPIO and Picamera2 instead of
+# importing them directly, so the recorder can run against the simulated
+# devices in simulated_hardware.py on any Linux box.  The backend comes
+# from the "hardware_backend" config key ("pi" or "simulated"), falling
+# back to the GREENHOUSE_HARDWARE environment variable, then "pi".
+
+import os
+
+BACKEND_PI = 'pi'
+BACKEND_SIMULATED = 'simulated'
+
+_backend = os.environ.get('GREENHOUSE_HARDWARE', BACKEND_PI)
+_simulation_config = {}
+_gpio = None
+
+
+def configure(config):
+    global _backend, _simulation_config
+    _backend = config.get('hardware_backend', _backend)
+    _simulation_config = config.get('simulation', {})
+    if _backend not in (BACKEND_PI, BACKEND_SIMULATED):
+        raise ValueError("Unknown hardware backend '%s'" % _backend)
+
+
+def backend():
+    return _backend
+
+
+def simulated():
+    return _backend == BACKEND_SIMULATED
+
+
+def smbus_module():
+    """Something with an SMBus(bus_number) class."""
+    if simulated():
+        import simulated_hardware
+        return simulated_hardware.configured(_simulation_config)
+    import smbus
+    return smbus
+
+
+def gpio():
+    """RPi.GPIO (or a stand-in) already set to BCM numbering."""
+    global _gpio
+    if _gpio is None:
+        if simulated():
+            import simulated_hardware
+            simulated_hardware.configured(_simulation_config)
+            _gpio = simulated_hardware.GPIO
+        else:
+            import RPi.GPIO
+            _gpio = RPi.GPIO
+        _gpio.setmode(_gpio.BCM)
+    return _gpio
+
+
+def camera_class():
+    if simulated():
+        import simulated_hardware
+        simulated_hardware.configured(_simulation_config)
+        return simulated_hardware.SimulatedCamera
+    from picamera2.picamera2 import Picamera2
+    return Picamera2
+
+
+def system_stat_paths(directory):
+    """Keyword arguments for SystemStatsCollector pointing at real /proc and /sys files, or simulated ones under directory."""
+    if simulated():
+        import simulated_hardware
+        return simulated_hardware.configured(_simulation_config).system_stat_paths(directory)
+    return {}
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import threading
+
+import hardware
+import instrumentation
+import SHT30
+import TCA9545
+
+TCA9545_CHANNEL_MASKS = (TCA9545.TCA9545_CONFIG_BUS0, TCA9545.TCA9545_CONFIG_BUS1,
+                         TCA9545.TCA9545_CONFIG_BUS2, TCA9545.TCA9545_CONFIG_BUS3)
+
+# What the recorder has always read when no "sensors" list is configured.
+DEFAULT_SENSORS = [
+    {"name": "Internal", "channel": 0, "power_pin": 6},
+    {"name": "External", "channel": 1, "power_pin": 6},
+]
+
+
+class SensorChannel:
+    """One sensor and where it lives: which mux, which channel on it."""
+
+    def __init__(self, name, sensor_id, mux_address, channel, sensor):
+        self.name = name
+        self.sensor_id = sensor_id
+        self.mux_address = mux_address
+        self.channel = channel
+        self.sensor = sensor
+
+    @property
+    def channel_mask(self):
+        return TCA9545_CHANNEL_MASKS[self.channel]
+
+
+class I2CBusManager:
+    """Owns the I2C bus, the TCA9545 mux(es) and the sensors behind them.
+
+    All devices share one SMBus handle.  The selected channel of each mux is
+    cached so a sweep only writes the control register when the channel
+    actually changes; the cache is dropped after any bus error so the next
+    read re-selects and verifies.  Several muxes at different addresses can
+    hang off the root bus; selecting a channel on one disables the others so
+    identical sensor addresses never collide.
+    """
+
+    class ChannelSelectException(Exception):
+        def __init__(self, value):
+            self.value = value
+
+        def __str__(self):
+            return repr(self.value)
+
+    def __init__(self, twi=1, lock=None, bus=None):
+        self._bus = bus if bus is not None else hardware.smbus_module().SMBus(twi)
+        self.lock = lock if lock is not None else threading.Lock()
+        self._muxes = {}
+        self._selected = {}
+        self._channels = []
+
+    @classmethod
+    def from_config(cls, config, lock=None):
+        manager = cls(twi=int(config.get('i2c_bus', 1)), lock=lock)
+        for sensor_config in config.get('sensors', DEFAULT_SENSORS):
+            manager.add_sht30(name=sensor_config['name'],
+                              channel=int(sensor_config['channel']),
+                              sensor_id=sensor_config.get('sensor_id'),
+                              mux_address=int(sensor_config.get('mux_address', TCA9545.TCA9545_ADDRESS)),
+                              address=int(sensor_config.get('address', SHT30.SHT30_I2CADDR)),
+                              power_pin=int(sensor_config.get('power_pin', 0)),
+                              mode=sensor_config.get('mode', SHT30.SHT30_MODE_SINGLE_SHOT),
+                              repeatability=sensor_config.get('repeatability', SHT30.SHT30_REPEATABILITY_HIGH),
+                              mps=sensor_config.get('measurements_per_second', 1))
+        return manager
+
+    def _mux(self, mux_address):
+        if mux_address not in self._muxes:
+            self._muxes[mux_address] = TCA9545.TCA9545(addr=mux_address, bus_enable=0, bus=self._bus)
+            self._selected[mux_address] = 0
+        return self._muxes[mux_address]
+
+    def add_sensor(self, name, channel, sensor, sensor_id=None, mux_address=TCA9545.TCA9545_ADDRESS):
+        self._mux(mux_address)
+        # Historically sensor_data.sensor_id has been the channel's mux mask.
+        if sensor_id is None:
+            sensor_id = TCA9545_CHANNEL_MASKS[channel]
+        sensor_channel = SensorChannel(name, sensor_id, mux_address, channel, sensor)
+        self._channels.append(sensor_channel)
+        # Keep sweeps ordered by mux and channel to minimise switching.
+        self._channels.sort(key=lambda c: (c.mux_address, c.channel))
+        return sensor_channel
+
+    def add_sht30(self, name, channel, sensor_id=None, mux_address=TCA9545.TCA9545_ADDRESS,
+                  address=SHT30.SHT30_I2CADDR, power_pin=0, mode=SHT30.SHT30_MODE_SINGLE_SHOT,
+                  repeatability=SHT30.SHT30_REPEATABILITY_HIGH, mps=1):
+        sensor = SHT30.SHT30(address=address, i2c=self._bus, powerpin=power_pin, repeatability=repeatability)
+        sensor_channel = self.add_sensor(name, channel, sensor, sensor_id=sensor_id, mux_address=mux_address)
+        if mode == SHT30.SHT30_MODE_PERIODIC:
+            # The start command has to reach this sensor, not whichever one the mux points at.
+            with self.lock:
+                self.select(mux_address, sensor_channel.channel_mask)
+                sensor.start_periodic(mps, repeatability)
+        return sensor_channel
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    def status_info(self):
+        """{sensor name: read_status_info() counters} for every sensor that keeps them."""
+        return dict((c.name, c.sensor.read_status_info()) for c in self._channels if hasattr(c.sensor, 'read_status_info'))
+
+    def health_info(self):
+        """List of (name, sensor_id, read_health_info(), read_status_info()) for every sensor that tracks health."""
+        return [(c.name, c.sensor_id, c.sensor.read_health_info(), c.sensor.read_status_info())
+                for c in self._channels if hasattr(c.sensor, 'read_health_info')]
+
+    def select(self, mux_address, channel_mask):
+        """Route the bus to channel_mask on mux_address; a no-op if it is already selected."""
+        for other_address, other_mask in self._selected.items():
+            if other_address != mux_address and other_mask != 0:
+                self._muxes[other_address].write_control_register(0)
+                self._selected[other_address] = 0
+        if self._selected[mux_address] == channel_mask:
+            return
+        mux = self._muxes[mux_address]
+        with instrumentation.timed('i2c.mux_select'):
+            mux.write_control_register(channel_mask)
+            selected = mux.read_control_register() & 0x0f
+        if selected != channel_mask:
+            self._selected[mux_address] = None
+            raise I2CBusManager.ChannelSelectException(channel_mask)
+        self._selected[mux_address] = channel_mask
+
+    def invalidate(self):
+        for mux_address in self._selected:
+            self._selected[mux_address] = None
+
+    def read_channel(self, sensor_channel):
+        """Returns (temperature C, humidity %) from one sensor; the caller must hold lock."""
+        try:
+            self.select(sensor_channel.mux_address, sensor_channel.channel_mask)
+            humidity, temp_c, crc_ch, crc_ct = sensor_channel.sensor.read_humidity_temperature_crc()
+        except SHT30.SHT30UnavailableException:
+            # Skipped without any bus traffic, the mux cache is still good.
+            raise
+        except Exception:
+            self.invalidate()
+            raise
+        return (temp_c, humidity)
+
+    def read_all(self):
+        """Sweep every registered sensor under one hold of the bus lock.
+
+        Returns a list of (name, sensor_id, temperature, humidity, error)
+        where error is None for a good read, otherwise a message and the
+        values are None.  Quarantined or power cycling sensors are skipped
+        without holding up the rest of the sweep.
+        """
+        readings = []
+        with self.lock:
+            for sensor_channel in self._channels:
+                try:
+                    temp_c, humidity = self.read_channel(sensor_channel)
+                    readings.append((sensor_channel.name, sensor_channel.sensor_id, temp_c, humidity, None))
+                except SHT30.SHT30UnavailableException as e:
+                    readings.append((sensor_channel.name, sensor_channel.sensor_id, None, None,
+                                     "WARNING: %s Weather Sensor skipped - %s" % (sensor_channel.name, e)))
+                except I2CBusManager.ChannelSelectException as e:
+                    readings.append((sensor_channel.name, sensor_channel.sensor_id, None, None,
+                                     "CRITICAL: %s Weather Sensor Failed to Read." % sensor_channel.name))
+                except Exception as e:
+                    readings.append((sensor_channel.name, sensor_channel.sensor_id, None, None,
+                                     "CRITICAL: I2C Bus Read Error - %s" % e))
+        return readings
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import concurrent.futures
+import io
+import json
+import os
+import threading
+
+# Imported by the first ImagePipeline, so recorders without one never load Pillow.
+Image = None
+
+MANIFEST_NAME = 'manifest.jsonl'
+CONTACT_SHEET_NAME = 'contact_sheet.jpg'
+TIMELAPSE_NAME = 'timelapse.mjpeg'
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _replace_file(filename, data):
+    # Derived files can always be rebuilt, so no fsync; the rename just keeps
+    # a gallery from serving a half-written one.
+    temporary_filename = filename + '.part'
+    with open(temporary_filename, 'wb') as output_file:
+        output_file.write(data)
+    os.rename(temporary_filename, filename)
+
+
+def remove_thumbnails(thumbnail_filenames):
+    """Delete thumbnails and their manifest lines, once retention has dropped the full images.
+
+    Only meant for past days: the manifest's line count is where a restarted
+    pipeline resumes the current day's contact sheet.  Contact sheets and
+    timelapses keep the frames; they are a record of the day.
+    """
+    by_directory = {}
+    for thumbnail_filename in thumbnail_filenames:
+        try:
+            os.remove(thumbnail_filename)
+        except OSError:
+            pass
+        by_directory.setdefault(os.path.dirname(thumbnail_filename), set()).add(os.path.basename(thumbnail_filename))
+    for directory, names in by_directory.items():
+        manifest_filename = os.path.join(directory, MANIFEST_NAME)
+        try:
+            with open(manifest_filename) as manifest_file:
+                lines = manifest_file.readlines()
+        except IOError:
+            continue
+        kept = [line for line in lines if json.loads(line).get('thumbnail') not in names]
+        if len(kept) != len(lines):
+            _replace_file(manifest_filename, ''.join(kept).encode('utf8'))
+
+
+class ImagePipeline:
+    """Derives thumbnails and per-day galleries from each image once it is written.
+
+    Every full resolution JPEG is decoded exactly once, on a pool of worker
+    threads sized to the available cores (Pillow drops the GIL while it
+    decodes and resamples).  Draft mode lets the JPEG decoder do most of the
+    downscaling, so only about one timelapse frame's worth of pixels is ever
+    held.  From that decode come, under output_root/YYYY/MM/DD:
+
+      img_<ts>_<HH_MM_SS>.jpg  the thumbnail
+      manifest.jsonl           a line per image: source, thumbnail, size and dimensions
+      contact_sheet.jpg        the day's thumbnails in a grid
+      timelapse.mjpeg          the day's timelapse frames as concatenated JPEGs
+
+    A day's outputs only ever grow by the new image, so earlier frames are
+    never decoded again; the current day's contact sheet stays in memory.
+    Images are decoded in parallel but appended in the order they were
+    submitted, which is the order they were captured, by whichever worker
+    finds the next one in line finished.
+    on_processed(filename, info) is called from the worker when an image is
+    done, with info None if it could not be processed, so the caller can
+    record it before letting the image be moved off local storage.
+    An image already queued is not queued again, and is_done() tells a
+    caller finding images in the spool whether one still needs submitting.
+    """
+
+    DEFAULT_THUMBNAIL_SIZE = (320, 240)
+    DEFAULT_TIMELAPSE_WIDTH = 1280
+    DEFAULT_CONTACT_SHEET_COLUMNS = 8
+    DEFAULT_JPEG_QUALITY = 85
+
+    def __init__(self, images_root, output_root, on_processed, workers=None, thumbnail_size=DEFAULT_THUMBNAIL_SIZE,
+                 timelapse_width=DEFAULT_TIMELAPSE_WIDTH, contact_sheet_columns=DEFAULT_CONTACT_SHEET_COLUMNS,
+                 jpeg_quality=DEFAULT_JPEG_QUALITY):
+        global Image
+        if Image is None:
+            try:
+                from PIL import Image
+            except ImportError:
+                raise RuntimeError("The image pipeline needs Pillow")
+        self._images_root = images_root
+        self._output_root = output_root
+        self._on_processed = on_processed
+        self._thumbnail_size = tuple(int(value) for value in thumbnail_size)
+        self._timelapse_width = int(timelapse_width)
+        self._columns = max(1, int(contact_sheet_columns))
+        self._jpeg_quality = int(jpeg_quality)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(workers or available_cores()),
+                                                               thread_name_prefix='image-pipeline')
+        # Guards the pending and failed sets and the hand over of finished
+        # images to the one worker appending them (see _finish).
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failed_files = set()
+        self._submitted = 0
+        self._next_to_append = 0
+        self._rendered = {}
+        self._appending = False
+        self._sheet_directory = None
+        self._sheet = None
+        self._sheet_cells = 0
+        self.processed = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, config, output_dir, on_processed):
+        """None unless the config has an "image_pipeline" block."""
+        options = config.get('image_pipeline')
+        if options is None:
+            return None
+        return cls(os.path.join(output_dir, config['image_subfolder']),
+                   os.path.join(output_dir, options.get('subfolder', 'thumbnails')), on_processed,
+                   workers=options.get('workers'),
+                   thumbnail_size=options.get('thumbnail_size', cls.DEFAULT_THUMBNAIL_SIZE),
+                   timelapse_width=options.get('timelapse_width', cls.DEFAULT_TIMELAPSE_WIDTH),
+                   contact_sheet_columns=options.get('contact_sheet_columns', cls.DEFAULT_CONTACT_SHEET_COLUMNS),
+                   jpeg_quality=options.get('jpeg_quality', cls.DEFAULT_JPEG_QUALITY))
+
+    def submit(self, filename, data_point_id):
+        with self._lock:
+            if filename in self._pending:
+                return
+            self._executor.submit(self._process, self._submitted, filename, data_point_id)
+            self._pending.add(filename)
+            self._submitted += 1
+
+    def thumbnail_filename(self, filename):
+        return os.path.join(self._day_directory(filename), os.path.basename(filename))
+
+    def is_done(self, filename):
+        """True once filename has a thumbnail, or failed to process in this run."""
+        with self._lock:
+            if filename in self._pending:
+                return False
+            if filename in self._failed_files:
+                return True
+        return os.path.exists(self.thumbnail_filename(filename))
+
+    def _day_directory(self, filename):
+        relative = os.path.relpath(os.path.dirname(filename), self._images_root)
+        if relative.startswith(os.pardir):
+            relative = os.curdir
+        return os.path.normpath(os.path.join(self._output_root, relative))
+
+    def _encode(self, image):
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=self._jpeg_quality)
+        return buffer.getvalue()
+
+    def _render(self, filename):
+        with Image.open(filename) as image:
+            width, height = image.size
+            frame_size = (self._timelapse_width, max(1, self._timelapse_width * height // width))
+            # Decode at the smallest DCT scale (down to 1/8) still covering a frame.
+            image.draft('RGB', frame_size)
+            frame = image.convert('RGB')
+        if frame.width > frame_size[0]:
+            frame = frame.resize(frame_size, Image.BILINEAR)
+        thumbnail = frame.copy()
+        thumbnail.thumbnail(self._thumbnail_size, Image.BILINEAR)
+        return width, height, frame, thumbnail
+
+    def _process(self, sequence, filename, data_point_id):
+        rendered = None
+        try:
+            file_size = os.path.getsize(filename)
+            width, height, frame, thumbnail = self._render(filename)
+            info = {'source': os.path.relpath(filename, self._images_root),
+                    'thumbnail': os.path.basename(self.thumbnail_filename(filename)),
+                    'data_point_id': data_point_id,
+                    'bytes': file_size,
+                    'width': width,
+                    'height': height,
+                    'thumbnail_width': thumbnail.width,
+                    'thumbnail_height': thumbnail.height}
+            rendered = (info, thumbnail, self._encode(frame), self._encode(thumbnail))
+        except Exception as e:
+            print("WARNING: Unable to process image %s - %s" % (filename, e))
+        self._finish(sequence, filename, rendered)
+
+    def _finish(self, sequence, filename, rendered):
+        # Whoever finds the next image in line finished appends it, and any
+        # that were waiting behind it; the others just leave theirs.
+        with self._lock:
+            self._rendered[sequence] = (filename, rendered)
+            if self._appending:
+                return
+            self._appending = True
+        while True:
+            with self._lock:
+                if self._next_to_append not in self._rendered:
+                    self._appending = False
+                    return
+                filename, rendered = self._rendered.pop(self._next_to_append)
+                self._next_to_append += 1
+            self._append(filename, rendered)
+
+    def _append(self, filename, rendered):
+        info = None
+        if rendered is not None:
+            try:
+                info, thumbnail, frame_data, thumbnail_data = rendered
+                thumbnail_filename = self.thumbnail_filename(filename)
+                directory = os.path.dirname(thumbnail_filename)
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+                self._add_to_contact_sheet(directory, thumbnail)
+                with open(os.path.join(directory, TIMELAPSE_NAME), 'ab') as timelapse_file:
+                    timelapse_file.write(frame_data)
+                with open(os.path.join(directory, MANIFEST_NAME), 'a') as manifest_file:
+                    manifest_file.write(json.dumps(info, sort_keys=True) + '\n')
+                # Written last: its existence is what marks the image as done.
+                _replace_file(thumbnail_filename, thumbnail_data)
+                info['thumbnail'] = thumbnail_filename
+            except Exception as e:
+                info = None
+                print("WARNING: Unable to process image %s - %s" % (filename, e))
+        with self._lock:
+            if info is None:
+                self._failed_files.add(filename)
+            self._pending.discard(filename)
+        if info is None:
+            self.failed += 1
+        else:
+            self.processed += 1
+        try:
+            self._on_processed(filename, info)
+        except Exception as e:
+            print("CRITICAL: Unable to record processed image %s - %s" % (filename, e))
+
+    def _load_contact_sheet(self, directory):
+        # After a restart, pick the day up from the files rather than from
+        # every image: the manifest gives the cell count, the sheet its pixels.
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+                cells = sum(1 for _ in manifest_file)
+        except IOError:
+            return None, 0
+        try:
+            with Image.open(os.path.join(directory, CONTACT_SHEET_NAME)) as sheet:
+                return sheet.convert('RGB'), cells
+        except IOError:
+            return None, cells
+
+    def _add_to_contact_sheet(self, directory, thumbnail):
+        if directory != self._sheet_directory:
+            self._sheet, self._sheet_cells = self._load_contact_sheet(directory)
+            self._sheet_directory = directory
+        cell_width, cell_height = self._thumbnail_size
+        row, column = divmod(self._sheet_cells, self._columns)
+        if self._sheet is None or self._sheet.height < (row + 1) * cell_height:
+            grown = Image.new('RGB', (self._columns * cell_width, (row + 1) * cell_height))
+            if self._sheet is not None:
+                grown.paste(self._sheet, (0, 0))
+            self._sheet = grown
+        self._sheet.paste(thumbnail, (column * cell_width + (cell_width - thumbnail.width) // 2,
+                                      row * cell_height + (cell_height - thumbnail.height) // 2))
+        self._sheet_cells += 1
+        _replace_file(os.path.join(directory, CONTACT_SHEET_NAME), self._encode(self._sheet))
+
+    def close(self):
+        """Finish every submitted image, then stop the workers."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+COPY_CHUNK_SIZE = 256 * 1024
+# A rescan leaves very new files alone; those are enqueued by whoever wrote
+# them once their database row exists.
+RESCAN_MIN_AGE = 60.0
+
+
+class RateLimiter:
+    """Token bucket shared by all replication workers (bytes per second, 0 = unlimited)."""
+
+    def __init__(self, bytes_per_second):
+        self._rate = float(bytes_per_second)
+        self._allowance = self._rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self._rate, self._allowance + (now - self._last) * self._rate)
+            self._last = now
+            self._allowance -= count
+            wait = -self._allowance / self._rate if self._allowance < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ImageReplicator:
+    """Moves spooled images from local storage to the external share in the background.
+
+    Images are always written under spool_root/subfolder first.  Worker
+    threads copy each one to the same relative path under share_root (the
+    mount holding volume_info.json) via a .part file,
+    verify the copy by checksum, rename it into place, call
+    on_replicated(local_filename, share_filename) so the database can be
+    repointed, and then delete the local copy.  on_replicated must not
+    return until the new filename is committed; if it raises, the local
+    copy stays and a later rescan tries again.  While the share is not
+    mounted files simply stay queued; anything left in the spool from an
+    earlier run (or an outage) is picked up by a rescan, so replication is
+    resumable and self-healing.  A rescan hands each file it finds to
+    on_found(local_filename) if given, which decides whether to enqueue it.
+    """
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_RETRY_INTERVAL = 60.0
+
+    def __init__(self, spool_root, share_root, share_validation_string, on_replicated, subfolder='',
+                 workers=DEFAULT_WORKERS, bytes_per_second=0, retry_interval=DEFAULT_RETRY_INTERVAL, on_found=None):
+        self._spool_root = spool_root
+        self._share_root = share_root
+        self._spool_images = os.path.join(spool_root, subfolder)
+        self._share_validation_string = share_validation_string
+        self._on_replicated = on_replicated
+        self._on_found = on_found if on_found is not None else self.enqueue
+        self._rate_limiter = RateLimiter(bytes_per_second)
+        self._retry_interval = float(retry_interval)
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.replicated = 0
+        self.failed = 0
+        self._threads = [threading.Thread(target=self._run, name='replicator-%d' % i, daemon=True)
+                         for i in range(max(1, int(workers)))]
+        self._rescan_thread = threading.Thread(target=self._rescan_periodically, name='replicator-scan', daemon=True)
+
+    @classmethod
+    def from_config(cls, config, spool_root, on_replicated, on_found=None):
+        return cls(spool_root, config['external_share'], config.get('share_validation_string'), on_replicated,
+                   subfolder=config['image_subfolder'],
+                   workers=config.get('replication_workers', cls.DEFAULT_WORKERS),
+                   bytes_per_second=config.get('replication_bytes_per_second', 0),
+                   retry_interval=config.get('replication_retry_interval', cls.DEFAULT_RETRY_INTERVAL),
+                   on_found=on_found)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        self._rescan_thread.start()
+
+    def validate_mount(self):
+        try:
+            with open(os.path.join(self._share_root, "volume_info.json")) as file_contents:
+                share_info = json.load(file_contents)
+                return share_info['storage_name'] == self._share_validation_string
+        except Exception:
+            return False
+
+    def share_filename(self, local_filename):
+        return os.path.join(self._share_root, os.path.relpath(local_filename, self._spool_root))
+
+    def enqueue(self, local_filename):
+        with self._queued_lock:
+            if local_filename in self._queued:
+                return
+            self._queued.add(local_filename)
+        self._queue.put(local_filename)
+
+    def rescan(self):
+        cutoff = time.time() - RESCAN_MIN_AGE
+        for directory, _, filenames in os.walk(self._spool_images):
+            for filename in sorted(filenames):
+                local_filename = os.path.join(directory, filename)
+                if filename.endswith('.jpg') and os.path.getmtime(local_filename) < cutoff:
+                    self._on_found(local_filename)
+
+    def _rescan_periodically(self):
+        while not self._stopping.is_set():
+            try:
+                self.rescan()
+            except OSError as e:
+                print("WARNING: Unable to scan image spool - ", e)
+            self._stopping.wait(self._retry_interval)
+
+    def _copy(self, local_filename, share_filename):
+        try:
+            os.makedirs(os.path.dirname(share_filename))
+        except OSError:
+            pass
+        source_digest = hashlib.sha256()
+        temporary_filename = share_filename + '.part'
+        with open(local_filename, 'rb') as source, open(temporary_filename, 'wb') as destination:
+            while True:
+                chunk = source.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._rate_limiter.consume(len(chunk))
+                source_digest.update(chunk)
+                destination.write(chunk)
+            destination.flush()
+            os.fsync(destination.fileno())
+        # Read back what actually landed on the share before trusting it.
+        copy_digest = hashlib.sha256()
+        with open(temporary_filename, 'rb') as copy:
+            for chunk in iter(lambda: copy.read(COPY_CHUNK_SIZE), b''):
+                copy_digest.update(chunk)
+        if copy_digest.digest() != source_digest.digest():
+            os.remove(temporary_filename)
+            raise IOError("checksum mismatch copying %s" % local_filename)
+        os.rename(temporary_filename, share_filename)
+
+    def _replicate(self, local_filename):
+        share_filename = self.share_filename(local_filename)
+        self._copy(local_filename, share_filename)
+        self._on_replicated(local_filename, share_filename)
+        os.remove(local_filename)
+
+    def _run(self):
+        while True:
+            local_filename = self._queue.get()
+            if local_filename is None:
+                break
+            try:
+                if self._stopping.is_set() or not os.path.exists(local_filename):
+                    continue
+                if not self.validate_mount():
+                    # Leave it in the spool; the next rescan retries once the share is back.
+                    continue
+                self._replicate(local_filename)
+                self.replicated += 1
+            except Exception as e:
+                self.failed += 1
+                print("WARNING: Unable to replicate %s - %s" % (local_filename, e))
+            finally:
+                with self._queued_lock:
+                    self._queued.discard(local_filename)
+
+    def close(self):
+        self._stopping.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import io
+import os
+import queue
+import threading
+
+import instrumentation
+
+
+class ImageWriter:
+    """Encodes captured frames to JPEG and writes them to disk off the capture path.
+
+    Frames are handed over as in-memory PIL images through a bounded queue so
+    at most queue_size full-resolution frames are held at once.  When the
+    queue is full the backpressure policy decides what happens to a new
+    frame: 'block' waits for room, 'drop' discards it, and 'downscale'
+    halves its resolution and then waits.  Once a file is fsync'ed and
+    renamed into place, on_written(filename, data_point_id) is called from
+    the writer thread.
+    """
+
+    BLOCK = 'block'
+    DROP = 'drop'
+    DOWNSCALE = 'downscale'
+
+    DEFAULT_QUEUE_SIZE = 2
+    DEFAULT_JPEG_QUALITY = 90
+
+    _STOP = object()
+
+    def __init__(self, on_written, queue_size=DEFAULT_QUEUE_SIZE, jpeg_quality=DEFAULT_JPEG_QUALITY,
+                 backpressure=BLOCK):
+        if backpressure not in (ImageWriter.BLOCK, ImageWriter.DROP, ImageWriter.DOWNSCALE):
+            raise ValueError("Unknown image backpressure policy '%s'" % backpressure)
+        self._on_written = on_written
+        self._jpeg_quality = int(jpeg_quality)
+        self._backpressure = backpressure
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.written = 0
+        self.dropped = 0
+        self.downscaled = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name='image-writer', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config, on_written):
+        return cls(on_written,
+                   queue_size=config.get('image_queue_size', cls.DEFAULT_QUEUE_SIZE),
+                   jpeg_quality=config.get('image_jpeg_quality', cls.DEFAULT_JPEG_QUALITY),
+                   backpressure=config.get('image_backpressure', cls.BLOCK))
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def submit(self, image, filename, data_point_id):
+        """Queue a frame for writing; returns False if it was dropped."""
+        item = (image, filename, data_point_id)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self._backpressure == ImageWriter.DROP:
+            self.dropped += 1
+            return False
+        if self._backpressure == ImageWriter.DOWNSCALE:
+            image = image.reduce(2)
+            item = (image, filename, data_point_id)
+            self.downscaled += 1
+        self._queue.put(item)
+        return True
+
+    def _write(self, image, filename):
+        buffer = io.BytesIO()
+        with instrumentation.timed('image.encode'):
+            image.save(buffer, format='JPEG', quality=self._jpeg_quality)
+        directory = os.path.dirname(filename)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        # Write to a temporary name and rename so a reader never sees a
+        # half-written JPEG, and fsync so the row we insert points at data
+        # that survives a power cut.
+        temporary_filename = filename + '.part'
+        with instrumentation.timed('image.write'):
+            with open(temporary_filename, 'wb') as image_file:
+                image_file.write(buffer.getbuffer())
+                image_file.flush()
+                os.fsync(image_file.fileno())
+            os.rename(temporary_filename, filename)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is ImageWriter._STOP:
+                self._queue.task_done()
+                break
+            image, filename, data_point_id = item
+            try:
+                self._write(image, filename)
+                self.written += 1
+                self._on_written(filename, data_point_id)
+            except Exception as e:
+                self.failed += 1
+                print("CRITICAL: Unable to write image %s - %s" % (filename, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued frame has been written."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(ImageWriter._STOP)
+        self._thread.join()
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Per-stage timing for the recorder's hot paths.
+#
+#   with instrumentation.timed('sht30.read'):
+#       ...
+#
+# Until enable() is called timed() hands back one shared do-nothing context
+# manager, so instrumented code costs a function call when it is switched
+# off.  Once enabled, every duration lands in a per-stage histogram; the
+# recorder takes a snapshot() every so often and stores it (see
+# SenseAndRecord.report_timings).
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# Histogram bucket upper bounds, in seconds: 10us doubling up to ~84s, then overflow.
+BUCKET_BOUNDS = tuple(0.00001 * (2 ** index) for index in range(24))
+
+
+class Histogram:
+    """Counts of durations per exponential bucket, plus their count, sum and max."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = 0
+        while index < len(BUCKET_BOUNDS) and seconds > BUCKET_BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding that fraction of the samples (max for the overflow)."""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted and count:
+                return min(BUCKET_BOUNDS[index], self.max) if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_seconds': self.total,
+                'max_seconds': self.max,
+                'p50_seconds': self.percentile(0.50),
+                'p95_seconds': self.percentile(0.95),
+                'p99_seconds': self.percentile(0.99),
+                'buckets': self.buckets}
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _Timer:
+    __slots__ = ('_timings', '_name', '_started')
+
+    def __init__(self, timings, name):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timings.record(self._name, time.perf_counter() - self._started)
+        return False
+
+
+class Timings:
+    """Histograms of stage durations, safe to record into from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def timed(self, name):
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self, reset=True):
+        """{stage: Histogram} recorded since the last reset."""
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+            else:
+                histograms = dict(histograms)
+        return histograms
+
+
+_NULL_TIMER = _NullTimer()
+_timings = None
+
+
+def enable():
+    global _timings
+    if _timings is None:
+        _timings = Timings()
+    return _timings
+
+
+def enabled():
+    return _timings is not None
+
+
+def timed(name):
+    if _timings is None:
+        return _NULL_TIMER
+    return _timings.timed(name)
+
+
+def record(name, seconds):
+    """For durations the caller has measured anyway."""
+    if _timings is not None:
+        _timings.record(name, seconds)
+
+
+def snapshot(reset=True):
+    if _timings is None:
+        return {}
+    return _timings.snapshot(reset)
+
+
+def write_json_lines(filename, timestamp, source, histograms):
+    # One line per stage; O_APPEND keeps lines from several processes whole.
+    lines = []
+    for stage, histogram in sorted(histograms.items()):
+        entry = histogram.as_dict()
+        entry.update({'timestamp': timestamp, 'source': source, 'stage': stage})
+        lines.append(json.dumps(entry, sort_keys=True) + '\n')
+    with open(filename, 'a') as timings_file:
+        timings_file.write(''.join(lines))
+
+
+class SamplingProfiler:
+    """Samples every thread's stack on a timer and keeps folded stack counts.
+
+    Runs on its own thread using sys._current_frames(), so it sees the
+    acquisition and writer threads as well as the main loop, and costs
+    nothing in the code being profiled.  dump() writes the counts in the
+    folded format ("thread;outer (file:line);inner (file:line) count") that
+    flamegraph.pl and speedscope read.
+    """
+
+    DEFAULT_INTERVAL = 0.01
+    DEFAULT_DUMP_INTERVAL = 60.0
+
+    def __init__(self, filename, interval=DEFAULT_INTERVAL, dump_interval=DEFAULT_DUMP_INTERVAL):
+        self._filename = filename
+        self._interval = float(interval)
+        self._dump_interval = float(dump_interval)
+        self._counts = collections.Counter()
+        self._labels = {}
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.samples = 0
+
+    def start(self):
+        self._thread.start()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                         code.co_firstlineno)
+        return label
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-%d' % ident))
+            self._counts[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        next_dump = time.monotonic() + self._dump_interval
+        while not self._stopping.wait(self._interval):
+            self._sample()
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump = time.monotonic() + self._dump_interval
+
+    def dump(self):
+        temporary_filename = self._filename + '.part'
+        with open(temporary_filename, 'w') as profile_file:
+            for stack, count in self._counts.most_common():
+                profile_file.write('%s %d\n' % (stack, count))
+        os.rename(temporary_filename, self._filename)
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.dump()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import array
+import json
+import math
+import threading
+import time
+
+
+class RingBuffer:
+    """Fixed-size ring of (timestamp, value) pairs kept in two array('d') columns."""
+
+    def __init__(self, size):
+        self._size = int(size)
+        self._timestamps = array.array('d', [0.0]) * self._size
+        self._values = array.array('d', [0.0]) * self._size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        self._timestamps[self._next] = timestamp
+        self._values[self._next] = value if value is not None else math.nan
+        self._next = (self._next + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def latest(self):
+        if self._count == 0:
+            return None
+        index = (self._next - 1) % self._size
+        return (self._timestamps[index], self._values[index])
+
+    def since(self, timestamp):
+        """Oldest first list of (timestamp, value) newer than timestamp."""
+        result = []
+        for offset in range(1, self._count + 1):
+            index = (self._next - offset) % self._size
+            if self._timestamps[index] < timestamp:
+                break
+            result.append((self._timestamps[index], self._values[index]))
+        result.reverse()
+        return result
+
+
+class LiveReadings:
+    """The last N readings per sensor and per system metric, held in memory.
+
+    Series are keyed by name, e.g. 'sensor.Internal.temperature' or
+    'system.soc_temperature'.  status_provider, if given, returns
+    {sensor name: SHT30.read_status_info() tuple} for the metrics endpoint.
+    """
+
+    DEFAULT_SIZE = 720
+
+    def __init__(self, size=DEFAULT_SIZE, status_provider=None):
+        self._size = int(size)
+        self._series = {}
+        self._lock = threading.Lock()
+        self._status_provider = status_provider
+
+    def _append(self, name, timestamp, value):
+        series = self._series.get(name)
+        if series is None:
+            series = self._series[name] = RingBuffer(self._size)
+        series.append(timestamp, value)
+
+    def record_sensor(self, name, timestamp, temperature, humidity):
+        with self._lock:
+            self._append('sensor.%s.temperature' % name, timestamp, temperature)
+            self._append('sensor.%s.humidity' % name, timestamp, humidity)
+
+    def record_system(self, timestamp, values):
+        with self._lock:
+            for name, value in values.items():
+                if isinstance(value, (int, float)):
+                    self._append('system.%s' % name, timestamp, value)
+
+    def latest(self):
+        with self._lock:
+            return dict((name, series.latest()) for name, series in self._series.items() if len(series))
+
+    def since(self, timestamp):
+        with self._lock:
+            return dict((name, series.since(timestamp)) for name, series in self._series.items())
+
+    def status_info(self):
+        return self._status_provider() if self._status_provider is not None else {}
+
+
+def _json_number(value):
+    return None if math.isnan(value) else value
+
+
+def render_latest(live):
+    return dict((name, {'timestamp': timestamp, 'value': _json_number(value)})
+                for name, (timestamp, value) in live.latest().items())
+
+
+def render_last_hour(live):
+    return dict((name, [[timestamp, _json_number(value)] for timestamp, value in points])
+                for name, points in live.since(time.time() - 3600.0).items())
+
+
+STATUS_COUNTERS = ('good_reads', 'bad_readings', 'bad_crcs', 'retries', 'power_cycles')
+
+
+def _prometheus_number(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def render_prometheus(live):
+    lines = []
+    for name, (timestamp, value) in sorted(live.latest().items()):
+        kind, rest = name.split('.', 1)
+        if kind == 'sensor':
+            sensor, field = rest.rsplit('.', 1)
+            metric = 'greenhouse_%s' % field
+            lines.append('%s{sensor="%s"} %s' % (metric, sensor, _prometheus_number(value)))
+        else:
+            lines.append('greenhouse_system_%s %s' % (rest, _prometheus_number(value)))
+    for sensor, counters in sorted(live.status_info().items()):
+        for counter, value in zip(STATUS_COUNTERS, counters):
+            lines.append('greenhouse_sht30_%s_total{sensor="%s"} %d' % (counter, sensor, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Tiny asyncio HTTP server exposing LiveReadings.
+
+    GET /latest     JSON of the newest value of every series
+    GET /last-hour  JSON of every series over the last hour
+    GET /metrics    Prometheus text format, including SHT30 status counters
+    It runs its own event loop on a daemon thread so the recorder is untouched.
+    """
+
+    def __init__(self, live, port, host='127.0.0.1'):
+        self._live = live
+        self._port = int(port)
+        self._host = host
+        self._loop = None
+        self._server = None
+        self._thread = threading.Thread(target=self._serve, name='metrics-server', daemon=True)
+        self._started = threading.Event()
+        self._error = None
+
+    def start(self):
+        """Returns once the server is listening; raises if it could not listen."""
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            self._thread.join()
+            raise self._error
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1] if self._server is not None else None
+
+    def _serve(self):
+        # Imported here, on the server thread, to keep it off the startup path.
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self._server = loop.run_until_complete(asyncio.start_server(self._handle, self._host, self._port))
+        except Exception as e:
+            # e.g. the port is taken or metrics_bind is not a local address.
+            loop.close()
+            self._error = e
+            self._started.set()
+            return
+        self._loop = loop
+        self._started.set()
+        self._loop.run_forever()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    def _respond(self, path):
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', render_prometheus(self._live)
+        if path == '/latest':
+            return 200, 'application/json', json.dumps(render_latest(self._live))
+        if path == '/last-hour':
+            return 200, 'application/json', json.dumps(render_last_hour(self._live))
+        return 404, 'text/plain', 'not found\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                status, content_type, body = 405, 'text/plain', 'method not allowed\n'
+            else:
+                status, content_type, body = self._respond(request_line[1].split('?', 1)[0])
+            body = body.encode('utf8')
+            writer.write(('HTTP/1.0 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                          % (status, 'OK' if status == 200 else 'Error', content_type, len(body))).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
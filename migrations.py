@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import rollups
+
+# Versions the Rails dashboard expects to find in schema_migrations for the
+# tables created here, so its own migrations do not try to recreate them.
+RAILS_SCHEMA_VERSIONS = ('20160529015914', '20160529020002', '20160529020220', '20160529191804')
+
+
+def _create_base_tables(db):
+    db.execute('CREATE TABLE IF NOT EXISTS "data_points" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "timestamp" integer, "synchronized" integer DEFAULT 0);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_data_points_on_timestamp" ON "data_points" ("timestamp");')
+
+    db.execute('CREATE TABLE IF NOT EXISTS "sensor_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "sensor_id" integer, "temperature" float, "humidity" float, "data_point_id" integer);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_sensor_data_on_data_point_id" ON "sensor_data" ("data_point_id");')
+
+    db.execute('CREATE TABLE IF NOT EXISTS "system_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "soc_temperature" float, wlan0_link_quality float, wlan0_signal_level integer, storage_total_size integer,storage_used integer, storage_avail integer, "data_point_id" integer);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_system_data_on_data_point_id" ON "system_data" ("data_point_id");')
+
+    db.execute('CREATE TABLE IF NOT EXISTS "image_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "filename" text, "data_point_id" integer);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_image_data_on_data_point_id" ON "image_data" ("data_point_id");')
+
+    # Rails Migration data. In the event this is run before rails migrations are run we need to let rails know we
+    # are already setup for it
+    db.execute('CREATE TABLE IF NOT EXISTS "schema_migrations" ("version" varchar NOT NULL);')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS "unique_schema_migrations" ON "schema_migrations" ("version");')
+    for version in RAILS_SCHEMA_VERSIONS:
+        db.execute('INSERT OR IGNORE INTO "schema_migrations" ("version") VALUES (?)', (version,))
+
+
+def _create_rollups(db):
+    print("Building sensor rollups from existing data...")
+    rollups.create_tables(db)
+    rollups.backfill(db)
+
+
+def _add_read_side_indexes(db):
+    # Covering indexes: charts fetch one sensor's readings by data point, and
+    # the dashboard joins a data point to all of its sensors, neither needs
+    # to touch the table itself.
+    db.execute('CREATE INDEX IF NOT EXISTS "index_sensor_data_on_sensor_id_and_data_point_id" ON "sensor_data" ("sensor_id", "data_point_id", "temperature", "humidity");')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_sensor_data_on_data_point_id_and_sensor_id" ON "sensor_data" ("data_point_id", "sensor_id", "temperature", "humidity");')
+    # The replicator repoints image rows by filename.
+    db.execute('CREATE INDEX IF NOT EXISTS "index_image_data_on_filename" ON "image_data" ("filename");')
+
+
+def _create_sensor_health(db):
+    # One row per sensor per data point, so a failing sensor shows up next
+    # to the readings it is missing.
+    db.execute('CREATE TABLE IF NOT EXISTS "sensor_health" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "sensor_id" integer, "state" varchar, "consecutive_failures" integer, "good_reads" integer, "bad_readings" integer, "bad_crcs" integer, "retries" integer, "power_cycles" integer, "quarantines" integer, "data_point_id" integer);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_sensor_health_on_data_point_id" ON "sensor_health" ("data_point_id");')
+
+
+def _add_raw_sensor_columns(db):
+    # temperature and humidity hold the filtered values the dashboard shows;
+    # the unfiltered ones are kept alongside when record_raw_readings is set.
+    db.execute('ALTER TABLE "sensor_data" ADD COLUMN "raw_temperature" float;')
+    db.execute('ALTER TABLE "sensor_data" ADD COLUMN "raw_humidity" float;')
+
+
+def _add_image_info_columns(db):
+    # Filled in by the image pipeline once the thumbnail has been made.
+    db.execute('ALTER TABLE "image_data" ADD COLUMN "width" integer;')
+    db.execute('ALTER TABLE "image_data" ADD COLUMN "height" integer;')
+    db.execute('ALTER TABLE "image_data" ADD COLUMN "file_size" integer;')
+    db.execute('ALTER TABLE "image_data" ADD COLUMN "thumbnail_filename" text;')
+
+
+def _create_timings(db):
+    # Per-stage duration histograms from the instrumentation, one row per
+    # stage per reporting interval; buckets is a JSON array of counts.
+    db.execute('CREATE TABLE IF NOT EXISTS "timings" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "timestamp" integer, "source" varchar, "stage" varchar, "count" integer, "total_seconds" float, "max_seconds" float, "p50_seconds" float, "p95_seconds" float, "p99_seconds" float, "buckets" text);')
+    db.execute('CREATE INDEX IF NOT EXISTS "index_timings_on_timestamp" ON "timings" ("timestamp");')
+
+
+def _add_unuploaded_index(db):
+    # Lets the sync service come back for re-marked data points without a
+    # full scan; must match the WHERE clause of its SELECT exactly.
+    db.execute('CREATE INDEX IF NOT EXISTS "index_data_points_not_uploaded" ON "data_points" ("id") WHERE (synchronized & 1) = 0;')
+
+
+# Ordered (version, description, function).  Never edit or reorder a
+# released entry; append a new one instead.  The applied version is kept in
+# PRAGMA user_version, which leaves the Rails schema_migrations table alone.
+MIGRATIONS = (
+    (1, "base tables", _create_base_tables),
+    (2, "sensor rollups", _create_rollups),
+    (3, "read side covering indexes", _add_read_side_indexes),
+    (4, "sensor health", _create_sensor_health),
+    (5, "raw sensor readings", _add_raw_sensor_columns),
+    (6, "image dimensions and thumbnails", _add_image_info_columns),
+    (7, "stage timings", _create_timings),
+    (8, "not yet uploaded data points index", _add_unuploaded_index),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(db):
+    return db.execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate(db):
+    """Apply any pending migrations; returns the list of versions applied.
+
+    db must be in autocommit mode (isolation_level=None); each migration runs
+    in its own transaction together with its user_version bump.
+    """
+    version = current_version(db)
+    if version >= LATEST_VERSION:
+        return []
+    if version == 0:
+        # Only has an effect on a brand new database file.
+        db.execute('PRAGMA encoding = "UTF-8";')
+    applied = []
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        print("Migrating database to version %d (%s)..." % (migration_version, description))
+        db.execute('BEGIN')
+        try:
+            migration(db)
+            db.execute('PRAGMA user_version = %d;' % migration_version)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        applied.append(migration_version)
+    return applied
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from database_writer import SYNCHRONIZED_EXPORTED, SYNCHRONIZED_UPLOADED
+import image_pipeline
+
+SECONDS_IN_DAY = 86400
+IMAGE_THIN_INTERVALS = {'hour': 3600, 'day': SECONDS_IN_DAY}
+RAW_TABLES = ('data_points', 'sensor_data', 'system_data', 'image_data', 'sensor_health')
+
+
+class RetentionEngine:
+    """Ages data out of greenhouse_data.sqlite in small batches.
+
+    Policies (all optional, from the JSON config):
+      retention_raw_days          raw readings older than this leave the main database
+      retention_archive_dir       if set, those readings are first copied into per-month
+                                  greenhouse_data_YYYY_MM.sqlite files here
+      retention_image_thin_days   images older than this are thinned ...
+      retention_image_thin_interval  ... to one per 'hour' or 'day'
+      retention_min_free_kb       run a pass as soon as free storage drops below this
+    Rollups are never touched, so long-range charts keep working.  While a
+    sync endpoint or an export is configured, raw readings stay until they
+    have been uploaded or exported.  Without an archive, the image files of
+    expired readings are deleted along with their rows.
+
+    Each batch is its own short transaction on a separate connection, so the
+    recorder's writer is never locked out for long.
+    """
+
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_BATCH_PAUSE = 0.05
+    DEFAULT_LOW_SPACE_INTERVAL = 3600.0
+
+    def __init__(self, db_path, raw_days=None, archive_dir=None, image_thin_days=None, image_thin_interval='hour',
+                 min_free_kb=None, batch_size=DEFAULT_BATCH_SIZE, batch_pause=DEFAULT_BATCH_PAUSE, busy_timeout=120.0,
+                 required_synchronized=0):
+        self._db_path = db_path
+        self._raw_days = raw_days
+        self._archive_dir = archive_dir
+        self._image_thin_days = image_thin_days
+        self._image_thin_interval = IMAGE_THIN_INTERVALS.get(image_thin_interval, image_thin_interval)
+        self._min_free_kb = min_free_kb
+        self._batch_size = int(batch_size)
+        self._batch_pause = float(batch_pause)
+        self._busy_timeout = float(busy_timeout)
+        # data_points.synchronized bits a point needs before it may expire.
+        self._required_synchronized = int(required_synchronized)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_low_space_run = 0.0
+        self.archived = 0
+        self.deleted = 0
+        self.images_thinned = 0
+
+    @classmethod
+    def from_config(cls, config, db_path):
+        required_synchronized = 0
+        if config.get('sync_endpoint'):
+            required_synchronized |= SYNCHRONIZED_UPLOADED
+        if config.get('export_dir') or config.get('export_format'):
+            required_synchronized |= SYNCHRONIZED_EXPORTED
+        return cls(db_path,
+                   raw_days=config.get('retention_raw_days'),
+                   archive_dir=config.get('retention_archive_dir'),
+                   image_thin_days=config.get('retention_image_thin_days'),
+                   image_thin_interval=config.get('retention_image_thin_interval', 'hour'),
+                   min_free_kb=config.get('retention_min_free_kb'),
+                   batch_size=config.get('retention_batch_size', cls.DEFAULT_BATCH_SIZE),
+                   # Must outlast a grouped commit on the recorder's connection.
+                   busy_timeout=float(config.get('commit_every_seconds', 60.0)) * 2,
+                   required_synchronized=required_synchronized)
+
+    @property
+    def enabled(self):
+        return self._raw_days is not None or self._image_thin_days is not None
+
+    def _connect(self):
+        db = sqlite3.connect(self._db_path, isolation_level=None, timeout=self._busy_timeout)
+        db.execute('PRAGMA journal_mode = WAL;')
+        return db
+
+    def run(self, now=None):
+        """Run one full pass; returns once every policy is satisfied."""
+        if not self._lock.acquire(False):
+            return
+        try:
+            now = time.time() if now is None else now
+            db = self._connect()
+            try:
+                if self._image_thin_days is not None:
+                    self._thin_images(db, now - self._image_thin_days * SECONDS_IN_DAY)
+                if self._raw_days is not None:
+                    self._expire_raw(db, now - self._raw_days * SECONDS_IN_DAY)
+            finally:
+                db.close()
+        finally:
+            self._lock.release()
+
+    def run_in_background(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run_logged, name='retention', daemon=True)
+        self._thread.start()
+
+    def _run_logged(self):
+        try:
+            self.run()
+            print("Retention pass: %d archived, %d deleted, %d images thinned" % (self.archived, self.deleted, self.images_thinned))
+        except Exception as e:
+            print("WARNING: Retention pass failed - ", e)
+
+    def check_free_space(self, storage_avail_kb):
+        """Call with each storage_avail reading; starts a pass when space runs low."""
+        if self._min_free_kb is None or storage_avail_kb >= self._min_free_kb:
+            return
+        now = time.monotonic()
+        if now - self._last_low_space_run >= RetentionEngine.DEFAULT_LOW_SPACE_INTERVAL:
+            self._last_low_space_run = now
+            print("WARNING: Storage below %d KB free, running retention." % self._min_free_kb)
+            self.run_in_background()
+
+    def _archive_path(self, month):
+        return os.path.join(self._archive_dir, 'greenhouse_data_%s.sqlite' % month)
+
+    def _attach_archive(self, db, month):
+        db.execute('ATTACH DATABASE ? AS archive', (self._archive_path(month),))
+        # Give the archive the same tables as the live database.
+        for table in self._child_tables(db) + ['data_points']:
+            row = db.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            db.execute(row[0].replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS archive.', 1).replace('archive. ', 'archive.', 1))
+            # Archives from before a column was added get it now, so SELECT * still lines up.
+            archive_columns = set(column[1] for column in db.execute('PRAGMA archive.table_info("%s")' % table))
+            for column in db.execute('PRAGMA main.table_info("%s")' % table).fetchall():
+                if column[1] not in archive_columns:
+                    db.execute('ALTER TABLE archive."%s" ADD COLUMN "%s" %s' % (table, column[1], column[2]))
+
+    def _child_tables(self, db):
+        return [table for table in RAW_TABLES[1:]
+                if db.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()]
+
+    def _expire_raw(self, db, cutoff):
+        if self._archive_dir is not None:
+            try:
+                os.makedirs(self._archive_dir)
+            except OSError:
+                pass
+        attached_month = None
+        try:
+            while True:
+                rows = db.execute('SELECT id, timestamp FROM data_points WHERE timestamp < ? AND (synchronized & ?) = ? '
+                                  'ORDER BY id LIMIT ?',
+                                  (cutoff, self._required_synchronized, self._required_synchronized,
+                                   self._batch_size)).fetchall()
+                if not rows:
+                    break
+                # Keep each batch within one month so it goes to a single archive.
+                month = datetime.fromtimestamp(rows[0][1]).strftime('%Y_%m')
+                ids = [row[0] for row in rows if datetime.fromtimestamp(row[1]).strftime('%Y_%m') == month]
+                if self._archive_dir is not None and attached_month != month:
+                    if attached_month is not None:
+                        db.execute('DETACH DATABASE archive')
+                    self._attach_archive(db, month)
+                    attached_month = month
+                self._move_batch(db, ids)
+                time.sleep(self._batch_pause)
+        finally:
+            if attached_month is not None:
+                db.execute('DETACH DATABASE archive')
+
+    def _move_batch(self, db, ids):
+        placeholders = ','.join('?' * len(ids))
+        child_tables = self._child_tables(db)
+        image_files = []
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if self._archive_dir is None and 'image_data' in child_tables:
+                # Nothing will refer to these files once the rows are gone.
+                image_files = db.execute('SELECT filename, thumbnail_filename FROM main.image_data '
+                                         'WHERE data_point_id IN (%s)' % placeholders, ids).fetchall()
+            if self._archive_dir is not None:
+                db.execute('INSERT OR IGNORE INTO archive.data_points SELECT * FROM main.data_points WHERE id IN (%s)' % placeholders, ids)
+                for table in child_tables:
+                    db.execute('INSERT OR IGNORE INTO archive.%s SELECT * FROM main.%s WHERE data_point_id IN (%s)' % (table, table, placeholders), ids)
+            for table in child_tables:
+                db.execute('DELETE FROM main.%s WHERE data_point_id IN (%s)' % (table, placeholders), ids)
+            db.execute('DELETE FROM main.data_points WHERE id IN (%s)' % placeholders, ids)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        # Only once the rows are committed, so a failed batch keeps its files.
+        for filename, _ in image_files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        image_pipeline.remove_thumbnails([thumbnail_filename for _, thumbnail_filename in image_files
+                                          if thumbnail_filename])
+        if self._archive_dir is not None:
+            self.archived += len(ids)
+        else:
+            self.deleted += len(ids)
+
+    def _thin_images(self, db, cutoff):
+        # Keep the first image in each interval, drop the rest (file,
+        # thumbnail and row).
+        last_id = 0
+        last_bucket = None
+        while True:
+            rows = db.execute('SELECT image_data.id, image_data.filename, image_data.thumbnail_filename, '
+                              'data_points.timestamp FROM image_data '
+                              'JOIN data_points ON data_points.id = image_data.data_point_id '
+                              'WHERE image_data.id > ? AND data_points.timestamp < ? ORDER BY image_data.id LIMIT ?',
+                              (last_id, cutoff, self._batch_size)).fetchall()
+            if not rows:
+                break
+            doomed = []
+            for image_id, filename, thumbnail_filename, timestamp in rows:
+                bucket = int(timestamp) // self._image_thin_interval
+                if bucket == last_bucket:
+                    doomed.append((image_id, filename, thumbnail_filename))
+                last_bucket = bucket
+                last_id = image_id
+            for image_id, filename, thumbnail_filename in doomed:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            image_pipeline.remove_thumbnails([thumbnail_filename for _, _, thumbnail_filename in doomed
+                                              if thumbnail_filename])
+            if doomed:
+                db.execute('DELETE FROM image_data WHERE id IN (%s)' % ','.join('?' * len(doomed)),
+                           [image_id for image_id, _, _ in doomed])
+                self.images_thinned += len(doomed)
+            time.sleep(self._batch_pause)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import array
+import sqlite3
+
+# Bucket sizes in seconds.  Buckets are aligned to UTC epoch multiples.
+ROLLUP_RESOLUTIONS = (300, 3600, 86400)
+
+CREATE_ROLLUP_TABLE = 'CREATE TABLE IF NOT EXISTS "sensor_rollups" ("resolution" integer NOT NULL, "bucket" integer NOT NULL, "sensor_id" integer NOT NULL, "count" integer NOT NULL, "temperature_min" float, "temperature_max" float, "temperature_sum" float, "humidity_min" float, "humidity_max" float, "humidity_sum" float, PRIMARY KEY ("resolution", "sensor_id", "bucket")) WITHOUT ROWID;'
+
+UPSERT_ROLLUP = ('INSERT INTO sensor_rollups(resolution, bucket, sensor_id, count, temperature_min, temperature_max, temperature_sum, humidity_min, humidity_max, humidity_sum) '
+                 'VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?) '
+                 'ON CONFLICT(resolution, sensor_id, bucket) DO UPDATE SET '
+                 'count = count + 1, '
+                 'temperature_min = min(temperature_min, excluded.temperature_min), '
+                 'temperature_max = max(temperature_max, excluded.temperature_max), '
+                 'temperature_sum = temperature_sum + excluded.temperature_sum, '
+                 'humidity_min = min(humidity_min, excluded.humidity_min), '
+                 'humidity_max = max(humidity_max, excluded.humidity_max), '
+                 'humidity_sum = humidity_sum + excluded.humidity_sum')
+
+BACKFILL_ROLLUP = ('INSERT OR REPLACE INTO sensor_rollups(resolution, bucket, sensor_id, count, temperature_min, temperature_max, temperature_sum, humidity_min, humidity_max, humidity_sum) '
+                   'SELECT ?, (CAST(data_points.timestamp AS integer) / ?) * ?, sensor_data.sensor_id, count(*), '
+                   'min(temperature), max(temperature), sum(temperature), min(humidity), max(humidity), sum(humidity) '
+                   'FROM sensor_data JOIN data_points ON data_points.id = sensor_data.data_point_id '
+                   'GROUP BY 2, sensor_data.sensor_id')
+
+SELECT_ROLLUP = ('SELECT bucket, count, temperature_min, temperature_max, temperature_sum, humidity_min, humidity_max, humidity_sum '
+                 'FROM sensor_rollups WHERE resolution = ? AND sensor_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket')
+
+SELECT_RAW = ('SELECT data_points.timestamp, sensor_data.temperature, sensor_data.humidity '
+              'FROM data_points JOIN sensor_data ON sensor_data.data_point_id = data_points.id '
+              'WHERE data_points.timestamp >= ? AND data_points.timestamp < ? AND sensor_data.sensor_id = ? '
+              'AND sensor_data.temperature IS NOT NULL AND sensor_data.humidity IS NOT NULL '
+              'ORDER BY data_points.timestamp')
+
+
+def create_tables(db):
+    db.execute(CREATE_ROLLUP_TABLE)
+
+
+def backfill(db):
+    """Rebuild every rollup from the raw tables; used once when rollups are first added."""
+    for resolution in ROLLUP_RESOLUTIONS:
+        db.execute(BACKFILL_ROLLUP, (resolution, resolution, resolution))
+
+
+def update(cursor, sensor_id, timestamp, temperature, humidity):
+    """Fold one reading into every resolution's bucket; called in the insert's transaction."""
+    timestamp = int(timestamp)
+    for resolution in ROLLUP_RESOLUTIONS:
+        cursor.execute(UPSERT_ROLLUP, (resolution, timestamp - timestamp % resolution, sensor_id,
+                                       temperature, temperature, temperature, humidity, humidity, humidity))
+
+
+class SeriesResult:
+    """Compact columns for a sensor over a time range.
+
+    timestamps, temperature_* and humidity_* are array.array('d').  For raw
+    data (resolution 0) min, mean and max are the same array.
+    """
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.timestamps = array.array('d')
+        self.counts = array.array('l')
+        self.temperature_min = array.array('d')
+        self.temperature_mean = array.array('d')
+        self.temperature_max = array.array('d')
+        self.humidity_min = array.array('d')
+        self.humidity_mean = array.array('d')
+        self.humidity_max = array.array('d')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class RollupQuery:
+    """Time-range queries that read the coarsest resolution still giving enough points."""
+
+    DEFAULT_MAX_POINTS = 1000
+
+    def __init__(self, db_path=None, db=None):
+        if db is None:
+            db = sqlite3.connect('file:%s?mode=ro' % db_path, uri=True)
+        self._db = db
+
+    def choose_resolution(self, start, end, max_points=DEFAULT_MAX_POINTS, raw_period=None):
+        span = float(end - start)
+        # Raw rows are only worth reading when they alone fit the budget.
+        if raw_period is not None and span / raw_period <= max_points:
+            return 0
+        for resolution in ROLLUP_RESOLUTIONS:
+            if span / resolution <= max_points:
+                return resolution
+        return ROLLUP_RESOLUTIONS[-1]
+
+    def series(self, sensor_id, start, end, max_points=DEFAULT_MAX_POINTS, raw_period=None, resolution=None):
+        if resolution is None:
+            resolution = self.choose_resolution(start, end, max_points, raw_period)
+        result = SeriesResult(resolution)
+        if resolution == 0:
+            for timestamp, temperature, humidity in self._db.execute(SELECT_RAW, (start, end, sensor_id)):
+                result.timestamps.append(timestamp)
+                result.counts.append(1)
+                result.temperature_mean.append(temperature)
+                result.humidity_mean.append(humidity)
+            result.temperature_min = result.temperature_max = result.temperature_mean
+            result.humidity_min = result.humidity_max = result.humidity_mean
+            return result
+
+        first_bucket = int(start) - int(start) % resolution
+        for row in self._db.execute(SELECT_ROLLUP, (resolution, sensor_id, first_bucket, end)):
+            bucket, count, t_min, t_max, t_sum, h_min, h_max, h_sum = row
+            result.timestamps.append(bucket)
+            result.counts.append(count)
+            result.temperature_min.append(t_min)
+            result.temperature_mean.append(t_sum / count)
+            result.temperature_max.append(t_max)
+            result.humidity_min.append(h_min)
+            result.humidity_mean.append(h_sum / count)
+            result.humidity_max.append(h_max)
+        return result
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import heapq
+import math
+import threading
+import time
+
+
+class JobStats:
+    """Running lateness statistics for a scheduled job (Welford's method)."""
+
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def record(self, lateness):
+        self.runs += 1
+        delta = lateness - self._mean
+        self._mean += delta / self.runs
+        self._m2 += delta * (lateness - self._mean)
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+    @property
+    def mean_lateness(self):
+        return self._mean
+
+    @property
+    def jitter(self):
+        return math.sqrt(self._m2 / (self.runs - 1)) if self.runs > 1 else 0.0
+
+    def as_dict(self):
+        return {'runs': self.runs,
+                'skipped': self.skipped,
+                'mean_lateness': self.mean_lateness,
+                'max_lateness': self.max_lateness,
+                'jitter': self.jitter}
+
+
+class Job:
+    """A periodic job, aligned to wall clock multiples of its period plus a phase."""
+
+    SKIP = 'skip'
+    CATCH_UP = 'catch_up'
+
+    def __init__(self, name, period, phase=0.0, align=True, missed_policy=SKIP, priority=0):
+        if period <= 0:
+            raise ValueError("Job '%s' needs a positive period" % name)
+        if missed_policy not in (Job.SKIP, Job.CATCH_UP):
+            raise ValueError("Unknown missed deadline policy '%s'" % missed_policy)
+        self.name = name
+        self.period = float(period)
+        self.phase = float(phase)
+        self.align = align
+        self.missed_policy = missed_policy
+        self.priority = priority
+        self.deadline = None
+        self.stats = JobStats()
+
+    def first_deadline(self, now, utc_offset):
+        if not self.align:
+            return now + self.phase
+        # Align against local wall clock so a 30 minute period lands on :00 and :30.
+        local_now = now + utc_offset - self.phase
+        return math.ceil(local_now / self.period) * self.period - utc_offset + self.phase
+
+    def advance(self, now):
+        self.deadline += self.period
+        if self.missed_policy == Job.SKIP and self.deadline <= now:
+            missed = int((now - self.deadline) // self.period) + 1
+            self.stats.skipped += missed
+            self.deadline += missed * self.period
+
+
+class Scheduler:
+    """Deadline driven scheduler.
+
+    Deadlines are kept in wall clock seconds (so they can be aligned to
+    boundaries and stored with data points) but all waiting is done against
+    the monotonic clock, so the process sleeps exactly until the next
+    deadline instead of polling.
+    """
+
+    DEFAULT_COALESCE_WINDOW = 1.0
+
+    def __init__(self, coalesce_window=DEFAULT_COALESCE_WINDOW, clock=time.time, monotonic=time.monotonic,
+                 sleep=None):
+        self._jobs = {}
+        self._queue = []
+        self._coalesce_window = coalesce_window
+        self._clock = clock
+        self._monotonic = monotonic
+        self._wakeup = threading.Event()
+        self._sleep = sleep if sleep is not None else self._wakeup.wait
+        self._stopped = False
+        self._triggered = []
+        # Guards _triggered together with _wakeup so a trigger() from another
+        # thread is either taken with this batch or leaves the event set.
+        self._trigger_lock = threading.Lock()
+
+    def add_job(self, job):
+        now = self._clock()
+        job.deadline = job.first_deadline(now, time.localtime(now).tm_gmtoff)
+        self._jobs[job.name] = job
+        heapq.heappush(self._queue, (job.deadline, job.priority, job.name))
+        return job
+
+    def job(self, name):
+        return self._jobs[name]
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def trigger(self, name):
+        """Make a job due once, right away, leaving its periodic deadlines alone.
+
+        Safe to call from another thread or from inside the sleep function.
+        """
+        with self._trigger_lock:
+            self._triggered.append(name)
+            self._wakeup.set()
+
+    def set_period(self, name, period):
+        """Change a job's period; its next deadline moves to match.
+
+        Aligned jobs move to the next boundary of the new period, others to
+        one new period after their last run.  Call from the thread running
+        wait_for_due_jobs().
+        """
+        job = self._jobs[name]
+        now = self._clock()
+        last_deadline = job.deadline - job.period
+        job.period = float(period)
+        if job.align:
+            job.deadline = job.first_deadline(now, time.localtime(now).tm_gmtoff)
+        else:
+            job.deadline = max(now, last_deadline + job.period)
+        self._queue = [entry for entry in self._queue if entry[2] != name]
+        self._queue.append((job.deadline, job.priority, job.name))
+        heapq.heapify(self._queue)
+
+    def wait_for_due_jobs(self):
+        """Sleep until the earliest deadline and return (deadline, [jobs]) for everything due.
+
+        Jobs whose deadlines fall within the coalesce window of the first are
+        returned together so they can share a single data point.  Triggered
+        jobs are returned on their own, with the current time as deadline.
+        Returns (None, []) once stop() has been called.
+        """
+        while not self._stopped and self._queue and not self._triggered:
+            deadline = self._queue[0][0]
+            # Convert the wall clock deadline into a monotonic wait once per
+            # sleep so clock steps (NTP) only shift the current wait.
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                break
+            target = self._monotonic() + remaining
+            while not self._stopped and not self._triggered:
+                remaining = target - self._monotonic()
+                if remaining <= 0:
+                    break
+                self._sleep(remaining)
+        if self._stopped or not self._queue:
+            return None, []
+        if self._triggered:
+            with self._trigger_lock:
+                names, self._triggered = self._triggered, []
+                self._wakeup.clear()
+            return self._clock(), [self._jobs[name] for name in sorted(set(names)) if name in self._jobs]
+
+        first_deadline = self._queue[0][0]
+        now = self._clock()
+        due = []
+        while self._queue and self._queue[0][0] <= max(now, first_deadline + self._coalesce_window):
+            deadline, _, name = heapq.heappop(self._queue)
+            job = self._jobs[name]
+            job.stats.record(max(0.0, now - deadline))
+            due.append(job)
+        for job in due:
+            job.advance(now)
+            heapq.heappush(self._queue, (job.deadline, job.priority, job.name))
+        return first_deadline, due
+
+    def next_deadline(self, name):
+        return self._jobs[name].deadline
+
+    def stats(self):
+        return dict((name, job.stats.as_dict()) for name, job in self._jobs.items())
@@ -3,16 +3,26 @@
 
 import time
 from datetime import datetime
-import sqlite3
 import os
-import subprocess
-import re
 import time
-from picamera2.picamera2 import Picamera2
 import json
+import signal
 import sys
-import SHT30
-import TCA9545
+from acquisition import AcquisitionPipeline
+from adaptive_sampling import CaptureLimiter, MotionDetector, RateController, triggers_from_config
+from database_writer import DatabaseWriter
+from filters import SignalProcessor
+import hardware
+import instrumentation
+from i2c_bus_manager import I2CBusManager
+from image_pipeline import ImagePipeline
+from image_replicator import ImageReplicator
+from image_writer import ImageWriter
+from live_metrics import LiveReadings, MetricsServer
+import migrations
+from retention import RetentionEngine
+from scheduler import Job, Scheduler
+from system_stats import SystemStatsCollector, read_process_age
 
 class SenseAndRecord:
 
@@ -24,235 +34,567 @@ class SenseAndRecord:
     SECONDS_IN_DAY      = SECONDS_IN_HOUR * HOURS_IN_DAY
 
     CAMERA_INITIALIZE_TIME = 2.0
+    DEFAULT_STARTUP_BUDGET = 0.5
 
-    class SensorException(Exception):
-        def __init__(self, value):
-            self.value = value
+    # What one process is responsible for.  A plain run does all three; the
+    # supervisor gives each worker process one of them.
+    ROLE_SENSORS = 'sensors'
+    ROLE_CAMERA = 'camera'
+    ROLE_STORAGE = 'storage'
+    ALL_ROLES = (ROLE_SENSORS, ROLE_CAMERA, ROLE_STORAGE)
 
-        def __str__(self):
-            return repr(self.value)
-
-    def __init__(self, config_file_name):
+    def __init__(self, config_file_name, roles=ALL_ROLES, on_image_written=None, on_image_requested=None,
+                 on_timings=None):
         with open(config_file_name) as json_config_file:
             self._config = json.load(json_config_file)
             self._output_dir = self._config['output_dir']
             self._minutes_between_sensor_readings = float(self._config["minutes_between_sensor_readings"])
             self._minutes_between_image_acquisitions = float(self._config["minutes_between_image_acquisitions"])
+        hardware.configure(self._config)
+        self._roles = frozenset(roles)
+        if not self._config.get('camera_enabled', True):
+            self._roles -= frozenset([SenseAndRecord.ROLE_CAMERA])
 
         self._last_image_taken = 0
         self._last_weather_sensed = 0
-        # Prep the mux.
-        # Note: This allows us to talk to up to 4 devices with the same address.
-        self._tca9545 = TCA9545.TCA9545(addr=TCA9545.TCA9545_ADDRESS, bus_enable=TCA9545.TCA9545_CONFIG_BUS0)
-        self._sht30 = SHT30.SHT30(powerpin=6)
+        self._scheduler = None
+        self._stop_requested = False
+        self._camera = None
+        self._camera_ready_at = 0.0
+        self._system_stats = None
+        self._bus_manager = None
+        self._db_writer = None
+        self._metrics_server = None
+        self._sync_service = None
+        self._image_writer = None
+        self._replicator = None
+        self._image_pipeline = None
+        self._sensor_status = {}
+        self._rate_controller = None
+        self._threshold_triggers = []
+        self._motion = None
+        self._motion_options = None
+        self._capture_limiter = None
+        self._on_image_requested = on_image_requested
+        self._on_timings = on_timings
+        self._timings_source = ','.join(sorted(self._roles))
+        self._instrumentation = self._config.get('instrumentation')
+        self._profiler = None
+        if self._instrumentation is not None:
+            self._initialize_instrumentation()
+        self._pipeline = AcquisitionPipeline(max_workers=int(self._config.get('acquisition_workers', AcquisitionPipeline.DEFAULT_MAX_WORKERS)))
         try:
             os.makedirs(self._output_dir)
         except:
             pass
+        self._spool_dir = '%s/%s' % (self._output_dir, self._config['image_subfolder'])
+        # Devices and the database are brought up by start().
+        if SenseAndRecord.ROLE_CAMERA in self._roles:
+            self._image_writer = ImageWriter.from_config(self._config, on_image_written or self._image_written)
+        self._initialize_triggers()
+
+    def _initialize_instrumentation(self):
+        instrumentation.enable()
+        profile = self._instrumentation.get('profile')
+        if profile:
+            options = profile if isinstance(profile, dict) else {}
+            filename = self._instrumentation_path(options.get('output', 'profile.folded'))
+            if self._roles != frozenset(SenseAndRecord.ALL_ROLES):
+                # One profile per worker process.
+                root, extension = os.path.splitext(filename)
+                filename = '%s_%s%s' % (root, '_'.join(sorted(self._roles)), extension)
+            self._profiler = instrumentation.SamplingProfiler(filename,
+                interval=options.get('interval', instrumentation.SamplingProfiler.DEFAULT_INTERVAL),
+                dump_interval=options.get('dump_interval', instrumentation.SamplingProfiler.DEFAULT_DUMP_INTERVAL))
+
+    def _instrumentation_path(self, filename):
+        return os.path.join(self._output_dir, filename)
+
+    def _initialize_sensors(self):
+        self._system_stats = SystemStatsCollector(interface=self._config.get('wireless_interface', 'wlan0'), **hardware.system_stat_paths(self._output_dir))
+        self._system_stats.add_default_metrics()
+        # Prep the mux and the sensors behind it.
+        # Note: This allows us to talk to up to 4 devices with the same address per mux.
+        self._bus_manager = I2CBusManager.from_config(self._config, lock=self._pipeline.bus_lock)
+
+    def _initialize_triggers(self):
+        threshold_triggers, motion_options = triggers_from_config(self._config)
+        if SenseAndRecord.ROLE_SENSORS in self._roles:
+            sensor_period = SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_sensor_readings
+            self._rate_controller = RateController.from_config(self._config, sensor_period)
+            self._threshold_triggers = threshold_triggers
+        if SenseAndRecord.ROLE_CAMERA in self._roles:
+            self._capture_limiter = CaptureLimiter.from_config(self._config)
+            if motion_options is not None:
+                self._motion_options = motion_options
+                preview_size = tuple(motion_options.get('preview_size', (320, 240)))
+                self._motion = MotionDetector(threshold=motion_options.get('threshold', MotionDetector.DEFAULT_THRESHOLD),
+                                              downsample=motion_options.get('downsample', MotionDetector.DEFAULT_DOWNSAMPLE),
+                                              luma_rows=preview_size[1])
+
+    def _initialize_storage(self):
         self._initialize_database()
+        self._filters = SignalProcessor.from_config(self._config)
+        self._record_raw_readings = bool(self._config.get('record_raw_readings', False))
+        self._live = LiveReadings(size=self._config.get('live_buffer_size', LiveReadings.DEFAULT_SIZE),
+                                  status_provider=lambda: self._sensor_status)
+        if self._config.get('metrics_port') is not None:
+            self._metrics_server = MetricsServer(self._live, self._config['metrics_port'], host=self._config.get('metrics_bind', '127.0.0.1'))
+        self._retention = RetentionEngine.from_config(self._config, "%s/greenhouse_data.sqlite" % self._output_dir)
+        if self._config.get('sync_endpoint'):
+            # http.client and friends are only imported when there is somewhere to sync to.
+            from sync_service import SyncService
+            self._sync_service = SyncService.from_config(self._config, "%s/greenhouse_data.sqlite" % self._output_dir)
+        if self._config.get('external_share'):
+            self._replicator = ImageReplicator.from_config(self._config, self._output_dir, self._image_replicated,
+                                                           on_found=self._image_found)
+        self._image_pipeline = ImagePipeline.from_config(self._config, self._output_dir, self._image_processed)
 
     def _initialize_database(self):
-        self._db = sqlite3.connect("%s/greenhouse_data.sqlite" % self._output_dir)
-        self._db.execute('PRAGMA encoding = \"UTF-8\";')
-
-        self._db.execute('CREATE TABLE IF NOT EXISTS "data_points" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "timestamp" integer, "synchronized" integer DEFAULT 0);')
-        self._db.execute('CREATE INDEX IF NOT EXISTS "index_data_points_on_timestamp" ON "data_points" ("timestamp");')
-
-        self._db.execute('CREATE TABLE IF NOT EXISTS "sensor_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "sensor_id" integer, "temperature" float, "humidity" float, "data_point_id" integer);')
-        self._db.execute('CREATE INDEX IF NOT EXISTS "index_sensor_data_on_data_point_id" ON "sensor_data" ("data_point_id");')
-
-        self._db.execute('CREATE TABLE IF NOT EXISTS "system_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "soc_temperature" float, wlan0_link_quality float, wlan0_signal_level integer, storage_total_size integer,storage_used integer, storage_avail integer, "data_point_id" integer);')
-        self._db.execute('CREATE INDEX IF NOT EXISTS "index_system_data_on_data_point_id" ON "system_data" ("data_point_id");')
-
-        self._db.execute('CREATE TABLE IF NOT EXISTS "image_data" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "filename" text, "data_point_id" integer);')
-        self._db.execute('CREATE INDEX IF NOT EXISTS "index_image_data_on_data_point_id" ON "image_data" ("data_point_id");')
-        # Rails Migration data. In the event this is run before rails migrations are run we need to let rails know we
-        # are already setup for it
-        self._db.execute('CREATE TABLE IF NOT EXISTS "schema_migrations" ("version" varchar NOT NULL);')
-        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS "unique_schema_migrations" ON "schema_migrations" ("version");')
-        try:
-            self._db.execute('INSERT INTO "schema_migrations" ("version") VALUES (20160529015914)')
-        except sqlite3.IntegrityError:
-            pass
-        try:
-            self._db.execute('INSERT INTO "schema_migrations" ("version") VALUES (20160529020002)')
-        except sqlite3.IntegrityError:
-            pass
-        try:
-            self._db.execute('INSERT INTO "schema_migrations" ("version") VALUES (20160529020220)')
-        except sqlite3.IntegrityError:
-            pass
-        try:
-            self._db.execute('INSERT INTO "schema_migrations" ("version") VALUES (20160529191804)')
-        except sqlite3.IntegrityError:
-            pass
-        
-        self._db.commit()
-        self._db.close()
+        self._db_writer = DatabaseWriter.from_config(self._config, "%s/greenhouse_data.sqlite" % self._output_dir)
+        self._db = self._db_writer.connection
+        migrations.migrate(self._db)
 
     def _initialize_camera(self):
         print("Initializing Camera...")
         # Prep the camera for use
-        self._camera = Picamera2()
-
-        config = self._camera.create_still_configuration()
+        self._camera = hardware.camera_class()()
+
+        streams = {}
+        if 'image_resolution' in self._config:
+            streams['main'] = {"size": tuple(self._config['image_resolution'])}
+        if self._motion is not None:
+            # Motion triggers difference frames from a small preview stream.
+            streams['lores'] = {"size": tuple(self._motion_options.get('preview_size', (320, 240)))}
+        config = self._camera.create_still_configuration(**streams)
         self._camera.configure(config)
         self._camera.start()
+        # Rather than sleeping here, the first capture waits out whatever is
+        # left of the settle time, which is usually nothing.
+        self._camera_ready_at = time.monotonic() + SenseAndRecord.CAMERA_INITIALIZE_TIME
 
-        print('Waiting %1.0fs for the camera to settle...' % SenseAndRecord.CAMERA_INITIALIZE_TIME)
-        time.sleep(SenseAndRecord.CAMERA_INITIALIZE_TIME)
-        
     def validate_mount(self):
-        valid = False
-        try:
-            with open("%s/volume_info.json" % self._config['external_share']) as file_contents:
-                share_info = json.load(file_contents)
-                valid = share_info['storage_name'] == self._config['share_validation_string']
-        except:
-            valid = False
-        return valid
+        if self._replicator is None:
+            return False
+        return self._replicator.validate_mount()
 
     def sense_and_record(self):
         print("Starting Sense and Record v2.0")
 
         if self._config['output_dir']:
-           self._initialize_camera()
-           while True:
-               self._db = sqlite3.connect("%s/greenhouse_data.sqlite" % self._output_dir)
-               
-               can_print_next_image_message = False
-               timestamp = time.mktime(time.localtime())
-               
-               time_since_last_weather_sensed = time.mktime(time.localtime()) - self._last_weather_sensed
-               time_since_last_image_taken = time.mktime(time.localtime()) - self._last_image_taken
-               
-               if time_since_last_weather_sensed >= (SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_sensor_readings) or time_since_last_image_taken >= (SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_image_acquisitions):
-                   cursor = self._db.cursor()
-                   cursor.execute("INSERT INTO data_points(timestamp) VALUES (?)", (timestamp,));
-                   data_point_id = cursor.lastrowid
-                   # TODO: Try to align the image time with half hour bounaries
-                   self._sense_weather(cursor, data_point_id)
-                   
-                   self._get_system_data(cursor,data_point_id)
-
-                   if time_since_last_image_taken >= (SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_image_acquisitions):
-                       # TODO: Try to align the image time with half hour bounaries
-                       self._acquire_image(cursor, data_point_id, timestamp)
-                   else:
-                       print("Next camera image will be taken in %ldm...\n" % int(((SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_image_acquisitions) - time_since_last_image_taken) / SenseAndRecord.SECONDS_IN_MINUTE))
-                       
-                   print()
-
-               self._db.commit()
-               self._db.close()
-
-               delta = time.mktime(time.localtime()) - timestamp
-               sleep_len = (5.0 - delta) if (delta <= 5.0) else 0.0
-               time.sleep(sleep_len)
+           self.start()
+           # Make sure SIGTERM from systemd unwinds through the finally below so
+           # any grouped, uncommitted data points are flushed.
+           signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+           try:
+               self.run_schedule()
+           finally:
+               self.stop()
         else:
             print("Missing 'output_dir' in config file!")
             sys.exit(125)
 
-    def _sense_weather(self, cursor, data_point_id):
-        print(("*" * 80))
-        print(("%d - %s" % (data_point_id, time.strftime("%m/%d/%Y %H:%M:%S"))))
-        print("Reading Sensors...\n")
+    def _initialize_devices(self):
+        # The sensors, the camera and the database do not depend on each
+        # other, so each comes up on its own acquisition worker.
+        initializers = {}
+        if SenseAndRecord.ROLE_SENSORS in self._roles:
+            initializers['init_sensors'] = self._initialize_sensors
+        if SenseAndRecord.ROLE_STORAGE in self._roles:
+            initializers['init_storage'] = self._initialize_storage
+        if SenseAndRecord.ROLE_CAMERA in self._roles:
+            initializers['init_camera'] = self._initialize_camera
+        results = self._pipeline.run(initializers)
+        for name, result in sorted(results.items()):
+            if not result.ok:
+                raise result.error
+        return results
+
+    def start(self):
+        if self._profiler is not None:
+            self._profiler.start()
+        results = self._initialize_devices()
+        if self._replicator is not None:
+            self._replicator.start()
+        if self._sync_service is not None:
+            self._sync_service.start()
+        if self._metrics_server is not None:
+            try:
+                self._metrics_server.start()
+            except Exception as e:
+                print("WARNING: Unable to start the metrics server - ", e)
+                self._metrics_server = None
+        self._report_startup(results)
+
+    def _report_startup(self, results):
+        age = read_process_age()
+        print("Started %s in %0.2fs (%s)." % ('/'.join(sorted(self._roles)), age if age is not None else 0.0,
+                                             ", ".join("%s %0.3fs" % (name[len('init_'):], result.duration)
+                                                       for name, result in sorted(results.items()))))
+        if age is not None:
+            instrumentation.record('startup', age)
+
+    def _report_first_data_point(self):
+        # The startup budget runs until the first readings are recorded, not
+        # just until start() returns.  It only covers the sensors: a camera on
+        # its own always waits out the settle time before its first frame.
+        age = read_process_age()
+        if age is None:
+            return
+        budget = float(self._config.get('startup_budget_seconds', SenseAndRecord.DEFAULT_STARTUP_BUDGET))
+        print("First data point %0.2fs after launch." % age)
+        instrumentation.record('startup.first_data_point', age)
+        if SenseAndRecord.ROLE_SENSORS in self._roles and age > budget:
+            print("WARNING: First data point took %0.2fs, over its %0.2fs startup budget." % (age, budget))
+
+    def stop(self):
+        self.stop_scheduler()
+        self._pipeline.shutdown()
+        if self._image_writer is not None:
+            self._image_writer.close()
+        if self._image_pipeline is not None:
+            self._image_pipeline.close()
+        if self._replicator is not None:
+            self._replicator.close()
+        if self._sync_service is not None:
+            self._sync_service.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        if self._system_stats is not None:
+            self._system_stats.close()
+        if self._instrumentation is not None:
+            self.report_timings()
+        if self._profiler is not None:
+            self._profiler.stop()
+        if self._db_writer is not None:
+            self._db_writer.close()
+
+    def stop_scheduler(self):
+        """Makes run_schedule() return; safe to call from another thread."""
+        self._stop_requested = True
+        if self._scheduler is not None:
+            self._scheduler.stop()
+
+    def _initialize_scheduler(self, sleep=None):
+        align = self._config.get('align_schedule_to_boundaries', True)
+        missed_policy = self._config.get('missed_reading_policy', Job.SKIP)
+        sensor_period = SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_sensor_readings
+        image_period = SenseAndRecord.SECONDS_IN_MINUTE * self._minutes_between_image_acquisitions
+        weather_period = self._rate_controller.period if self._rate_controller is not None else sensor_period
+
+        self._scheduler = Scheduler(sleep=sleep)
+        if SenseAndRecord.ROLE_SENSORS in self._roles:
+            self._scheduler.add_job(Job('weather', weather_period, align=align, missed_policy=missed_policy, priority=0))
+            self._scheduler.add_job(Job('system', sensor_period, align=align, missed_policy=missed_policy, priority=1))
+        if SenseAndRecord.ROLE_CAMERA in self._roles:
+            self._scheduler.add_job(Job('image', image_period, align=align, missed_policy=missed_policy, priority=2))
+            if self._motion is not None:
+                self._scheduler.add_job(Job('preview', self._motion_options.get('interval', 5.0), align=False, priority=5))
+        if SenseAndRecord.ROLE_STORAGE in self._roles:
+            if self._retention.enabled:
+                # Daily pass in the small hours, when nobody is looking at the dashboard.
+                self._scheduler.add_job(Job('retention', SenseAndRecord.SECONDS_IN_DAY, phase=3 * SenseAndRecord.SECONDS_IN_HOUR, priority=4))
+            if self._db_writer.commit_every_data_points > 1:
+                # Bounds how long grouped data points can sit uncommitted while we sleep.
+                self._scheduler.add_job(Job('flush', self._db_writer.commit_every_seconds, align=False, priority=3))
+        if self._instrumentation is not None:
+            self._scheduler.add_job(Job('timings', self._instrumentation.get('interval', 900), align=False, priority=6))
+        # Record straight away rather than at the next boundary, which can be
+        # a whole period off; the aligned deadlines carry on as before.  With
+        # sensors, the first image follows in a data point of its own (see
+        # run_schedule) so the camera settling does not hold up the readings.
+        if SenseAndRecord.ROLE_SENSORS in self._roles:
+            self._scheduler.trigger('weather')
+            self._scheduler.trigger('system')
+        elif SenseAndRecord.ROLE_CAMERA in self._roles:
+            self._scheduler.trigger('image')
+
+    def run_schedule(self, on_due=None, sleep=None):
+        """Run the schedule until stop_scheduler(); on_due(deadline, due) replaces tick() for acquisition jobs."""
+        self._initialize_scheduler(sleep)
+        if self._stop_requested:
+            return
+        first_data_point = bool(set([SenseAndRecord.ROLE_SENSORS, SenseAndRecord.ROLE_CAMERA]) & self._roles)
+        while True:
+            deadline, due_jobs = self._scheduler.wait_for_due_jobs()
+            if not due_jobs:
+                break
+            due = set(job.name for job in due_jobs)
+            if 'retention' in due:
+                self._retention.run_in_background()
+                due.discard('retention')
+            if 'flush' in due:
+                self._db_writer.maybe_flush()
+                due.discard('flush')
+            if 'preview' in due:
+                self._check_motion()
+                due.discard('preview')
+            if 'timings' in due:
+                self.report_timings()
+                due.discard('timings')
+            if not due:
+                continue
+            if on_due is not None:
+                on_due(deadline, due)
+            else:
+                self.tick(due)
+            if first_data_point:
+                first_data_point = False
+                self._report_first_data_point()
+                if SenseAndRecord.ROLE_SENSORS in self._roles and SenseAndRecord.ROLE_CAMERA in self._roles:
+                    self._scheduler.trigger('image')
+
+    def tick(self, due):
+        """Acquire and record one data point for the due jobs ('weather', 'system', 'image').
+
+        Returns {stage name: StageResult}.
+        """
+        timestamp = float(int(time.time()))
+        results = self.acquire(due, timestamp)
+        self.adapt(results)
+
+        data_point_id = self._db_writer.begin_data_point(timestamp)
+        self.record(data_point_id, timestamp, results)
+        if self._scheduler is not None:
+            print("Schedule lateness: %s" % ", ".join("%s %0.3fs (jitter %0.3fs)" % (name, stats['mean_lateness'], stats['jitter']) for name, stats in sorted(self._scheduler.stats().items())))
+        print()
+        self._db_writer.end_data_point()
+        return results
+
+    def acquire(self, due, timestamp):
+        """Run the acquisition stages for due concurrently; returns {stage name: StageResult}."""
+        stages = {}
+        if 'weather' in due:
+            stages['weather'] = self._sense_weather
+        if 'system' in due:
+            stages['system'] = self._get_system_data
+        if 'image' in due:
+            stages['image'] = lambda: self._acquire_image(timestamp)
+        return self._pipeline.run(stages)
+
+    def adapt(self, results):
+        """Adjust the sensor period and fire threshold triggers from a weather sweep."""
+        weather = results.get('weather')
+        if weather is None or not weather.ok:
+            return
+        readings, health = weather.value
+        if self._rate_controller is not None and self._scheduler is not None:
+            period = self._rate_controller.update(time.time(), readings)
+            if period is not None:
+                print("Sensor readings now every %0.0fs." % period)
+                self._scheduler.set_period('weather', period)
+        for trigger in self._threshold_triggers:
+            reason = trigger.check(readings)
+            if reason is not None:
+                self.request_image(reason)
+
+    def request_image(self, reason):
+        """Capture an image as soon as possible, within the triggered image limits."""
+        if SenseAndRecord.ROLE_CAMERA not in self._roles:
+            if self._on_image_requested is not None:
+                self._on_image_requested(reason)
+            return
+        if self._scheduler is None:
+            return
+        if not self._capture_limiter.allow():
+            print("Capture trigger suppressed (%s), triggered image limit reached." % reason)
+            return
+        print("Capture triggered: %s" % reason)
+        self._scheduler.trigger('image')
+
+    def _check_motion(self):
         try:
-            print("Internal Sensor:")
-            self._sense_weather_on_bus(cursor, data_point_id, TCA9545.TCA9545_CONFIG_BUS0)
-        except SenseAndRecord.SensorException as e:
-            print("CRITICAL: Internal Weather Sensor Failed to Read.")
+            frame = self._camera.capture_array("lores")
         except Exception as e:
-            print(("CRITICAL: I2C Bus Read Error - ", e))
-
+            print("WARNING: Unable to read the camera preview stream - ", e)
+            return
+        reason = self._motion.check(frame)
+        if reason is not None:
+            self.request_image(reason)
+
+    def report_timings(self):
+        """Store the stage timings gathered since the last report."""
+        histograms = instrumentation.snapshot()
+        if not histograms:
+            return
+        timestamp = int(time.time())
+        output = self._instrumentation.get('output', 'database')
+        if output != 'database':
+            instrumentation.write_json_lines(self._instrumentation_path(output), timestamp, self._timings_source,
+                                             histograms)
+        elif SenseAndRecord.ROLE_STORAGE in self._roles:
+            self.record_timings(timestamp, self._timings_source, histograms)
+        elif self._on_timings is not None:
+            self._on_timings(timestamp, self._timings_source, histograms)
+
+    def record_timings(self, timestamp, source, histograms):
         try:
-            print("External Sensor:")
-            self._sense_weather_on_bus(cursor, data_point_id, TCA9545.TCA9545_CONFIG_BUS1)
-        except SenseAndRecord.SensorException as e:
-            print("CRITICAL: External Weather Sensor Failed to Read.")
+            self._db_writer.insert_timings(timestamp, source, histograms)
         except Exception as e:
-            print(("CRITICAL: I2C Bus Read Error - ", e))
+            print("CRITICAL: Unable to insert stage timings. ", e)
 
-        self._last_weather_sensed = time.mktime(time.localtime())
+    def begin_data_point(self, timestamp):
+        return self._db_writer.begin_data_point(timestamp)
 
-    def _sense_weather_on_bus(self, cursor, data_point_id, bus):
-        # Point the mux to the first bus
-        self._tca9545.write_control_register(bus)
-        control_register = self._tca9545.read_control_register()
+    def end_data_point(self):
+        self._db_writer.end_data_point()
+
+    def record(self, data_point_id, timestamp, results):
+        """Store acquired results under an already begun data point."""
+        print(("*" * 80))
+        print(("%d - %s" % (data_point_id, time.strftime("%m/%d/%Y %H:%M:%S"))))
+        if 'weather' in results:
+            self._record_weather(data_point_id, timestamp, results['weather'])
+        if 'system' in results:
+            self._record_system_data(data_point_id, timestamp, results['system'])
+        if 'image' in results:
+            self._record_image(data_point_id, results['image'])
+        elif self._scheduler is not None and SenseAndRecord.ROLE_CAMERA in self._roles:
+            print("Next camera image will be taken in %ldm...\n" % int((self._scheduler.next_deadline('image') - time.time()) / SenseAndRecord.SECONDS_IN_MINUTE))
+
+        print("Stage times: %s" % ", ".join("%s %0.3fs" % (name, result.duration) for name, result in sorted(results.items())))
+
+    def _sense_weather(self):
+        readings = self._bus_manager.read_all()
+        self._last_weather_sensed = time.mktime(time.localtime())
+        return (readings, self._bus_manager.health_info())
 
-        if control_register & 0x0f == bus:
-            # Grab sensor info from that bus
-            humidity, temp_c, crc_ch, crc_ct = self._sht30.read_humidity_temperature_crc()
-            if True:
+    def _record_weather(self, data_point_id, timestamp, result):
+        print("Reading Sensors...\n")
+        readings, health = result.value
+        self._sensor_status = dict((name, counters) for name, sensor_id, state, counters in health)
+        for name, bus, temp_c, humidity, error in readings:
+            print("%s Sensor:" % name)
+            if error is not None:
+                print(error)
+                continue
+            raw_temp_c, raw_humidity = temp_c, humidity
+            temp_c, humidity = self._filters.process(name, raw_temp_c, raw_humidity)
+            if temp_c is not None:
                 print(("    Temperature:        %0.1f°F" % self._celsius_to_fahrenheit(temp_c)))
+            else:
+                print(("    Temperature:        %0.1f°F [REJECTED]" % self._celsius_to_fahrenheit(raw_temp_c)))
+            if humidity is not None:
                 print(("    Humidity:           %0.1f%%" % humidity))
-                print(("." * 80))
-                cursor.execute("INSERT INTO sensor_data(sensor_id, temperature, humidity, data_point_id) VALUES (?, ?, ?, ?)", (bus, temp_c, humidity, data_point_id));
             else:
-                print(("CRC: %d %d" % crc_ch, crc_ct)) 
-                raise SenseAndRecord.SensorException(bus)
-        return (temp_c, humidity)
-
-    def _get_system_data(self, cursor, data_point_id):
+                print(("    Humidity:           %0.1f%% [REJECTED]" % raw_humidity))
+            print(("." * 80))
+            if self._record_raw_readings:
+                self._db_writer.insert_sensor_data(bus, temp_c, humidity, data_point_id, raw_temp_c, raw_humidity)
+            elif temp_c is not None and humidity is not None:
+                # Without the raw values a rejected reading's row would say
+                # nothing, and sensor_data has never held NULL readings.
+                self._db_writer.insert_sensor_data(bus, temp_c, humidity, data_point_id)
+            self._live.record_sensor(name, timestamp, temp_c, humidity)
+        for name, sensor_id, (state, consecutive_failures, quarantines), counters in health:
+            if state != 'healthy':
+                print("%s Sensor is %s (%d consecutive failures)" % (name, state, consecutive_failures))
+            good_reads, _, bad_crcs, retries, power_cycles = counters
+            bad_readings = self._filters.rejected.get(name, 0)
+            self._db_writer.insert_sensor_health(sensor_id, state, consecutive_failures, good_reads, bad_readings,
+                                                 bad_crcs, retries, power_cycles, quarantines, data_point_id)
+
+    def _get_system_data(self):
+        return self._system_stats.collect()
+
+    def _record_system_data(self, data_point_id, timestamp, result):
         print("System Info:")
+        if isinstance(result.error, IOError):
+            print(("WARNING: Unable to open system temperature file.", result.error))
+            return
+        if not result.ok:
+            print(("CRITICAL: Unable to insert system temperature data. ", result.error))
+            return
         try:
-            # Get SOC Temp
-            system_temp_file = open("/sys/class/thermal/thermal_zone0/temp", "r")
-            temperature_data_string = system_temp_file.readline()
-            soc_temperature = float(temperature_data_string)/1000.0
-            # Get Wifi Info
-            iwconfig_output = subprocess.check_output(["/usr/sbin/iwconfig", "wlan0"]).decode('utf8')
-            link_quality_match = re.match(r'.*Link Quality=([0-9]{,3}/[0-9]{,3})', iwconfig_output, re.MULTILINE | re.DOTALL)
-            link_quality_string = link_quality_match.group(1) # Gives value as x/y
-            num, den = link_quality_string.split("/")
-            link_quality = float(num)/float(den)
-            link_signal_match = re.match(r'.*Signal level=(-?[0-9]{,3})\s*dBm', iwconfig_output, re.MULTILINE | re.DOTALL)
-            link_signal_string = link_signal_match.group(1)
-            link_signal = 30#int(link_signal_string)
-            # Disk Stats
-            df_output = subprocess.check_output(["df", "/"]).decode('utf8')
-            dev, size, used, avail, percent, mountpoint = df_output.split("\n")[1].split()
-
-            cursor.execute("INSERT INTO system_data(soc_temperature, wlan0_link_quality, wlan0_signal_level, storage_total_size, storage_used, storage_avail, data_point_id) VALUES (?, ?, ?, ?, ?, ?, ?);", (soc_temperature, link_quality, link_signal, int(size), int(used), int(avail), data_point_id));
+            system_data, extras = result.value
+            soc_temperature, link_quality, link_signal, size, used, avail = system_data
+            self._db_writer.insert_system_data(soc_temperature, link_quality, link_signal, size, used, avail, data_point_id)
+            self._retention.check_free_space(avail)
+            live_values = {'soc_temperature': soc_temperature, 'wlan0_link_quality': link_quality,
+                           'wlan0_signal_level': link_signal, 'storage_used': used, 'storage_avail': avail}
+            live_values.update(extras)
+            self._live.record_system(timestamp, live_values)
             print(("    SOC Temperature:    %0.1f°F" % self._celsius_to_fahrenheit(soc_temperature)))
             print(("    wlan0 Link Quality: %0.2f%%" % (100.0*link_quality)))
             print(("    wlan0 Signal Level: %d dBm" % link_signal))
             print(("    Storage Used:       %0.1f%%" % (100.0*(float(used)/float(size)))))
+            for name, value in sorted(extras.items()):
+                print(("    %-20s%s" % (name + ":", value)))
             print(("." * 80))
-        except IOError as e:
-            print(("WARNING: Unable to open system temperature file.", e))
         except Exception as e:
             print(("CRITICAL: Unable to insert system temperature data. ", e))
 
-    def _acquire_image(self, cursor, data_point_id, timestamp):
-       print("Camera:")
-       try:
-           print("    Snapping Image...", end="")
-           output_dir = self._output_dir
-           if self.validate_mount():
-               output_dir = self._config['external_share']
-           else:
-               print("[WARNING]: External share is not mounted properly.  Saving images locally.")
-
-           date_subfolders = datetime.fromtimestamp(timestamp).strftime('%Y/%m/%d')
-           friendly_timestamp = datetime.fromtimestamp(timestamp).strftime('%H_%M_%S')
-           images_path = '%s/%s/%s' % (output_dir, self._config['image_subfolder'], date_subfolders)
-           try:
-               os.makedirs(images_path)
-           except OSError as e:
-               pass
-           except Exception as e:
-               print(e)
-           filename = '%s/img_%02d_%s.jpg' % (images_path, timestamp, friendly_timestamp)
-           self._camera.capture_file(filename)
-           cursor.execute("INSERT INTO image_data(filename, data_point_id) VALUES (?, ?);", (filename, data_point_id));
-           print("   [OK]\n")
-           print("." * 80)
-           self._last_image_taken = time.mktime(time.localtime())
-       except Exception as e:
-           print("   [FAILED]\n")
-           print("CRITICAL: Camera Read Error - ", e)
-           print("." * 80)
+    def _acquire_image(self, timestamp):
+        # Images always land in the local spool; the replicator moves them to
+        # the external share so the capture path never waits on the network.
+        date_subfolders = datetime.fromtimestamp(timestamp).strftime('%Y/%m/%d')
+        friendly_timestamp = datetime.fromtimestamp(timestamp).strftime('%H_%M_%S')
+        images_path = '%s/%s' % (self._spool_dir, date_subfolders)
+        filename = '%s/img_%02d_%s.jpg' % (images_path, timestamp, friendly_timestamp)
+        # Only grab the frame here; encoding and the (possibly network) write
+        # happen on the image writer thread.
+        wait = self._camera_ready_at - time.monotonic()
+        if wait > 0:
+            with instrumentation.timed('camera.settle'):
+                time.sleep(wait)
+        with instrumentation.timed('camera.capture'):
+            image = self._camera.capture_image("main")
+        self._last_image_taken = time.mktime(time.localtime())
+        return (image, filename)
+
+    def _record_image(self, data_point_id, result):
+        print("Camera:")
+        print("    Snapping Image...", end="")
+        if not result.ok:
+            print("   [FAILED]\n")
+            print("CRITICAL: Camera Read Error - ", result.error)
+            print("." * 80)
+            return
+        image, filename = result.value
+        # The image_data row is inserted by _image_written once the file is on disk.
+        if self._image_writer.submit(image, filename, data_point_id):
+            print("   [OK]\n")
+        else:
+            print("   [DROPPED]\n")
+            print("WARNING: Image writer is backed up, frame discarded.")
+        print("." * 80)
+
+    def write_image(self, image, filename, token):
+        """Hand a captured frame to the image writer; token is passed back to on_image_written."""
+        return self._image_writer.submit(image, filename, token)
+
+    def record_image_file(self, filename, data_point_id):
+        self._image_written(filename, data_point_id)
+
+    def _image_written(self, filename, data_point_id):
+        self._db_writer.insert_image_data(filename, data_point_id)
+        # With a pipeline the image has to stay local until it has been processed.
+        if self._image_pipeline is not None:
+            self._image_pipeline.submit(filename, data_point_id)
+        elif self._replicator is not None:
+            self._replicator.enqueue(filename)
+
+    def _image_processed(self, filename, info):
+        if info is not None:
+            self._db_writer.update_image_info(filename, info['width'], info['height'], info['bytes'], info['thumbnail'])
+        if self._replicator is not None:
+            self._replicator.enqueue(filename)
+
+    def _image_found(self, filename):
+        # A spooled image the pipeline has not finished with, still queued or
+        # left over from before a restart, goes through it before it may
+        # leave local storage; _image_processed enqueues it afterwards.
+        if self._image_pipeline is None or self._image_pipeline.is_done(filename):
+            self._replicator.enqueue(filename)
+        else:
+            self._image_pipeline.submit(filename, self._db_writer.image_data_point_id(filename))
+
+    def _image_replicated(self, local_filename, share_filename):
+        self._db_writer.update_image_filename(local_filename, share_filename)
+        # The replicator deletes the local copy once this returns, so the row
+        # has to point at the share on disk first.
+        if not self._db_writer.wait_for_commit(self._db_writer.commit_every_seconds):
+            raise IOError("new filename for %s was not committed" % local_filename)
 
     def _celsius_to_fahrenheit(self, celsius):
         return (celsius * (9.0 / 5.0) + 32.0)
@@ -260,9 +602,14 @@ class SenseAndRecord:
 
 
 
-if len(sys.argv) < 2:
-    print("Usage: sense_and_record.py <PATH_TO_JSON_CONFIG>")
-    sys.exit(127)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 1:
+        print("Usage: sense_and_record.py <PATH_TO_JSON_CONFIG>")
+        return 127
+    SenseAndRecord(argv[0]).sense_and_record()
+    return 0
+
 
-snr = SenseAndRecord(sys.argv[1])
-snr.sense_and_record()
+if __name__ == '__main__':
+    sys.exit(main())
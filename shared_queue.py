@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import multiprocessing
+import pickle
+import queue
+import struct
+import time
+from multiprocessing import shared_memory
+
+# Header: messages ever taken (head), messages ever added (tail).
+INDEX = struct.Struct('Q')
+HEAD_OFFSET = 0
+TAIL_OFFSET = INDEX.size
+HEADER_SIZE = 2 * INDEX.size
+LENGTH = struct.Struct('I')
+# How long a blocking put or get waits on its semaphore before checking the
+# indices for a slot whose count a killed process took with it.
+RECHECK_INTERVAL = 1.0
+
+
+class SharedMemoryQueue:
+    """Bounded single producer, single consumer queue between processes.
+
+    Messages are pickled into fixed size slots of one SharedMemory block
+    instead of being pushed through a pipe, so a put never waits on the
+    reader.  Two semaphores count free and filled slots; head and tail live
+    in the block itself, each written by only one side, so there is no lock
+    for a killed worker to leave held.  The block and semaphores outlive the
+    processes using them, so a restarted producer or consumer picks up
+    where its predecessor stopped.  A process killed halfway through a put
+    or get can cost at most the message it was handling.
+
+    The semaphores only say when to look: head and tail decide whether a
+    slot is free or filled.  A process killed between taking a semaphore and
+    moving its index takes the semaphore's count with it; the other side
+    then finds the slot by the indices once its wait runs out, and the
+    count is whole again after the next put or get.  A count left over the
+    other way is dropped when the indices disagree with it.
+
+    Create it before forking; call unlink() once when nobody needs it.
+    """
+
+    DEFAULT_SLOTS = 64
+    DEFAULT_SLOT_SIZE = 4096
+
+    def __init__(self, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE, context=None):
+        context = context if context is not None else multiprocessing
+        self._slots = int(slots)
+        self._slot_size = int(slot_size)
+        self._shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + self._slots * self._slot_size)
+        INDEX.pack_into(self._shm.buf, HEAD_OFFSET, 0)
+        INDEX.pack_into(self._shm.buf, TAIL_OFFSET, 0)
+        self._free = context.Semaphore(self._slots)
+        self._filled = context.Semaphore(0)
+
+    def _slot_offset(self, index):
+        return HEADER_SIZE + (index % self._slots) * self._slot_size
+
+    def put(self, message, timeout=None):
+        """Raises queue.Full if no slot frees up within timeout, ValueError if message does not fit a slot."""
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        if LENGTH.size + len(data) > self._slot_size:
+            raise ValueError("message of %d bytes does not fit a %d byte slot" % (len(data), self._slot_size))
+        if not self._wait(self._free, timeout, lambda: self.qsize() < self._slots):
+            raise queue.Full
+        buf = self._shm.buf
+        tail = INDEX.unpack_from(buf, TAIL_OFFSET)[0]
+        offset = self._slot_offset(tail)
+        LENGTH.pack_into(buf, offset, len(data))
+        buf[offset + LENGTH.size:offset + LENGTH.size + len(data)] = data
+        INDEX.pack_into(buf, TAIL_OFFSET, tail + 1)
+        self._filled.release()
+
+    def get(self, timeout=None):
+        """Raises queue.Empty if nothing arrives within timeout."""
+        if not self._wait(self._filled, timeout, lambda: self.qsize() > 0):
+            raise queue.Empty
+        buf = self._shm.buf
+        head = INDEX.unpack_from(buf, HEAD_OFFSET)[0]
+        offset = self._slot_offset(head)
+        length = LENGTH.unpack_from(buf, offset)[0]
+        data = bytes(buf[offset + LENGTH.size:offset + LENGTH.size + length])
+        INDEX.pack_into(buf, HEAD_OFFSET, head + 1)
+        self._free.release()
+        return pickle.loads(data)
+
+    @staticmethod
+    def _wait(semaphore, timeout, ready):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if semaphore.acquire(timeout=RECHECK_INTERVAL if remaining is None else min(remaining, RECHECK_INTERVAL)):
+                if ready():
+                    return True
+                # A count for a slot the other side already took without one.
+                continue
+            if ready():
+                # The count went with a killed process; the indices still tell.
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def qsize(self):
+        buf = self._shm.buf
+        return INDEX.unpack_from(buf, TAIL_OFFSET)[0] - INDEX.unpack_from(buf, HEAD_OFFSET)[0]
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
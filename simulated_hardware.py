@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Simulated smbus, RPi.GPIO and Picamera2 for running the recorder off a Pi.
+#
+# One SimulatedBus per bus number models the TCA9545 mux(es) on the root bus
+# and an SHT30 behind every (mux, channel, address) that gets talked to.
+# Sensors follow the real command set closely enough for the driver: they
+# NAK reads before a conversion has finished or when periodic mode has no
+# new sample, and produce frames with real CRCs.  Everything is tunable
+# from the "simulation" block of the JSON config:
+#
+#   i2c_latency             seconds per bus transaction
+#   temperature, humidity   centre of the simulated readings
+#   noise                   standard deviation added to each reading
+#   crc_fault_rate          probability a frame comes back with a bad CRC
+#   nak_rate                probability any sensor read is NAK'ed
+#   camera_capture_latency  seconds to capture a still
+#   camera_encode_latency   seconds to "encode" a JPEG
+#   image_bytes             size of the written JPEG
+#   scene_change_rate       probability the preview stream shows a new scene
+#   powered_pins            GPIO pins already switched on, as a crashed
+#                           earlier run leaves them
+#   seed                    random seed, for repeatable runs
+
+import errno
+import math
+import os
+import random
+import threading
+import time
+
+MUX_ADDRESSES = range(0x70, 0x78)
+
+SHT30_SINGLE_SHOT_DURATIONS = {0x06: 0.015, 0x0D: 0.006, 0x10: 0.004,    # clock stretching
+                               0x00: 0.015, 0x0B: 0.006, 0x16: 0.004}    # no clock stretching
+SHT30_PERIODIC_MPS = {0x20: 0.5, 0x21: 1.0, 0x22: 2.0, 0x23: 4.0, 0x27: 10.0}
+
+
+def _nak():
+    return OSError(errno.EREMOTEIO, "Remote I/O error")
+
+
+class SimulatedSHT30:
+
+    def __init__(self, simulation, offset):
+        self._simulation = simulation
+        self._offset = offset
+        self._ready_at = None
+        self._periodic_started = None
+        self._period = None
+        self._samples_fetched = 0
+        self._fetch_requested = False
+
+    def command(self, command):
+        now = time.monotonic()
+        msb, lsb = command >> 8, command & 0xff
+        if msb in (0x24, 0x2C):
+            self._ready_at = now + SHT30_SINGLE_SHOT_DURATIONS.get(lsb, 0.015)
+        elif msb in SHT30_PERIODIC_MPS:
+            self._periodic_started = now
+            self._period = 1.0 / SHT30_PERIODIC_MPS[msb]
+            self._samples_fetched = 0
+        elif command == 0xE000:
+            self._fetch_requested = True
+        elif command == 0x3093:
+            self._periodic_started = None
+
+    def read(self):
+        now = time.monotonic()
+        if self._periodic_started is not None:
+            if not self._fetch_requested:
+                raise _nak()
+            self._fetch_requested = False
+            samples = int((now - self._periodic_started) / self._period)
+            if samples <= self._samples_fetched:
+                raise _nak()
+            self._samples_fetched = samples
+        else:
+            if self._ready_at is None or now < self._ready_at:
+                raise _nak()
+            self._ready_at = None
+        if self._simulation.random.random() < self._simulation.nak_rate:
+            raise _nak()
+        return self._simulation.frame(self._offset)
+
+
+class SimulatedTCA9545:
+
+    def __init__(self):
+        self.control = 0
+
+
+class SimulatedBus:
+    """Stands in for smbus.SMBus; shared by everything on the same bus number."""
+
+    def __init__(self, simulation):
+        self._simulation = simulation
+        self._muxes = {}
+        self._sensors = {}
+        self._lock = threading.Lock()
+        self.transactions = 0
+
+    def _transaction(self):
+        self.transactions += 1
+        if self._simulation.i2c_latency > 0:
+            time.sleep(self._simulation.i2c_latency)
+
+    def _sensor(self, address):
+        routes = [(mux_address, channel) for mux_address, mux in self._muxes.items()
+                  for channel in range(4) if mux.control & (1 << channel)]
+        # Nothing routed, or two identical addresses on the bus at once.
+        if len(routes) != 1:
+            raise _nak()
+        key = routes[0] + (address,)
+        if key not in self._sensors:
+            self._sensors[key] = SimulatedSHT30(self._simulation, offset=len(self._sensors))
+        return self._sensors[key]
+
+    def write_byte_data(self, address, register, data):
+        with self._lock:
+            self._transaction()
+            if address not in MUX_ADDRESSES:
+                raise _nak()
+            self._muxes.setdefault(address, SimulatedTCA9545()).control = data & 0x0f
+
+    def read_byte(self, address):
+        with self._lock:
+            self._transaction()
+            if address not in self._muxes:
+                raise _nak()
+            return self._muxes[address].control
+
+    def write_i2c_block_data(self, address, command, data):
+        with self._lock:
+            self._transaction()
+            self._sensor(address).command((command << 8) | (data[0] if data else 0))
+
+    def read_i2c_block_data(self, address, register, length):
+        with self._lock:
+            self._transaction()
+            return self._sensor(address).read()[:length]
+
+    def close(self):
+        pass
+
+
+class SimulatedGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        self.directions = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction):
+        self.directions[pin] = direction
+        self.pins.setdefault(pin, False)
+
+    def gpio_function(self, pin):
+        return self.directions.get(pin, SimulatedGPIO.IN)
+
+    def input(self, pin):
+        return self.pins.get(pin, False)
+
+    def output(self, pin, value):
+        self.pins[pin] = bool(value)
+
+    def cleanup(self):
+        self.pins.clear()
+        self.directions.clear()
+
+
+GPIO = SimulatedGPIO()
+
+
+class SimulatedImage:
+
+    def __init__(self, simulation, size):
+        self._simulation = simulation
+        self.size = size
+
+    def reduce(self, factor):
+        return SimulatedImage(self._simulation, (self.size[0] // factor, self.size[1] // factor))
+
+    def save(self, fp, format=None, quality=None):
+        if self._simulation.camera_encode_latency > 0:
+            time.sleep(self._simulation.camera_encode_latency)
+        fp.write(b'\xff\xd8' + b'\x00' * max(0, self._simulation.image_bytes - 4) + b'\xff\xd9')
+
+
+class SimulatedCamera:
+    """The slice of Picamera2 the recorder uses."""
+
+    DEFAULT_SIZE = (4056, 3040)
+
+    def __init__(self):
+        self._simulation = _simulation
+        self._size = SimulatedCamera.DEFAULT_SIZE
+        self._lores_size = None
+        self._scene = None
+        self.started = False
+
+    def create_still_configuration(self, main=None, lores=None, **kwargs):
+        config = {'main': dict(main or {'size': SimulatedCamera.DEFAULT_SIZE})}
+        if lores is not None:
+            config['lores'] = dict(lores)
+        return config
+
+    def configure(self, config):
+        self._size = tuple(config['main'].get('size', SimulatedCamera.DEFAULT_SIZE))
+        if 'lores' in config:
+            self._lores_size = tuple(config['lores']['size'])
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def capture_image(self, name="main"):
+        if self._simulation.camera_capture_latency > 0:
+            time.sleep(self._simulation.camera_capture_latency)
+        return SimulatedImage(self._simulation, self._size)
+
+    def capture_array(self, name="main"):
+        # Only the preview stream, as YUV420: luminance rows, then chroma.
+        import numpy
+        if name != "lores" or self._lores_size is None:
+            raise RuntimeError("simulated camera only provides a configured lores stream")
+        width, height = self._lores_size
+        if self._scene is None or self._simulation.random.random() < self._simulation.scene_change_rate:
+            self._scene = numpy.random.RandomState(self._simulation.random.randrange(1 << 30)).randint(
+                0, 256, size=(height * 3 // 2, width)).astype(numpy.uint8)
+        noise = numpy.random.RandomState(self._simulation.random.randrange(1 << 30)).randint(-2, 3, size=self._scene.shape)
+        return numpy.clip(self._scene + noise, 0, 255).astype(numpy.uint8)
+
+    def capture_file(self, filename):
+        with open(filename, 'wb') as image_file:
+            self.capture_image().save(image_file)
+
+    def close(self):
+        pass
+
+
+class Simulation:
+
+    def __init__(self, config):
+        self.i2c_latency = float(config.get('i2c_latency', 0.0002))
+        self.temperature = float(config.get('temperature', 22.0))
+        self.humidity = float(config.get('humidity', 55.0))
+        self.noise = float(config.get('noise', 0.1))
+        self.crc_fault_rate = float(config.get('crc_fault_rate', 0.0))
+        self.nak_rate = float(config.get('nak_rate', 0.0))
+        self.camera_capture_latency = float(config.get('camera_capture_latency', 0.05))
+        self.camera_encode_latency = float(config.get('camera_encode_latency', 0.1))
+        self.image_bytes = int(config.get('image_bytes', 512 * 1024))
+        self.scene_change_rate = float(config.get('scene_change_rate', 0.0))
+        self.random = random.Random(config.get('seed'))
+        self._buses = {}
+        for pin in config.get('powered_pins', []):
+            GPIO.directions[pin] = SimulatedGPIO.OUT
+            GPIO.pins[pin] = True
+
+    def SMBus(self, bus_number=1):
+        if bus_number not in self._buses:
+            self._buses[bus_number] = SimulatedBus(self)
+        return self._buses[bus_number]
+
+    def frame(self, offset):
+        import SHT30
+        # A slow daily swing plus noise, each sensor a little different.
+        swing = 5.0 * math.sin(time.time() * 2 * math.pi / 86400.0)
+        temperature = self.temperature + offset + swing + self.random.gauss(0, self.noise)
+        humidity = min(100.0, max(0.0, self.humidity - 2 * swing + self.random.gauss(0, self.noise)))
+        raw_temperature = max(0, min(0xffff, int(round((temperature + 45) * 65535.0 / 175.0))))
+        raw_humidity = max(0, min(0xffff, int(round(humidity * 65535.0 / 100.0))))
+        t = [raw_temperature >> 8, raw_temperature & 0xff]
+        h = [raw_humidity >> 8, raw_humidity & 0xff]
+        frame = t + [SHT30.crc8(t)] + h + [SHT30.crc8(h)]
+        if self.random.random() < self.crc_fault_rate:
+            frame[2] ^= 0x01
+        return frame
+
+    def system_stat_paths(self, directory):
+        # Kept with the recorder's output so nothing is left behind elsewhere
+        # and every run reuses the same two files.
+        system_dir = os.path.join(directory, 'simulation')
+        try:
+            os.makedirs(system_dir)
+        except OSError:
+            pass
+        with open(os.path.join(system_dir, 'temp'), 'w') as temp_file:
+            temp_file.write('48312\n')
+        with open(os.path.join(system_dir, 'wireless'), 'w') as wireless_file:
+            wireless_file.write('Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE\n'
+                                ' face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22\n'
+                                ' wlan0: 0000   54.  -56.  -256        0      0      0      0      0        0\n')
+        return {'thermal_path': os.path.join(system_dir, 'temp'),
+                'wireless_path': os.path.join(system_dir, 'wireless')}
+
+
+_simulation = None
+
+
+def configured(config=None):
+    """The process wide Simulation, created from config on first use."""
+    global _simulation
+    if _simulation is None:
+        _simulation = Simulation(config or {})
+    return _simulation
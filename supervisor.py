@@ -0,0 +1,416 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Runs the recorder as three worker processes under a watchdog.
+#
+#   python supervisor.py <PATH_TO_JSON_CONFIG>
+#
+# The sensors worker reads the SHT30s and system stats, the camera worker
+# captures and writes images to the local spool, and the storage worker owns
+# the database, sync, replication and metrics.  The acquisition workers hand
+# their results to storage through shared memory queues, so a hung camera or
+# a sensor stuck in I2C only stalls its own process; the supervisor kills
+# and restarts any worker whose heartbeat goes quiet.
+#
+# Config keys (all optional):
+#   supervisor_watchdog_timeouts  {"sensors": 120, "camera": 180, "storage": 300} seconds
+#   supervisor_startup_timeout    seconds a worker gets to come up, default 600
+#   supervisor_queue_slots        slots per queue, default 64
+#   supervisor_queue_slot_size    bytes per slot, default 4096
+#   supervisor_stats_interval     seconds between stats reports, default 3600
+
+import json
+import multiprocessing
+import pickle
+import queue
+import signal
+import sys
+import threading
+import time
+
+from acquisition import StageResult
+from sense_and_record import SenseAndRecord
+from shared_queue import SharedMemoryQueue
+
+# Slots of each worker's shared stats array.
+HEARTBEAT = 0
+JOBS = 1
+ERRORS = 2
+BUSY_SECONDS = 3
+MAX_JOB_SECONDS = 4
+LATENCY_SECONDS = 5
+MAX_LATENCY_SECONDS = 6
+DROPPED = 7
+STATS_SIZE = 8
+
+DEFAULT_WATCHDOG_TIMEOUTS = {SenseAndRecord.ROLE_SENSORS: 120.0,
+                             SenseAndRecord.ROLE_CAMERA: 180.0,
+                             SenseAndRecord.ROLE_STORAGE: 300.0}
+DEFAULT_STARTUP_TIMEOUT = 600.0
+DEFAULT_STATS_INTERVAL = 3600.0
+# How often idle workers beat; must stay well under every watchdog timeout.
+HEARTBEAT_INTERVAL = 1.0
+# Keeps a batch of pickled histograms well inside a default queue slot.
+TIMINGS_STAGES_PER_MESSAGE = 8
+# How long an acquisition worker waits for room in its queue before it drops
+# the message; a stalled storage worker must not stop it heartbeating.
+QUEUE_PUT_TIMEOUT = 1.0
+
+
+class WorkerStats:
+    """A worker's heartbeat and job counters in a shared array, written by the worker, read by the supervisor.
+
+    Latency is how late a job finished relative to when it became due: the
+    schedule deadline for acquisition, the enqueue time for storage.
+    """
+
+    def __init__(self, context):
+        self._values = context.Array('d', STATS_SIZE)
+
+    def beat(self):
+        self._values[HEARTBEAT] = time.monotonic()
+
+    @property
+    def heartbeat(self):
+        return self._values[HEARTBEAT]
+
+    def record(self, duration, latency, ok=True):
+        with self._values.get_lock():
+            self._values[HEARTBEAT] = time.monotonic()
+            self._values[JOBS] += 1
+            if not ok:
+                self._values[ERRORS] += 1
+            self._values[BUSY_SECONDS] += duration
+            self._values[MAX_JOB_SECONDS] = max(self._values[MAX_JOB_SECONDS], duration)
+            self._values[LATENCY_SECONDS] += latency
+            self._values[MAX_LATENCY_SECONDS] = max(self._values[MAX_LATENCY_SECONDS], latency)
+
+    def drop(self):
+        with self._values.get_lock():
+            self._values[DROPPED] += 1
+
+    def snapshot(self):
+        with self._values.get_lock():
+            return list(self._values)
+
+
+def _portable_error(error):
+    # Results cross a process boundary; not every exception survives pickling.
+    if error is None:
+        return None
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _timings_sender(output, stages_per_message=TIMINGS_STAGES_PER_MESSAGE):
+    def send(timestamp, source, histograms):
+        stages = sorted(histograms)
+        for start in range(0, len(stages), stages_per_message):
+            batch = dict((stage, histograms[stage]) for stage in stages[start:start + stages_per_message])
+            try:
+                output.put(('timings', None, timestamp, time.monotonic(), source, batch), timeout=QUEUE_PUT_TIMEOUT)
+            except queue.Full:
+                return
+    return send
+
+
+def _put_or_drop(output, message, stats):
+    try:
+        output.put(message, timeout=QUEUE_PUT_TIMEOUT)
+    except queue.Full:
+        stats.drop()
+        print("WARNING: Storage queue is full, %s message dropped." % message[0])
+
+
+def _heartbeat_sleep(stats, stopping, recorder, capture_requested=None):
+    def sleep(seconds):
+        stats.beat()
+        if stopping.wait(min(seconds, HEARTBEAT_INTERVAL)):
+            recorder.stop_scheduler()
+        elif capture_requested is not None and capture_requested.is_set():
+            capture_requested.clear()
+            recorder.request_image("requested by the sensors worker")
+    return sleep
+
+
+def _reset_signals():
+    # Forked workers inherit the supervisor's handlers, which would stop every
+    # worker when the watchdog terminates just one.  Ctrl-C reaches the whole
+    # process group; leave it to the supervisor to stop workers in order.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_sensors(config_path, output, capture_requested, stopping, stats):
+    _reset_signals()
+    recorder = SenseAndRecord(config_path, roles=(SenseAndRecord.ROLE_SENSORS,),
+                              on_image_requested=lambda reason: capture_requested.set(),
+                              on_timings=_timings_sender(output))
+    stats.beat()
+
+    def on_due(deadline, due):
+        timestamp = float(int(time.time()))
+        results = recorder.acquire(due, timestamp)
+        recorder.adapt(results)
+        finished = time.monotonic()
+        for result in results.values():
+            stats.record(result.duration, max(0.0, time.time() - deadline), result.ok)
+        payload = dict((name, (result.value, _portable_error(result.error), result.duration))
+                       for name, result in results.items())
+        _put_or_drop(output, ('results', deadline, timestamp, finished, payload), stats)
+
+    try:
+        recorder.start()
+        recorder.run_schedule(on_due=on_due, sleep=_heartbeat_sleep(stats, stopping, recorder))
+    finally:
+        recorder.stop()
+
+
+def run_camera(config_path, output, capture_requested, stopping, stats):
+    _reset_signals()
+
+    def image_written(filename, due):
+        deadline, timestamp = due
+        # A dropped image is still written; it just never gets an image_data row.
+        _put_or_drop(output, ('image', deadline, timestamp, time.monotonic(), filename), stats)
+
+    recorder = SenseAndRecord(config_path, roles=(SenseAndRecord.ROLE_CAMERA,), on_image_written=image_written,
+                              on_timings=_timings_sender(output))
+    stats.beat()
+
+    def on_due(deadline, due):
+        timestamp = float(int(time.time()))
+        result = recorder.acquire(due, timestamp)['image']
+        stats.record(result.duration, max(0.0, time.time() - deadline), result.ok)
+        if not result.ok:
+            print("CRITICAL: Camera Read Error - ", result.error)
+            return
+        image, filename = result.value
+        # The writer calls image_written once the file is safely on disk.
+        if not recorder.write_image(image, filename, (deadline, timestamp)):
+            print("WARNING: Image writer is backed up, frame discarded.")
+
+    try:
+        recorder.start()
+        recorder.run_schedule(on_due=on_due, sleep=_heartbeat_sleep(stats, stopping, recorder, capture_requested))
+    finally:
+        recorder.stop()
+
+
+def run_storage(config_path, inputs, stopping, stats, max_open_data_points=32):
+    _reset_signals()
+    recorder = SenseAndRecord(config_path, roles=(SenseAndRecord.ROLE_STORAGE,))
+    stats.beat()
+    # Sensor and image results due at the same deadline share a data point.
+    data_points = {}
+
+    def data_point_for(deadline, timestamp):
+        if deadline in data_points:
+            return data_points[deadline], False
+        data_point_id = recorder.begin_data_point(timestamp)
+        data_points[deadline] = data_point_id
+        while len(data_points) > max_open_data_points:
+            del data_points[min(data_points)]
+        return data_point_id, True
+
+    def store(message):
+        kind, deadline, timestamp, enqueued = message[:4]
+        if kind == 'timings':
+            recorder.record_timings(timestamp, message[4], message[5])
+            return
+        started = time.monotonic()
+        data_point_id, new = data_point_for(deadline, timestamp)
+        if kind == 'results':
+            results = dict((name, StageResult(name, value=value, error=error, duration=duration))
+                           for name, (value, error, duration) in message[4].items())
+            recorder.record(data_point_id, timestamp, results)
+            print()
+        else:
+            recorder.record_image_file(message[4], data_point_id)
+        if new:
+            recorder.end_data_point()
+        finished = time.monotonic()
+        stats.record(finished - started, finished - enqueued)
+
+    recorder.start()
+    # Retention and the periodic flush keep their own schedule.
+    schedule = threading.Thread(target=recorder.run_schedule, name='storage-schedule', daemon=True)
+    schedule.start()
+    try:
+        # Keep going after stop is requested until a full pass finds both
+        # queues empty.
+        while True:
+            stop_requested = stopping.is_set()
+            idle = True
+            for source in inputs:
+                try:
+                    message = source.get(timeout=HEARTBEAT_INTERVAL / len(inputs))
+                except queue.Empty:
+                    continue
+                idle = False
+                store(message)
+                # Take whatever else is queued without waiting on the other source.
+                while True:
+                    try:
+                        message = source.get(timeout=0)
+                    except queue.Empty:
+                        break
+                    store(message)
+            stats.beat()
+            if stop_requested and idle:
+                break
+    finally:
+        recorder.stop_scheduler()
+        schedule.join()
+        recorder.stop()
+
+
+class WorkerHandle:
+
+    def __init__(self, context, role, target, args, watchdog_timeout, startup_timeout):
+        self.role = role
+        self.restarts = 0
+        self.stats = WorkerStats(context)
+        self._context = context
+        self._target = target
+        self._args = args
+        self._watchdog_timeout = watchdog_timeout
+        self._startup_timeout = startup_timeout
+        self._process = None
+        self._started = 0.0
+
+    def start(self):
+        self._started = time.monotonic()
+        self._process = self._context.Process(target=self._target, args=self._args + (self.stats,),
+                                              name='greenhouse-%s' % self.role)
+        self._process.start()
+
+    def check(self, stopping):
+        """Restart the worker if it died or its heartbeat went quiet; returns a reason when it did."""
+        now = time.monotonic()
+        if not self._process.is_alive():
+            reason = "exited with code %s" % self._process.exitcode
+        elif self.stats.heartbeat < self._started:
+            if now - self._started <= self._startup_timeout:
+                return None
+            reason = "did not start within %0.0fs" % self._startup_timeout
+        elif now - self.stats.heartbeat > self._watchdog_timeout:
+            reason = "no heartbeat for %0.0fs" % (now - self.stats.heartbeat)
+        else:
+            return None
+        if stopping.is_set():
+            return None
+        self.kill()
+        self.restarts += 1
+        self.start()
+        return reason
+
+    def kill(self, grace=5.0):
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(grace)
+        if self._process.is_alive():
+            self._process.kill()
+        self._process.join()
+
+    def join(self, timeout):
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self.kill()
+
+    def report(self, elapsed):
+        _, jobs, errors, busy, max_job, latency, max_latency, dropped = self.stats.snapshot()
+        mean_job = busy / jobs if jobs else 0.0
+        mean_latency = latency / jobs if jobs else 0.0
+        return ("%-8s %6d jobs (%0.2f/min), %d errors, job %0.3fs mean %0.3fs max, latency %0.3fs mean %0.3fs max, "
+                "%d dropped, %d restarts" % (self.role, jobs, 60.0 * jobs / elapsed if elapsed > 0 else 0.0, errors,
+                                             mean_job, max_job, mean_latency, max_latency, dropped, self.restarts))
+
+
+class Supervisor:
+
+    def __init__(self, config_file_name):
+        with open(config_file_name) as json_config_file:
+            config = json.load(json_config_file)
+        # Fork so the queues and stats arrays are simply inherited.
+        self._context = multiprocessing.get_context('fork')
+        self._stopping = self._context.Event()
+        # Storage stops last, once nothing more can be queued for it.
+        self._storage_stopping = self._context.Event()
+        # Set by the sensors worker's threshold triggers, acted on by the camera worker.
+        self._capture_requested = self._context.Event()
+        slots = config.get('supervisor_queue_slots', SharedMemoryQueue.DEFAULT_SLOTS)
+        slot_size = config.get('supervisor_queue_slot_size', SharedMemoryQueue.DEFAULT_SLOT_SIZE)
+        self._queues = [SharedMemoryQueue(slots, slot_size, self._context) for _ in range(2)]
+        sensor_queue, camera_queue = self._queues
+        timeouts = dict(DEFAULT_WATCHDOG_TIMEOUTS)
+        timeouts.update(config.get('supervisor_watchdog_timeouts', {}))
+        startup_timeout = float(config.get('supervisor_startup_timeout', DEFAULT_STARTUP_TIMEOUT))
+        self._stats_interval = float(config.get('supervisor_stats_interval', DEFAULT_STATS_INTERVAL))
+        self._stop_signalled = False
+        workers = ((SenseAndRecord.ROLE_STORAGE, run_storage, (config_file_name, self._queues, self._storage_stopping)),
+                   (SenseAndRecord.ROLE_SENSORS, run_sensors, (config_file_name, sensor_queue, self._capture_requested, self._stopping)),
+                   (SenseAndRecord.ROLE_CAMERA, run_camera, (config_file_name, camera_queue, self._capture_requested, self._stopping)))
+        if not config.get('camera_enabled', True):
+            workers = workers[:2]
+        self._workers = [WorkerHandle(self._context, role, target, args, float(timeouts[role]), startup_timeout)
+                         for role, target, args in workers]
+
+    def run(self):
+        print("Starting Sense and Record v2.0 (supervised)")
+        # Only set a flag here; setting the Event from a handler can deadlock
+        # on the lock the interrupted code already holds.
+        signal.signal(signal.SIGTERM, self._signalled)
+        signal.signal(signal.SIGINT, self._signalled)
+        started = time.monotonic()
+        next_report = started + self._stats_interval
+        for worker in self._workers:
+            worker.start()
+        try:
+            while not self._stop_signalled:
+                time.sleep(HEARTBEAT_INTERVAL)
+                for worker in self._workers:
+                    reason = worker.check(self._stopping)
+                    if reason is not None:
+                        print("WARNING: Restarted %s worker, it %s." % (worker.role, reason))
+                if time.monotonic() >= next_report:
+                    next_report += self._stats_interval
+                    self.report(time.monotonic() - started)
+        finally:
+            self.stop()
+            self.report(time.monotonic() - started)
+            for shared_queue in self._queues:
+                shared_queue.close()
+                shared_queue.unlink()
+
+    def _signalled(self, signum, frame):
+        self._stop_signalled = True
+
+    def report(self, elapsed):
+        print("Worker stats after %0.0fs (queued: %s):" % (elapsed, ", ".join(str(q.qsize()) for q in self._queues)))
+        for worker in self._workers:
+            print("    " + worker.report(elapsed))
+
+    def stop(self, timeout=30.0):
+        self._stopping.set()
+        # Acquisition first, so storage can drain what they queued.
+        for worker in reversed(self._workers):
+            if worker.role == SenseAndRecord.ROLE_STORAGE:
+                self._storage_stopping.set()
+            worker.join(timeout)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 1:
+        print("Usage: supervisor.py <PATH_TO_JSON_CONFIG>")
+        return 127
+    Supervisor(argv[0]).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import gzip
+import http.client
+import json
+import queue
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+
+from database_writer import SYNCHRONIZED_CHANGED, SYNCHRONIZED_UPLOADED
+
+SELECT_UNSYNCHRONIZED = ('SELECT id, timestamp FROM data_points WHERE id > ? AND (synchronized & %d) = 0 '
+                         'ORDER BY id LIMIT ?' % SYNCHRONIZED_UPLOADED)
+# The points in a batch are not contiguous (changed points come back with
+# new ones), so everything below takes the batch's ids; fill in the
+# placeholders with _id_list().
+SELECT_SENSOR_DATA = 'SELECT data_point_id, sensor_id, temperature, humidity FROM sensor_data WHERE data_point_id IN (%s)'
+SELECT_SYSTEM_DATA = ('SELECT data_point_id, soc_temperature, wlan0_link_quality, wlan0_signal_level, storage_total_size, '
+                      'storage_used, storage_avail FROM system_data WHERE data_point_id IN (%s)')
+SELECT_IMAGE_DATA = 'SELECT data_point_id, filename FROM image_data WHERE data_point_id IN (%s)'
+# From here on an image row added or changed under one of the points sets
+# the changed bit again, which keeps MARK_SYNCHRONIZED off that point.
+CLEAR_CHANGED = ('UPDATE data_points SET synchronized = synchronized & ~%d WHERE id IN (%%s)' % SYNCHRONIZED_CHANGED)
+MARK_SYNCHRONIZED = ('UPDATE data_points SET synchronized = synchronized | %d WHERE id IN (%%s) AND (synchronized & %d) = 0'
+                     % (SYNCHRONIZED_UPLOADED, SYNCHRONIZED_CHANGED))
+
+
+def _id_list(ids):
+    return ','.join('?' * len(ids))
+
+
+class SyncService:
+    """Uploads data points that are not yet synchronized to an HTTP endpoint.
+
+    A reader thread gathers batches of unsynchronized data points together
+    with their sensor, system and image rows into gzip'ed JSON payloads and
+    hands them to max_in_flight sender threads through a queue of the same
+    size, so at most 2 * max_in_flight batches exist at once.  Each sender
+    keeps one persistent connection, retries with exponential backoff, and
+    marks its batch synchronized with one UPDATE once the endpoint accepts
+    it with a 2xx status.
+
+    Image rows arrive after their data point, from the image writer and
+    later the replicator; each one clears the point's upload bit again (see
+    DatabaseWriter), and once caught up the reader goes back over the table
+    for such points, so the endpoint gets the point again, complete.
+    """
+
+    DEFAULT_BATCH_SIZE = 200
+    DEFAULT_MAX_IN_FLIGHT = 2
+    DEFAULT_POLL_INTERVAL = 60.0
+    DEFAULT_TIMEOUT = 30.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, db_path, endpoint, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 poll_interval=DEFAULT_POLL_INTERVAL, timeout=DEFAULT_TIMEOUT, headers=None):
+        url = urlsplit(endpoint)
+        self._scheme = url.scheme
+        self._netloc = url.netloc
+        self._path = url.path or '/'
+        if url.query:
+            self._path += '?' + url.query
+        self._db_path = db_path
+        self._batch_size = int(batch_size)
+        self._poll_interval = float(poll_interval)
+        self._timeout = float(timeout)
+        self._headers = dict(headers or {})
+        self._batches = queue.Queue(maxsize=max(1, int(max_in_flight)))
+        self._stopping = threading.Event()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._in_flight = 0
+        self.batches_sent = 0
+        self.data_points_sent = 0
+        self.retries = 0
+        self._threads = [threading.Thread(target=self._read_batches, name='sync-reader', daemon=True)]
+        self._threads += [threading.Thread(target=self._send_batches, name='sync-sender-%d' % i, daemon=True)
+                          for i in range(max(1, int(max_in_flight)))]
+
+    @classmethod
+    def from_config(cls, config, db_path):
+        return cls(db_path, config['sync_endpoint'],
+                   batch_size=config.get('sync_batch_size', cls.DEFAULT_BATCH_SIZE),
+                   max_in_flight=config.get('sync_max_in_flight', cls.DEFAULT_MAX_IN_FLIGHT),
+                   poll_interval=config.get('sync_poll_interval', cls.DEFAULT_POLL_INTERVAL),
+                   timeout=config.get('sync_timeout', cls.DEFAULT_TIMEOUT),
+                   headers=config.get('sync_headers'))
+
+    def start(self):
+        self._db = sqlite3.connect(self._db_path, isolation_level=None, timeout=120.0, check_same_thread=False)
+        for thread in self._threads:
+            thread.start()
+
+    def _build_batch(self, last_id):
+        with self._db_lock:
+            points = self._db.execute(SELECT_UNSYNCHRONIZED, (last_id, self._batch_size)).fetchall()
+            if not points:
+                return None
+            ids = [point_id for point_id, _ in points]
+            placeholders = _id_list(ids)
+            data_points = dict((point_id, {'id': point_id, 'timestamp': timestamp, 'sensor_data': [],
+                                           'system_data': None, 'image_data': []})
+                               for point_id, timestamp in points)
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(CLEAR_CHANGED % placeholders, ids)
+                for row in self._db.execute(SELECT_SENSOR_DATA % placeholders, ids):
+                    data_points[row[0]]['sensor_data'].append({'sensor_id': row[1], 'temperature': row[2], 'humidity': row[3]})
+                for row in self._db.execute(SELECT_SYSTEM_DATA % placeholders, ids):
+                    data_points[row[0]]['system_data'] = {'soc_temperature': row[1], 'wlan0_link_quality': row[2],
+                                                          'wlan0_signal_level': row[3], 'storage_total_size': row[4],
+                                                          'storage_used': row[5], 'storage_avail': row[6]}
+                for row in self._db.execute(SELECT_IMAGE_DATA % placeholders, ids):
+                    data_points[row[0]]['image_data'].append({'filename': row[1]})
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._in_flight += 1
+        payload = json.dumps({'data_points': [data_points[point_id] for point_id, _ in points]}, separators=(',', ':'))
+        return (ids, gzip.compress(payload.encode('utf8')))
+
+    def _read_batches(self):
+        last_id = 0
+        while not self._stopping.is_set():
+            try:
+                batch = self._build_batch(last_id)
+            except sqlite3.Error as e:
+                print("WARNING: Unable to read unsynchronized data - ", e)
+                batch = None
+            if batch is None:
+                if self._in_flight == 0:
+                    # Caught up; points sent again sit below last_id.
+                    last_id = 0
+                self._stopping.wait(self._poll_interval)
+                continue
+            last_id = batch[0][-1]
+            # Blocks while max_in_flight batches are already waiting.
+            while not self._stopping.is_set():
+                try:
+                    self._batches.put(batch, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
+
+    def _connect(self):
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._netloc, timeout=self._timeout)
+        return http.client.HTTPConnection(self._netloc, timeout=self._timeout)
+
+    def _post(self, connection, body):
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        headers.update(self._headers)
+        connection.request('POST', self._path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status // 100 != 2:
+            raise IOError("sync endpoint returned %d %s" % (response.status, response.reason))
+
+    def _send_batches(self):
+        connection = None
+        while not self._stopping.is_set():
+            try:
+                ids, body = self._batches.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            backoff = 1.0
+            while not self._stopping.is_set():
+                try:
+                    if connection is None:
+                        connection = self._connect()
+                    self._post(connection, body)
+                    break
+                except (IOError, OSError, http.client.HTTPException) as e:
+                    # Start over on a fresh connection after any failure.
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    self.retries += 1
+                    print("WARNING: Sync upload failed, retrying in %0.0fs - %s" % (backoff, e))
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, SyncService.MAX_BACKOFF)
+            else:
+                break
+            with self._db_lock:
+                self._db.execute(MARK_SYNCHRONIZED % _id_list(ids), ids)
+                self._in_flight -= 1
+            self.batches_sent += 1
+            self.data_points_sent += len(ids)
+        if connection is not None:
+            connection.close()
+
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
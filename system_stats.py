@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import os
+
+import instrumentation
+
+# /proc/net/wireless reports link quality against this maximum for brcmfmac,
+# which is what iwconfig shows as "Link Quality=x/70".
+WIRELESS_LINK_QUALITY_MAX = 70.0
+THERMAL_ZONE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+PROC_NET_WIRELESS_PATH = "/proc/net/wireless"
+PROC_MEMINFO_PATH = "/proc/meminfo"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+
+class SystemStatsCollector:
+    """Collects the system_data figures from /proc and /sys without forking.
+
+    The SoC thermal file is held open and re-read in place.  Extra metrics
+    can be registered with add_metric(); they are returned alongside the
+    standard values but are not stored in system_data.
+    """
+
+    def __init__(self, interface="wlan0", storage_path="/", thermal_path=THERMAL_ZONE_PATH,
+                 wireless_path=PROC_NET_WIRELESS_PATH):
+        self._interface = interface
+        self._storage_path = storage_path
+        self._thermal_path = thermal_path
+        self._wireless_path = wireless_path
+        self._thermal_file = None
+        self._extra_metrics = []
+
+    def add_metric(self, name, read_function):
+        self._extra_metrics.append((name, read_function))
+
+    def add_default_metrics(self):
+        self.add_metric('load_average_1m', read_load_average)
+        self.add_metric('memory_available_kb', read_memory_available)
+        if os.path.exists(THROTTLED_PATH):
+            self.add_metric('throttled', read_throttled)
+
+    def read_soc_temperature(self):
+        if self._thermal_file is None:
+            self._thermal_file = open(self._thermal_path, "rb", buffering=0)
+        self._thermal_file.seek(0)
+        return float(self._thermal_file.read(16)) / 1000.0
+
+    def read_wireless(self):
+        """Returns (link_quality as a 0-1 fraction, signal level in dBm)."""
+        prefix = self._interface + ":"
+        with open(self._wireless_path) as wireless:
+            for line in wireless:
+                fields = line.split()
+                if fields and fields[0] == prefix:
+                    # iface: status link level noise ...
+                    link_quality = float(fields[2].rstrip('.')) / WIRELESS_LINK_QUALITY_MAX
+                    signal_level = int(float(fields[3].rstrip('.')))
+                    return (link_quality, signal_level)
+        raise IOError("%s not listed in %s" % (self._interface, self._wireless_path))
+
+    def read_storage(self):
+        """Returns (size, used, avail) in 1K blocks, matching df."""
+        stats = os.statvfs(self._storage_path)
+        size = stats.f_blocks * stats.f_frsize // 1024
+        used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize // 1024
+        avail = stats.f_bavail * stats.f_frsize // 1024
+        return (size, used, avail)
+
+    def collect(self):
+        """Returns the system_data tuple plus a dict of any extra metrics."""
+        with instrumentation.timed('system.soc_temperature'):
+            soc_temperature = self.read_soc_temperature()
+        with instrumentation.timed('system.wireless'):
+            link_quality, link_signal = self.read_wireless()
+        with instrumentation.timed('system.storage'):
+            size, used, avail = self.read_storage()
+        extras = {}
+        for name, read_function in self._extra_metrics:
+            try:
+                with instrumentation.timed('system.' + name):
+                    extras[name] = read_function()
+            except (IOError, OSError, ValueError):
+                extras[name] = None
+        return (soc_temperature, link_quality, link_signal, size, used, avail), extras
+
+    def close(self):
+        if self._thermal_file is not None:
+            self._thermal_file.close()
+            self._thermal_file = None
+
+
+def read_process_age():
+    """Seconds since this process was started, or None off Linux."""
+    try:
+        with open("/proc/self/stat") as stat:
+            # Skip past the command name, which may itself contain spaces.
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as uptime:
+            seconds_since_boot = float(uptime.read().split()[0])
+        return seconds_since_boot - float(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def read_load_average():
+    return os.getloadavg()[0]
+
+
+def read_memory_available():
+    with open(PROC_MEMINFO_PATH) as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1])
+    return None
+
+
+def read_throttled():
+    with open(THROTTLED_PATH) as throttled:
+        return int(throttled.read().strip(), 16)